@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Time the stages of the processing on synthetic data.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import tracemalloc
+from functools import partial
+import numpy as np
+from scipy.sparse import csr_matrix
+import osr
+import reverse_sediment
+import find_upstream
+import upstream_index
+import make_test_dataset
+
+# Default shapes of the rasters in the benchmark suite
+SUITE_SHAPES = ['200x200', '1000x1000']
+
+# Times and peak memory that are more than this fraction above the baseline are regressions
+DEFAULT_TOLERANCE = 0.25
+
+# Increases in time (seconds) and peak memory (bytes) smaller than these are noise, not regressions
+MIN_INCREASE = {'time': 0.01, 'peak_memory': 1e6}
+
+def make_nested_upstream(num_samples, catchment_size, nesting, seed=0):
+    """Create upstream coordinate pairs for num_samples measurements on
+       chains of nesting samples, where each sample's catchment contains
+       catchment_size cells plus the catchments of the samples upstream of it.
+    """
+    rng = np.random.RandomState(seed)
+    upstream = []
+    width = int(np.ceil(np.sqrt(catchment_size)))
+    for chain in range(int(np.ceil(num_samples / nesting))):
+        chain_coords = []
+        for _ in range(min(nesting, num_samples - len(upstream))):
+            rows = rng.randint(0, width * nesting, catchment_size)
+            cols = chain * width + rng.randint(0, width, catchment_size)
+            chain_coords = list(zip(rows.tolist(), cols.tolist())) + chain_coords
+            upstream.append(np.array(chain_coords))
+    return upstream
+
+# Loop-based implementations that the vectorized versions in reverse_sediment replaced.
+# These are kept to check the vectorized versions and measure their speed-up.
+
+def find_min_max_nonzero_coords_loop(upstream):
+    """Reference implementation of reverse_sediment.find_min_max_nonzero_coords.
+    """
+    minx = np.inf
+    maxx = -np.inf
+    miny = np.inf
+    maxy = -np.inf
+    for _, upstream_coords in enumerate(upstream):
+        for coord in upstream_coords:
+            if coord[1] < minx:
+                minx = coord[1]
+            if coord[1] > maxx:
+                maxx = coord[1]
+            if coord[0] < miny:
+                miny = coord[0]
+            if coord[0] > maxy:
+                maxy = coord[0]
+    return minx, maxx, miny, maxy
+
+def find_nonzero_cells_loop(upstream):
+    """Reference implementation of reverse_sediment.find_nonzero_cells.
+    """
+    minx, maxx, miny, maxy = find_min_max_nonzero_coords_loop(upstream)
+    nx = maxx - minx + 1
+    ny = maxy - miny + 1
+    if not np.isfinite(nx):
+        nx = 0
+    if not np.isfinite(ny):
+        ny = 0
+    # coordinate pairs of points in full 2D landscape that will be solved for
+    full_coords = []
+    # a 2D landscape with cells that will be solved for containing their
+    # index in the reduced-size system that will be solved
+    # initialize to -1 to indicate that value has not been set
+    reduced_idxs = -1*np.ones([ny, nx], dtype=np.int64)
+    reduced_idx = 0
+    num_nonzero = 0
+    for coords_upstream_of_measurement in upstream:
+        for coord in coords_upstream_of_measurement:
+            if reduced_idxs[coord[0] - miny, coord[1] - minx] < 0:
+                # point has not been added to the reduced system yet, so add it
+                full_coords.append(coord)
+                reduced_idxs[coord[0] - miny, coord[1] - minx] = reduced_idx
+                reduced_idx += 1
+            num_nonzero += 1
+    return full_coords, reduced_idxs, num_nonzero, minx, miny
+
+def build_A_loop(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny):
+    """Reference implementation of reverse_sediment.build_A.
+    """
+    num_rows = len(upstream)
+    indices = np.zeros(num_nonzero, dtype=np.int64)
+    indptr = np.zeros(num_rows+1, dtype=np.int64)
+    Adata = np.ones(num_nonzero, dtype=np.float32)
+
+    nz_idx = 0
+    for row_idx in range(num_rows):
+        indptr[row_idx] = nz_idx
+        for coord in upstream[row_idx]:
+            reduced_idx = reduced_idxs[coord[0] - miny, coord[1] - minx]
+            indices[nz_idx] = reduced_idx
+            Adata[nz_idx] = 1.0/len(upstream[row_idx])
+            nz_idx += 1
+    assert(nz_idx == num_nonzero)
+    indptr[-1] = nz_idx
+    A = csr_matrix((Adata, indices, indptr), shape=(num_rows, len(full_coords)))
+
+    return A
+
+def time_function(function, *args):
+    """Call function with args and return its result and the wall time taken.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark_build_A(upstream):
+    """Compare the vectorized and loop-based construction of the reduced system.
+    """
+    cells, loop_cells_time = time_function(find_nonzero_cells_loop, upstream)
+    A, loop_A_time = time_function(build_A_loop, upstream, *cells)
+    vec_cells, cells_time = time_function(reverse_sediment.find_nonzero_cells, upstream)
+    vec_A, A_time = time_function(reverse_sediment.build_A, upstream, *vec_cells)
+    assert(np.array_equal(np.asarray(cells[0]), vec_cells[0]))
+    assert((A != vec_A).nnz == 0)
+    return {'find_nonzero_cells': (loop_cells_time, cells_time),
+            'build_A': (loop_A_time, A_time)}
+
+def measure(function, *args):
+    """Call function with args and return its result, and its wall time, CPU time
+       and peak memory allocated (as traced by tracemalloc, which NumPy reports to).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    result = function(*args)
+    stats = {'time': time.perf_counter() - start,
+             'cpu_time': time.process_time() - start_cpu,
+             'peak_memory': tracemalloc.get_traced_memory()[1]}
+    tracemalloc.stop()
+    return result, stats
+
+def trace_samples(flow_directions, cells):
+    """The find_upstream stage: invert the flow directions and find the upstream cells of the samples.
+    """
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    upstream, starts, stops = find_upstream.find_all_upstream(donor_graph, cells)
+    return upstream_index.from_slices(upstream, starts, stops, flow_directions.shape)
+
+def benchmark_case(shape, density=1e-3, nesting=3, spacing=10, solver_options=None, seed=0):
+    """Time each stage of the processing on a synthetic dendritic dataset (see
+       make_test_dataset.create_dendritic_dataset) of the given shape.
+       The throughput of each stage is the number of items (such as upstream cells or
+       nonzeros of A) that it processes per second.
+    """
+    ny, nx = shape
+    flow_directions = make_test_dataset.make_dendritic_flow_directions(ny, nx, seed)
+    cells = make_test_dataset.make_dendritic_samples(flow_directions, int(round(density * ny * nx)),
+                                                     nesting, spacing, seed=seed)
+    stages = {}
+    def record(stage, stats, items):
+        stats['items'] = int(items)
+        stats['throughput'] = items / max(stats['time'], 1e-9)
+        stages[stage] = stats
+
+    index, stats = measure(trace_samples, flow_directions, cells)
+    record('find_upstream', stats, len(index.cells))
+    upstream = [np.column_stack(np.unravel_index(upstream_index.row_cells(index, i), index.shape))
+                for i in range(upstream_index.num_rows(index))]
+
+    reduced, stats = measure(reverse_sediment.find_nonzero_cells, upstream)
+    record('find_nonzero_cells', stats, len(index.cells))
+    A, stats = measure(reverse_sediment.build_A, upstream, *reduced)
+    record('build_A', stats, A.nnz)
+
+    # Measurements of a known concentration field, so the solver has a consistent system
+    full_coords = reduced[0]
+    x_true = np.random.RandomState(seed).lognormal(size=len(full_coords))
+    (x, offset, _), stats = measure(partial(reverse_sediment.solve, **(solver_options or {})),
+                                    A, A @ x_true, full_coords)
+    record('solve', stats, A.nnz)
+
+    # The same system, multiplying by A without forming it
+    (operator, operator_coords), stats = measure(reverse_sediment.build_operator, index,
+                                                 np.ones(upstream_index.num_rows(index), dtype=bool))
+    record('build_operator', stats, operator.nnz)
+    _, stats = measure(partial(reverse_sediment.solve, **(solver_options or {})), operator, A @ x_true, operator_coords)
+    record('solve_matrix_free', stats, operator.nnz)
+
+    output_dir = tempfile.mkdtemp(prefix='benchmark')
+    try:
+        spatialReference = osr.SpatialReference()
+        spatialReference.ImportFromEPSG(4326)
+        geometry = upstream_index.RasterGeometry(shape, make_test_dataset.GEOTRANSFORM, spatialReference.ExportToWkt())
+        _, stats = measure(reverse_sediment.write_output, x, os.path.join(output_dir, 'output.tif'), geometry, offset)
+        record('write_output', stats, x.size)
+    finally:
+        shutil.rmtree(output_dir)
+
+    return {'shape': [ny, nx], 'samples': len(cells), 'stages': stages}
+
+def compare_levels(shape, levels=4, max_iter=100, density=1e-3, nesting=3, spacing=10, seed=0):
+    """Compare solving on levels grid levels (see reverse_sediment.solve_multigrid) with
+       solving on one level at the same cost, using projected_gradient, on a synthetic
+       dendritic dataset of the given shape. The cost of a solve is the number of
+       nonzeros it multiplies by: each level's iterations times the nonzeros of its A.
+       The single level is given as many iterations as the multigrid solve cost on the
+       full grid. The default solver (lsq_linear, which cannot be used on several
+       levels, and does not record its cost) is also timed. Returns the time, residual
+       and cost of each solve.
+    """
+    ny, nx = shape
+    flow_directions = make_test_dataset.make_dendritic_flow_directions(ny, nx, seed)
+    cells = make_test_dataset.make_dendritic_samples(flow_directions, int(round(density * ny * nx)),
+                                                     nesting, spacing, seed=seed)
+    index = trace_samples(flow_directions, cells)
+    upstream = [np.column_stack(np.unravel_index(upstream_index.row_cells(index, i), index.shape))
+                for i in range(upstream_index.num_rows(index))]
+    reduced = reverse_sediment.find_nonzero_cells(upstream)
+    A = reverse_sediment.build_A(upstream, *reduced)
+    full_coords = reduced[0]
+    b = A @ np.random.RandomState(seed).lognormal(size=len(full_coords))
+
+    solves = {}
+    def record(name, options):
+        result, solve_time = time_function(partial(reverse_sediment.solve_values, **options), A, b, None, full_coords)
+        if result.history and 'level' in result.history[-1]:
+            cost = sum(level['iterations'] * level['nnz'] for level in reverse_sediment.level_summary(result.history))
+        elif options.get('method') == 'projected_gradient':
+            cost = result.history[-1]['iteration'] * A.nnz
+        else:
+            cost = None
+        solves[name] = {'time': solve_time, 'residual': float(np.linalg.norm(A @ result.x - b)),
+                        'cost': None if cost is None else int(cost)}
+
+    record('multigrid', {'method': 'projected_gradient', 'max_iter': max_iter, 'levels': levels})
+    equal_iterations = max(int(np.ceil(solves['multigrid']['cost'] / max(A.nnz, 1))), 1)
+    record('single_level', {'method': 'projected_gradient', 'max_iter': equal_iterations})
+    record('lsq_linear', {})
+    return {'shape': [ny, nx], 'samples': len(cells), 'nnz': int(A.nnz), 'levels': levels,
+            'single_level_iterations': equal_iterations, 'solves': solves}
+
+def run_suite(shapes, density=1e-3, nesting=3, spacing=10, solver_options=None, seed=0):
+    """Run benchmark_case for each shape ('NYxNX'), and return the results with a
+       description of the environment.
+    """
+    cases = {}
+    for shape in shapes:
+        ny, nx = [int(n) for n in shape.split('x')]
+        cases[shape] = benchmark_case((ny, nx), density, nesting, spacing, solver_options, seed)
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'machine': platform.machine(),
+                            'processor': platform.processor()},
+            'parameters': {'density': density, 'nesting': nesting, 'spacing': spacing,
+                           'solver_options': solver_options or {}, 'seed': seed},
+            'cases': cases}
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return a description of each stage whose time or peak memory is more than
+       tolerance (a fraction) above that of the same stage in the baseline results,
+       ignoring increases that are too small to measure reliably (see MIN_INCREASE).
+    """
+    regressions = []
+    for case, result in sorted(results['cases'].items()):
+        for stage, stats in sorted(result['stages'].items()):
+            baseline_stats = baseline['cases'].get(case, {}).get('stages', {}).get(stage)
+            if baseline_stats is None:
+                continue
+            for measurement in ['time', 'peak_memory']:
+                increase = stats[measurement] - baseline_stats[measurement]
+                if increase > tolerance * baseline_stats[measurement] and increase > MIN_INCREASE[measurement]:
+                    regressions.append('{} {}: {} {:.4g} is {:.0%} above baseline {:.4g}'.format(
+                        case, stage, measurement, stats[measurement],
+                        stats[measurement] / max(baseline_stats[measurement], 1e-12) - 1, baseline_stats[measurement]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=1000, help="number of synthetic measurements")
+    parser.add_argument("--catchment_size", type=int, default=100, help="number of cells added to the catchment by each sample")
+    parser.add_argument("--nesting", type=int, default=5, help="number of nested samples along each synthetic river")
+    parser.add_argument("--suite", action="store_true", help="time every stage on synthetic dendritic datasets, instead of comparing build_A with the loops")
+    parser.add_argument("--shapes", type=str, nargs='+', default=SUITE_SHAPES, help="shapes (NYxNX) of the suite's synthetic rasters")
+    parser.add_argument("--density", type=float, default=1e-3, help="number of samples per cell in the suite")
+    parser.add_argument("--spacing", type=int, default=10, help="number of cells between nested samples in the suite")
+    parser.add_argument("--solver", type=str, default='lsq_linear', help="solver used in the suite")
+    parser.add_argument("--max_iter", type=int, help="maximum number of solver iterations in the suite")
+    parser.add_argument("--compare_levels", type=int, help="compare solving on this many grid levels with one level at the same cost, on the suite's shapes")
+    parser.add_argument("--output", type=str, help="path to output JSON file of suite results")
+    parser.add_argument("--baseline", type=str, help="path to JSON file of earlier suite results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="fraction above the baseline that is a regression")
+    args = parser.parse_args()
+    if args.compare_levels:
+        for shape in args.shapes:
+            ny, nx = (int(n) for n in shape.split('x'))
+            comparison = compare_levels((ny, nx), args.compare_levels, args.max_iter or 100, args.density,
+                                        args.nesting, args.spacing)
+            for name, stats in comparison['solves'].items():
+                cost = 'unknown' if stats['cost'] is None else '{:.3g} nonzeros'.format(stats['cost'])
+                print('{} {}: {:.3f}s, residual {:.6g}, cost {}'.format(shape, name, stats['time'], stats['residual'], cost))
+    elif args.suite:
+        results = run_suite(args.shapes, args.density, args.nesting, args.spacing,
+                            {'method': args.solver, 'max_iter': args.max_iter})
+        for case, result in results['cases'].items():
+            for stage, stats in result['stages'].items():
+                print('{} {}: {:.3f}s, {:.3g} items/s, peak memory {:.1f} MB'.format(
+                    case, stage, stats['time'], stats['throughput'], stats['peak_memory'] / 1e6))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+            for regression in regressions:
+                print('REGRESSION ' + regression, file=sys.stderr)
+            sys.exit(1 if regressions else 0)
+    else:
+        upstream = make_nested_upstream(args.samples, args.catchment_size, args.nesting)
+        for stage, (loop_time, vec_time) in benchmark_build_A(upstream).items():
+            print('{}: loop {:.3f}s, vectorized {:.3f}s, speed-up {:.1f}x'.format(stage, loop_time, vec_time, loop_time / vec_time))
@@ -0,0 +1,119 @@
+"""Keep the catchments of sample cells on disk, so that they are only traced once.
+
+The cache is a directory containing one entry for each flow directions raster,
+named by a hash of the raster's contents (so that editing or replacing the raster
+invalidates it). Each entry contains:
+    sample_cells.npy: the sorted linear indices of the cells whose catchments are cached
+    last_used.npy: the time (in seconds since the epoch) that each catchment was last used
+    upstream: an upstream index (see upstream_index) with one row for each sample cell
+Catchments that have not been used for max_age seconds are evicted, as are entries
+for rasters that have not been used for that long.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+from collections import namedtuple
+import numpy as np
+import upstream_index
+
+# Catchments and rasters that have not been used for this many seconds are evicted
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+# Files next to a raster file that also describe it (such as BIL headers)
+SIDECAR_EXTENSIONS = ('.hdr', '.prj')
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evicted'])
+
+def raster_key(flow_directions_files, chunk_size=1 << 20):
+    """Return a hash of the contents of the flow directions files (and their sidecar files).
+    """
+    digest = hashlib.sha256()
+    for path in flow_directions_files:
+        paths = [path] + [os.path.splitext(path)[0] + extension for extension in SIDECAR_EXTENSIONS]
+        for part in paths:
+            if part != path and not os.path.exists(part):
+                continue
+            with open(part, 'rb') as raster_file:
+                for chunk in iter(lambda: raster_file.read(chunk_size), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+def load_entry(entry_path):
+    """Return the sample cells, last used times and upstream index in a cache entry,
+       or None if there is not one.
+    """
+    if not os.path.isdir(entry_path):
+        return None
+    sample_cells = np.load(os.path.join(entry_path, 'sample_cells.npy'))
+    last_used = np.load(os.path.join(entry_path, 'last_used.npy'))
+    index = upstream_index.load(os.path.join(entry_path, 'upstream'))
+    return sample_cells, last_used, index
+
+def save_entry(entry_path, sample_cells, last_used, index, now):
+    """Save a cache entry, replacing the existing one (if any) once the new one is complete.
+       Its modification time is set to now, the time that it was last used.
+    """
+    new_path = entry_path + '.new'
+    if os.path.isdir(new_path):
+        shutil.rmtree(new_path)
+    os.makedirs(new_path)
+    np.save(os.path.join(new_path, 'sample_cells.npy'), sample_cells)
+    np.save(os.path.join(new_path, 'last_used.npy'), last_used)
+    upstream_index.save(os.path.join(new_path, 'upstream'), index)
+    if os.path.isdir(entry_path):
+        shutil.rmtree(entry_path)
+    os.rename(new_path, entry_path)
+    os.utime(entry_path, (now, now))
+
+def evict_rasters(cache_dir, key, max_age, now):
+    """Remove the entries of other rasters that have not been used for max_age seconds.
+    """
+    for name in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, name)
+        if name != key and os.path.isdir(entry_path) and now - os.path.getmtime(entry_path) > max_age:
+            shutil.rmtree(entry_path)
+
+def find_upstream_cached(cache_dir, key, cells, trace, shape, geotransform=None, projection=None,
+                         max_age=DEFAULT_MAX_AGE, now=None):
+    """Return a list of the linear indices of the cells upstream of each of cells,
+       and the CacheStats of the lookup.
+       Only the catchments of cells that are not in the cache are traced, by calling
+       trace with an array of the (unique) cells, which should return a list of their
+       catchments. Negative cells (those outside the raster) have empty catchments.
+       The new catchments are added to the cache entry for key (see raster_key).
+    """
+    if now is None:
+        now = time.time()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    evict_rasters(cache_dir, key, max_age, now)
+    entry_path = os.path.join(cache_dir, key)
+    entry = load_entry(entry_path)
+    if entry is None:
+        entry = (np.zeros(0, dtype=np.int64), np.zeros(0), upstream_index.from_rows([], shape))
+
+    sample_cells, last_used, index = entry
+    cells = np.asarray(cells, dtype=np.int64)
+    wanted = np.unique(cells[cells >= 0])
+    cached = np.isin(wanted, sample_cells)
+    new_cells = wanted[~cached]
+    new_rows = trace(new_cells) if len(new_cells) > 0 else []
+
+    # Keep the cached catchments that are used now or have been used recently
+    used = np.isin(sample_cells, wanted)
+    last_used = np.where(used, now, last_used)
+    keep = used | (now - last_used <= max_age)
+    rows = upstream_index.select_rows(index, keep) + list(new_rows)
+    all_cells = np.concatenate([sample_cells[keep], new_cells])
+    all_last_used = np.concatenate([last_used[keep], np.full(len(new_cells), now)])
+    order = np.argsort(all_cells, kind='stable')
+    index = upstream_index.from_rows([rows[i] for i in order], shape, geotransform, projection)
+    save_entry(entry_path, all_cells[order], all_last_used[order], index, now)
+
+    empty = np.zeros(0, dtype=index.cells.dtype)
+    positions = np.searchsorted(all_cells[order], cells)
+    upstream = [upstream_index.row_cells(index, position) if cell >= 0 else empty
+                for cell, position in zip(cells, positions)]
+    return upstream, CacheStats(int(np.sum(cached)), len(new_cells), int(np.sum(~keep)))
@@ -0,0 +1,126 @@
+"""Multiply by the A matrix without forming it.
+
+Row i of A is 1/n_i for each of the n_i cells upstream of measurement i, and zero
+elsewhere. The upstream cells of two measurements are either nested (one
+measurement is downstream of the other) or separate, so the cells can be ordered
+(see order_cells) such that the upstream cells of every measurement are a
+contiguous range, starts[i]:stops[i], as in a depth-first walk of the flow tree.
+Then A @ x is a difference of prefix sums of x, and A.T @ y is a prefix sum of
+the rows' values added at their starts and subtracted at their stops, so A is
+described by two integers and a scale factor per row, rather than an index and
+a value for every cell upstream of every measurement.
+"""
+
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+import upstream_index
+
+class CatchmentOperator(LinearOperator):
+    """The A matrix, for cells ordered so that row i's cells are starts[i]:stops[i].
+    """
+
+    def __init__(self, starts, stops, num_cells):
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.stops = np.asarray(stops, dtype=np.int32)
+        self.scale = 1.0 / np.maximum(self.stops - self.starts, 1)
+        # The number of nonzero values that A would have
+        self.nnz = int(np.sum(self.stops - self.starts, dtype=np.int64))
+        super(CatchmentOperator, self).__init__(np.float64, (len(self.starts), num_cells))
+
+    def _matvec(self, x):
+        sums = np.zeros(self.shape[1] + 1)
+        np.cumsum(np.ravel(x), out=sums[1:])
+        return (sums[self.stops] - sums[self.starts]) * self.scale
+
+    def _rmatvec(self, y):
+        weights = np.ravel(y) * self.scale
+        num_cells = self.shape[1]
+        changes = (np.bincount(self.starts, weights=weights, minlength=num_cells + 1) -
+                   np.bincount(self.stops, weights=weights, minlength=num_cells + 1))
+        return np.cumsum(changes[:num_cells])
+
+    def select_rows(self, mask):
+        """Return the operator for the rows where mask is True, without the cells
+           that are not upstream of any of them, and the indices of the remaining cells.
+           The remaining cells keep their order, so each row's cells are still contiguous.
+        """
+        starts = self.starts[mask]
+        stops = self.stops[mask]
+        num_cells = self.shape[1]
+        coverage = np.cumsum(np.bincount(starts, minlength=num_cells + 1) -
+                             np.bincount(stops, minlength=num_cells + 1))[:num_cells]
+        used_cells = np.flatnonzero(coverage > 0)
+        positions = np.zeros(num_cells + 1, dtype=np.int64)
+        np.cumsum(coverage > 0, out=positions[1:])
+        return CatchmentOperator(positions[starts], positions[stops], len(used_cells)), used_cells
+
+def order_cells(index, mask):
+    """Order the cells upstream of the rows of index where mask is True so that
+       each row's cells are contiguous.
+       Returns the linear indices of the cells in that order, and the start and stop
+       of each of the rows' cells in it (which are both zero for rows without cells).
+       Each row is assigned to the smallest row containing it (its parent), and is
+       placed after its parent's own cells and the rows before it with the same parent.
+       Only one row's cells, and the owner of each cell in the window of the raster
+       that contains them all, are in memory at once. A ValueError is raised if the rows
+       are not nested or separate, as they are if they were traced on the same flow directions.
+    """
+    rows = np.flatnonzero(mask)
+    lengths = upstream_index.row_lengths(index)[rows]
+    starts = np.zeros(len(rows), dtype=np.int64)
+    stops = np.zeros(len(rows), dtype=np.int64)
+    if np.sum(lengths) == 0:
+        return np.zeros(0, dtype=np.int64), starts, stops
+
+    # The cells are found in the smallest window of the raster that contains them
+    ncols = index.shape[1]
+    nonempty = rows[lengths > 0]
+    bounds = np.zeros([len(nonempty), 4], dtype=np.int64)
+    for i, row in enumerate(nonempty):
+        cells = upstream_index.row_cells(index, row)
+        cols = cells % ncols
+        bounds[i] = cells.min() // ncols, cells.max() // ncols, cols.min(), cols.max()
+    miny, maxy = bounds[:, 0].min(), bounds[:, 1].max()
+    minx, maxx = bounds[:, 2].min(), bounds[:, 3].max()
+    nx = maxx - minx + 1
+
+    # The largest rows are visited first, so that each row's cells all belong
+    # to its parent when it is visited
+    order = np.argsort(-lengths, kind='stable')
+    order = order[lengths[order] > 0]
+    owners = np.full((maxy - miny + 1) * nx, -1, dtype=np.int32)
+    parents = np.full(len(rows), -1, dtype=np.int64)
+    for i in order:
+        cells = upstream_index.row_cells(index, rows[i])
+        window_idxs = (cells // ncols - miny) * nx + (cells % ncols - minx)
+        previous_owners = owners[window_idxs]
+        if np.any(previous_owners != previous_owners[0]):
+            raise ValueError('the upstream cells of row {} overlap those of another row without being '
+                             'nested in them'.format(rows[i]))
+        parents[i] = previous_owners[0]
+        owners[window_idxs] = i
+
+    window_idxs = np.flatnonzero(owners >= 0)
+    cell_owners = owners[window_idxs]
+    num_own = np.bincount(cell_owners, minlength=len(rows))
+    next_starts = np.zeros(len(rows), dtype=np.int64)
+    num_cells = 0
+    for i in order:
+        if parents[i] < 0:
+            starts[i] = num_cells
+            num_cells += lengths[i]
+        else:
+            starts[i] = next_starts[parents[i]]
+            next_starts[parents[i]] += lengths[i]
+        next_starts[i] = starts[i] + num_own[i]
+    stops[order] = starts[order] + lengths[order]
+
+    # Each cell is placed among its owner's own cells
+    by_owner = np.argsort(cell_owners, kind='stable')
+    owner_starts = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(num_own, out=owner_starts[1:])
+    positions = starts[cell_owners[by_owner]] + np.arange(len(by_owner)) - owner_starts[cell_owners[by_owner]]
+    ordered_idxs = np.zeros(len(window_idxs), dtype=np.int64)
+    ordered_idxs[positions] = window_idxs[by_owner]
+    cells = (ordered_idxs // nx + miny) * ncols + ordered_idxs % nx + minx
+    return cells, starts, stops
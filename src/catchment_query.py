@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""Answer questions about catchments from an upstream index, such as which samples
+drain a cell, what is upstream of a point, and what the estimated concentrations are there.
+
+The upstream index (see upstream_index) lists the cells upstream of each sample.
+When a CatchmentQuery is created, the index is also inverted, so that the samples
+downstream of each cell can be looked up. Each query then takes milliseconds.
+The queries can also be made over HTTP (see serve), with GET requests such as:
+    /point?x=-8.5&y=53.2             samples downstream of the cell containing a point
+    /upstream?x=-8.5&y=53.2          cells upstream of a point (needs the flow directions)
+    /bbox?minx=-9&miny=53&maxx=-8&maxy=54
+                                     samples with upstream cells in a bounding box
+    /sample?sample=12                cells upstream of a sample
+Coordinates are in the projection of the flow directions, unless epsg is specified.
+Adding column=Na2O_% to a request that returns cells also returns the estimated
+concentration in them, read from the output GeoTiff of that column.
+The responses are JSON, with cells as [row, col] pairs in the flow directions raster.
+"""
+
+import json
+import argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import gdal
+import osr
+import numpy as np
+import upstream_index
+import measurement_store
+import find_upstream
+from gdal_data import set_gdal_data
+
+class CatchmentQuery(object):
+    """An upstream index, loaded once and inverted, with the optional sample IDs
+       (from measurements_file), output GeoTiffs (results_pattern.format(column=column))
+       and flow directions (needed to find what is upstream of cells that are not samples).
+    """
+
+    def __init__(self, upstream_file, measurements_file=None, results_pattern=None, flow_directions_files=None):
+        self.index = upstream_index.load(upstream_file)
+        self.geometry = upstream_index.geometry(self.index)
+        if self.geometry.geotransform is None:
+            raise ValueError('{} does not record the flow directions geometry'.format(upstream_file))
+        cells = np.asarray(self.index.cells)
+        samples = np.repeat(np.arange(upstream_index.num_rows(self.index)), upstream_index.row_lengths(self.index))
+        order = np.argsort(cells, kind='stable')
+        # The samples downstream of cells[i] are samples[indptr[i]:indptr[i+1]]
+        self.cells, starts = np.unique(cells[order], return_index=True)
+        self.indptr = np.append(starts, len(order))
+        self.samples = samples[order]
+        self.sample_ids = None
+        if measurements_file is not None and 'Sample_ID' in measurement_store.column_names(measurements_file):
+            self.sample_ids = measurement_store.read_columns(measurements_file, ['Sample_ID'])['Sample_ID'].astype(str).tolist()
+        self.results_pattern = results_pattern
+        self.flow = None
+        if flow_directions_files is not None:
+            self.flow = find_upstream.load_flow_directions(flow_directions_files)[0]
+        self.transforms = {}
+        self.results = {}
+
+    def locate(self, x, y, epsg=None):
+        """Return the (row, col) of the cell containing a point, which is in the projection
+           of the flow directions, or of epsg if it is specified.
+        """
+        if epsg is not None:
+            if epsg not in self.transforms:
+                set_gdal_data()
+                sourceSR = osr.SpatialReference()
+                sourceSR.ImportFromEPSG(epsg)
+                targetSR = osr.SpatialReference()
+                targetSR.ImportFromWkt(self.geometry.projection)
+                self.transforms[epsg] = osr.CoordinateTransformation(sourceSR, targetSR)
+            (x, y) = find_upstream.transform_points(self.transforms[epsg], [x], [y])
+        (pixel, line) = find_upstream.world_to_pixel(self.geometry.geotransform, np.atleast_1d(x), np.atleast_1d(y))
+        return int(line[0]), int(pixel[0])
+
+    def inside(self, row, col):
+        """Return True if (row, col) is in the flow directions raster.
+        """
+        return 0 <= row < self.geometry.shape[0] and 0 <= col < self.geometry.shape[1]
+
+    def downstream_samples(self, row, col):
+        """Return the samples whose catchments contain the cell (row, col).
+        """
+        if not self.inside(row, col):
+            return np.zeros(0, dtype=np.int64)
+        i = np.searchsorted(self.cells, row * self.geometry.shape[1] + col)
+        if i == len(self.cells) or self.cells[i] != row * self.geometry.shape[1] + col:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(self.samples[self.indptr[i]:self.indptr[i+1]])
+
+    def bbox_samples(self, min_row, min_col, max_row, max_col):
+        """Return the samples with catchment cells in the rows and columns min to max (inclusive),
+           and the number of such cells.
+        """
+        ny, nx = self.geometry.shape
+        min_row, min_col = max(min_row, 0), max(min_col, 0)
+        max_row, max_col = min(max_row, ny - 1), min(max_col, nx - 1)
+        if min_row > max_row or min_col > max_col:
+            return np.zeros(0, dtype=np.int64), 0
+        rows = np.arange(min_row, max_row + 1)
+        starts = np.searchsorted(self.cells, rows * nx + min_col)
+        stops = np.searchsorted(self.cells, rows * nx + max_col, side='right')
+        idxs, _ = find_upstream.gather_ranges(starts, stops - starts)
+        sample_idxs, _ = find_upstream.gather_ranges(self.indptr[idxs], self.indptr[idxs + 1] - self.indptr[idxs])
+        return np.unique(self.samples[sample_idxs]), len(idxs)
+
+    def sample_cells(self, sample):
+        """Return the linear indices of the cells upstream of a sample.
+        """
+        if not 0 <= sample < upstream_index.num_rows(self.index):
+            raise ValueError('sample should be between 0 and {}'.format(upstream_index.num_rows(self.index) - 1))
+        return np.asarray(upstream_index.row_cells(self.index, sample))
+
+    def upstream_cells(self, row, col):
+        """Return the linear indices of the cells upstream of (and including) the cell (row, col).
+        """
+        if self.flow is None:
+            raise ValueError('the flow directions are needed to find the cells upstream of a point')
+        if not self.inside(row, col):
+            return np.zeros(0, dtype=np.int64)
+        return find_upstream.trace_upstream(self.flow, row * self.geometry.shape[1] + col)
+
+    def values(self, column, cells):
+        """Return the estimated concentration of column in cells, read from its output GeoTiff.
+           Only the window containing the cells is read.
+        """
+        if self.results_pattern is None:
+            raise ValueError('the output files are needed to return concentrations')
+        if column not in self.results:
+            self.results[column] = gdal.Open(self.results_pattern.format(column=column))
+            if self.results[column] is None:
+                del self.results[column]
+                raise ValueError('there is no output for {}'.format(column))
+        if len(cells) == 0:
+            return np.zeros(0)
+        rows, cols = np.unravel_index(cells, self.geometry.shape)
+        window = self.results[column].GetRasterBand(1).ReadAsArray(
+            int(cols.min()), int(rows.min()), int(cols.max() - cols.min() + 1), int(rows.max() - rows.min() + 1))
+        return window[rows - rows.min(), cols - cols.min()].astype(float)
+
+    def describe_samples(self, samples):
+        """Return a list describing each sample, with its ID if the measurements were given.
+        """
+        lengths = upstream_index.row_lengths(self.index)
+        descriptions = []
+        for sample in samples:
+            description = {'sample': int(sample), 'num_cells': int(lengths[sample])}
+            if self.sample_ids is not None:
+                description['sample_id'] = self.sample_ids[sample]
+            descriptions.append(description)
+        return descriptions
+
+    def describe_cells(self, cells, column=None):
+        """Return a dictionary of the [row, col] pairs of cells, and their concentration of column.
+        """
+        rows, cols = np.unravel_index(np.asarray(cells, dtype=np.int64), self.geometry.shape)
+        description = {'num_cells': len(cells), 'cells': np.column_stack([rows, cols]).tolist()}
+        if column is not None:
+            description['column'] = column
+            description['values'] = [None if np.isnan(value) else float(value) for value in self.values(column, cells)]
+        return description
+
+    def point(self, x, y, epsg=None, column=None):
+        """Return the cell containing a point, the samples downstream of it, and its concentration of column.
+        """
+        row, col = self.locate(x, y, epsg)
+        answer = {'cell': [row, col], 'inside': self.inside(row, col),
+                  'samples': self.describe_samples(self.downstream_samples(row, col))}
+        if column is not None and answer['inside']:
+            answer.update(self.describe_cells([row * self.geometry.shape[1] + col], column))
+        return answer
+
+    def upstream(self, x, y, epsg=None, column=None):
+        """Return the cell containing a point and the cells upstream of it.
+        """
+        row, col = self.locate(x, y, epsg)
+        return dict({'cell': [row, col], 'inside': self.inside(row, col)},
+                    **self.describe_cells(self.upstream_cells(row, col), column))
+
+    def bbox(self, minx, miny, maxx, maxy, epsg=None):
+        """Return the samples with upstream cells in a bounding box.
+        """
+        corners = [self.locate(x, y, epsg) for x, y in [(minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy)]]
+        rows, cols = zip(*corners)
+        samples, num_cells = self.bbox_samples(min(rows), min(cols), max(rows), max(cols))
+        return {'rows': [min(rows), max(rows)], 'cols': [min(cols), max(cols)], 'num_cells': num_cells,
+                'samples': self.describe_samples(samples)}
+
+    def sample(self, sample, column=None):
+        """Return the cells upstream of a sample.
+        """
+        cells = self.sample_cells(sample)
+        return dict(self.describe_samples([sample])[0], **self.describe_cells(cells, column))
+
+# The requests that can be answered
+REQUESTS = ('/point', '/upstream', '/bbox', '/sample')
+
+def answer(query, path, params):
+    """Answer a request for path (one of REQUESTS) with the query parameters params.
+       Raises KeyError for missing parameters, and ValueError for invalid ones.
+    """
+    epsg = int(params['epsg']) if 'epsg' in params else None
+    column = params.get('column')
+    if path == '/point':
+        return query.point(float(params['x']), float(params['y']), epsg, column)
+    if path == '/upstream':
+        return query.upstream(float(params['x']), float(params['y']), epsg, column)
+    if path == '/bbox':
+        return query.bbox(float(params['minx']), float(params['miny']), float(params['maxx']), float(params['maxy']), epsg)
+    if path == '/sample':
+        return query.sample(int(params['sample']), column)
+    raise ValueError('unknown request {}, should be one of {}'.format(path, ', '.join(REQUESTS)))
+
+def make_handler(query):
+    """Return a request handler class that answers GET requests using query.
+    """
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            status = 200
+            try:
+                response = answer(query, url.path, params)
+            except KeyError as error:
+                status, response = 400, {'error': 'missing parameter {}'.format(error.args[0])}
+            except ValueError as error:
+                status, response = 404 if url.path not in REQUESTS else 400, {'error': str(error)}
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return QueryHandler
+
+def serve(query, host='127.0.0.1', port=8000):
+    """Answer queries over HTTP until interrupted.
+    """
+    server = HTTPServer((host, port), make_handler(query))
+    print('serving catchment queries on http://{}:{}'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--upstream", type=str, help="path to upstream index directory", required=True)
+    parser.add_argument("--measurements", type=str, help="path to measurements csv file or measurement store directory, to report sample IDs")
+    parser.add_argument("--results", type=str, help="path to output files, containing {column}, to report concentrations")
+    parser.add_argument("--flow_directions", type=str, nargs='+', help="path to flow directions file, or paths to BIL flow directions tiles, to find the cells upstream of any point")
+    parser.add_argument("--port", type=int, help="answer queries over HTTP on this port")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="address to answer HTTP queries on")
+    parser.add_argument("--query", type=str, help="answer one query, such as '/point?x=-8.5&y=53.2', and print the result")
+    args = parser.parse_args()
+    if (args.port is None) == (args.query is None):
+        parser.error('exactly one of --port and --query must be specified')
+    query = CatchmentQuery(args.upstream, args.measurements, args.results, args.flow_directions)
+    if args.port is not None:
+        serve(query, args.host, args.port)
+    else:
+        url = urlparse(args.query)
+        print(json.dumps(answer(query, url.path, {key: values[0] for key, values in parse_qs(url.query).items()}), indent=1))
@@ -2,21 +2,24 @@
 """Find the upstream cells for each row in the input CSV.
 """
 
-import sys
 import os
+import sys
+import shutil
+import tempfile
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import gdal
 import gdalnumeric
 import osr
-import pandas as pd
 import numpy as np
-
-# 10000 is an arbitrary number and may need to be increased
-sys.setrecursionlimit(10000)
-
-# Necessary for my version of GDAL to avoid errors such as
-# ERROR 4: Unable to open EPSG support file gcs.csv
-os.environ['GDAL_DATA'] = os.popen('gdal-config --datadir').read().rstrip()
+import upstream_index
+import flow_raster
+import catchment_cache
+import measurement_store
+from gdal_data import set_gdal_data
+from metrics import Metrics, profile
 
 # The coordinates of the neighbour to which flow is directed
 # e.g. if the flow direction value is 1, dx=1, dy=0, so flow is
@@ -25,80 +28,489 @@ os.environ['GDAL_DATA'] = os.popen('gdal-config --datadir').read().rstrip()
 dx = [0, 1, 1, 0, -1, -1, -1, 0, 1]
 dy = [0, 0, 1, 1, 1, 0, -1, -1, -1]
 
-def find_upstream(flow_directions, row, col):
-    """Recursively find the coordinate pairs of upstream points
+# 32 64 128
+# 16 0  1
+# 8  4  2
+# Index into dx and dy for every possible flow direction value.
+# A value v is treated as direction int(log2(v))+1 (i.e. its bit
+# length), so 1 -> 1 (east), 2 -> 2 (south east), ..., 128 -> 8 (north
+# east), and 0 -> 0 (no flow). Looking this up once per raster replaces
+# calling np.log2 for every neighbour of every visited cell.
+DIRECTION_INDEX = np.array([int(v).bit_length() for v in range(256)], dtype=np.uint8)
+
+# The inverted flow directions: the cells that flow into cell i are
+# donors[indptr[i]:indptr[i+1]], where cells are identified by their
+# linear (row-major) index in a raster of the given shape. Both arrays are
+# 32 bit (see index_dtype) unless the raster has 2^31 cells or more
+DonorGraph = namedtuple('DonorGraph', ['indptr', 'donors', 'shape'])
+
+def index_dtype(num_cells):
+    """Smallest integer type that can hold a linear index into num_cells cells.
+    """
+    if num_cells < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def direction_index(flow_directions):
+    """Convert flow direction values into indices into dx and dy.
     """
-    # 32 64 128
-    # 16 0  1
-    # 8  4  2
-    upstream = [(row, col)]
+    flow_directions = np.asarray(flow_directions)
+    valid = (flow_directions > 0) & (flow_directions < 256)
+    return np.where(valid, DIRECTION_INDEX[np.where(valid, flow_directions, 0).astype(np.uint8)], 0)
+
+def build_donor_graph(flow_directions):
+    """Invert the flow directions so that the upstream neighbours of each cell can
+       be found without examining its neighbours.
+    """
+    ny, nx = np.shape(flow_directions)
+    dtype = index_dtype(ny * nx)
+    k = direction_index(flow_directions).ravel()
+    donors = np.flatnonzero(k).astype(dtype)
+    k = k[donors]
+    rows = donors // nx + np.take(dy, k)
+    cols = donors % nx + np.take(dx, k)
+    inside = (0 <= rows) & (rows < ny) & (0 <= cols) & (cols < nx)
+    donors = donors[inside]
+    receivers = rows[inside] * nx + cols[inside]
+    order = np.argsort(receivers, kind='stable')
+    indptr = np.zeros(ny * nx + 1, dtype=index_dtype(ny * nx + 1))
+    np.cumsum(np.bincount(receivers, minlength=ny * nx), out=indptr[1:])
+    return DonorGraph(indptr, donors[order], (ny, nx))
+
+def gather_ranges(starts, counts):
+    """Concatenate the index ranges [starts[i], starts[i]+counts[i]).
+       Also return, for each index, the range (i) that it came from.
+    """
+    ranges = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(ranges)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.asarray(starts)[ranges] + offsets, ranges
+
+# The neighbour (k) that is flowing into a cell if it flows in direction OPPOSITE[k]
+OPPOSITE = [0, 5, 6, 7, 8, 1, 2, 3, 4]
+
+def flow_shape(flow):
+    """Return the shape of the raster that flow (see find_donors) describes.
+    """
+    return tuple(flow.shape)
+
+def find_donors(flow, cells):
+    """Find the cells that flow directly into any of the given cells.
+       Also return, for each donor, the position in cells of the cell it flows into.
+       flow is either a DonorGraph, or flow directions that support NumPy's take
+       (such as an array or a flow_raster.TileMosaic), in which case the direction of
+       each of the cells' neighbours is read to find the donors.
+    """
+    if isinstance(flow, DonorGraph):
+        starts = flow.indptr[cells]
+        counts = flow.indptr[cells + 1] - starts
+        idxs, parents = gather_ranges(starts, counts)
+        return flow.donors[idxs], parents
+    ny, nx = flow_shape(flow)
+    rows = cells // nx
+    cols = cells % nx
+    donors = []
+    parents = []
     for k in range(1, 9):
-        if (0 <= row+dy[k] < flow_directions.shape[0]) and (0 <= col+dx[k] < flow_directions.shape[1]):
-            nv = flow_directions[row+dy[k], col+dx[k]]
-            if nv == 0:
-                ni = 0
-            else:
-                ni = int(np.log2(nv))+1
-            if (dx[ni] == -dx[k]) & (dy[ni] == -dy[k]):
-                upstream = upstream + find_upstream(flow_directions, row+dy[k], col+dx[k])
-    return upstream
+        inside = np.flatnonzero((0 <= rows + dy[k]) & (rows + dy[k] < ny) & (0 <= cols + dx[k]) & (cols + dx[k] < nx))
+        neighbours = cells[inside] + dy[k] * nx + dx[k]
+        flows_in = direction_index(flow.take(neighbours)) == OPPOSITE[k]
+        donors.append(neighbours[flows_in])
+        parents.append(inside[flows_in])
+    return np.concatenate(donors).astype(cells.dtype), np.concatenate(parents)
+
+def trace_upstream(flow, cell):
+    """Find the linear indices of the cells upstream of (and including) a cell.
+       The flow is walked breadth first, one level of the queue at a time,
+       so the work is proportional to the number of upstream cells.
+    """
+    num_cells = np.prod(flow_shape(flow))
+    frontier = np.array([cell], dtype=index_dtype(num_cells))
+    upstream = []
+    num_upstream = 0
+    while len(frontier) > 0:
+        upstream.append(frontier)
+        num_upstream += len(frontier)
+        if num_upstream > num_cells:
+            raise ValueError('flow directions contain a cycle upstream of cell {}'.format(cell))
+        frontier, _ = find_donors(flow, frontier)
+    return np.concatenate(upstream)
+
+def label_catchments(flow, sample_cells):
+    """Assign every cell upstream of the (unique) sample cells to the nearest
+       sample downstream of it, in a single sweep up the flow (see find_donors)
+       from all of the samples at once.
+       Returns the labelled cells, ordered by increasing distance from their sample,
+       their labels (the position of their sample in sample_cells), and the label
+       of the nearest sample downstream of each sample (-1 if there is none).
+    """
+    num_cells = np.prod(flow_shape(flow))
+    sample_cells = np.asarray(sample_cells, dtype=index_dtype(num_cells))
+    order = np.argsort(sample_cells)
+    sorted_sample_cells = sample_cells[order]
+    parents = -1 * np.ones(len(sample_cells), dtype=np.int64)
+    if len(sample_cells) == 0:
+        return sample_cells, np.zeros(0, dtype=np.int64), parents
+
+    frontier = sample_cells
+    frontier_labels = np.arange(len(sample_cells))
+    cells = []
+    labels = []
+    num_labelled = 0
+    while len(frontier) > 0:
+        cells.append(frontier)
+        labels.append(frontier_labels)
+        num_labelled += len(frontier)
+        if num_labelled > num_cells:
+            raise ValueError('flow directions contain a cycle upstream of the samples')
+        donors, donor_parents = find_donors(flow, frontier)
+        donor_labels = frontier_labels[donor_parents]
+        # Donors that are themselves samples start their own catchment
+        pos = np.minimum(np.searchsorted(sorted_sample_cells, donors), len(sample_cells) - 1)
+        is_sample = sorted_sample_cells[pos] == donors
+        parents[order[pos[is_sample]]] = donor_labels[is_sample]
+        frontier = donors[~is_sample]
+        frontier_labels = donor_labels[~is_sample]
+    return np.concatenate(cells), np.concatenate(labels), parents
+
+def sample_preorder(parents):
+    """Order the samples so that every sample is followed by the samples upstream of it.
+       Also return the number of samples upstream of, and including, each sample.
+    """
+    num_samples = len(parents)
+    children = np.argsort(parents, kind='stable')
+    children_ptr = np.searchsorted(parents[children], np.arange(-1, num_samples + 1))
+    preorder = []
+    stack = list(children[children_ptr[0]:children_ptr[1]][::-1])
+    while stack:
+        sample = stack.pop()
+        preorder.append(sample)
+        stack.extend(children[children_ptr[sample + 1]:children_ptr[sample + 2]][::-1])
+    preorder = np.array(preorder, dtype=np.int64)
+    subtree_sizes = np.ones(num_samples, dtype=np.int64)
+    for sample in preorder[::-1]:
+        if parents[sample] >= 0:
+            subtree_sizes[parents[sample]] += subtree_sizes[sample]
+    return preorder, subtree_sizes
+
+def find_all_upstream(flow, cells):
+    """Find the upstream cells of all of the given cells in one pass.
+       Each cell upstream of the samples is visited once, however deeply the samples
+       are nested. The upstream cells of cell i are upstream[starts[i]:stops[i]],
+       consisting of the cells that drain to it without passing another sample,
+       followed by the upstream cells of the samples that drain to it.
+       If there are no cells, the upstream cells, starts and stops are all empty.
+    """
+    if len(cells) == 0:
+        return (np.zeros(0, dtype=index_dtype(np.prod(flow_shape(flow)))),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    sample_cells, inverse = np.unique(np.asarray(cells), return_inverse=True)
+    labelled, labels, parents = label_catchments(flow, sample_cells)
+
+    # group the labelled cells into the increment of each sample
+    labelled = labelled[np.argsort(labels, kind='stable')]
+    increment_sizes = np.bincount(labels, minlength=len(sample_cells))
+    increment_starts = np.cumsum(increment_sizes) - increment_sizes
+
+    # order the increments so that the upstream cells of each sample are contiguous
+    preorder, subtree_sizes = sample_preorder(parents)
+    idxs, _ = gather_ranges(increment_starts[preorder], increment_sizes[preorder])
+    upstream = labelled[idxs]
+    offsets = np.zeros(len(sample_cells) + 1, dtype=np.int64)
+    np.cumsum(increment_sizes[preorder], out=offsets[1:])
+    ranks = np.empty(len(sample_cells), dtype=np.int64)
+    ranks[preorder] = np.arange(len(sample_cells))
+    starts = offsets[ranks]
+    stops = offsets[ranks + subtree_sizes]
+    return upstream, starts[inverse], stops[inverse]
+
+def find_upstream(flow, row, col):
+    """Find the coordinate pairs of upstream points.
+       flow may be the flow directions array, a DonorGraph built from it (which
+       should be used when tracing many points), or a flow_raster.TileMosaic.
+    """
+    shape = flow_shape(flow)
+    rows, cols = np.unravel_index(trace_upstream(flow, row * shape[1] + col), shape)
+    return list(zip(rows.tolist(), cols.tolist()))
 
 def world2Pixel(geoMatrix, x, y):
     """Uses a gdal geomatrix (gdal.GetGeoTransform()) to calculate
     the pixel location of a geospatial coordinate
     """
+    (pixel, line) = world_to_pixel(geoMatrix, np.array([x]), np.array([y]))
+    return (int(pixel[0]), int(line[0]))
+
+def world_to_pixel(geoMatrix, x, y):
+    """Calculate the pixel and line of arrays of geospatial coordinates,
+    by inverting the affine transformation described by a gdal geomatrix
+    """
     ulX = geoMatrix[0]
     ulY = geoMatrix[3]
     xDist = geoMatrix[1]
     yDist = geoMatrix[5]
     rtnX = geoMatrix[2]
     rtnY = geoMatrix[4]
-    pixel = int((x - ulX) / xDist)
-    line = int((ulY - y) / xDist)
+    det = xDist * yDist - rtnX * rtnY
+    x = np.asarray(x, dtype=float) - ulX
+    y = np.asarray(y, dtype=float) - ulY
+    pixel = np.floor((yDist * x - rtnX * y) / det)
+    line = np.floor((xDist * y - rtnY * x) / det)
     return (pixel, line)
 
-def process_row(row, flow_directions, coordTrans, geoTrans):
-    """Find the upstream points for one row of the input CSV
+def transform_points(coordTrans, x, y):
+    """Transform arrays of coordinates with one call to the coordinate transformation
     """
-    sourceCoords = row[['Easting', 'Northing']]
-    targetCoords = coordTrans.TransformPoint(float(sourceCoords[0]), float(sourceCoords[1]))
-    (col, row) = world2Pixel(geoTrans, targetCoords[0], targetCoords[1])
-    upstream = find_upstream(flow_directions, row, col)
-    return upstream
+    if len(x) == 0:
+        return (np.zeros(0), np.zeros(0))
+    points = np.array(coordTrans.TransformPoints(list(zip(np.asarray(x, dtype=float).tolist(),
+                                                          np.asarray(y, dtype=float).tolist()))),
+                      dtype=float).reshape(len(x), -1)
+    return (points[:, 0], points[:, 1])
+
+def locate_cells(input_df, shape, coordTrans, geoTrans):
+    """Find the linear index of the raster cell containing each row of the input CSV.
+       Also return a mask that is False for rows whose point is not in the raster
+       (these have a cell index of -1).
+    """
+    (x, y) = transform_points(coordTrans, input_df['Easting'].values, input_df['Northing'].values)
+    (pixel, line) = world_to_pixel(geoTrans, x, y)
+    inside = (0 <= line) & (line < shape[0]) & (0 <= pixel) & (pixel < shape[1])
+    cells = -1 * np.ones(len(input_df), dtype=np.int64)
+    cells[inside] = line[inside].astype(np.int64) * shape[1] + pixel[inside].astype(np.int64)
+    return cells, inside
+
+def load_flow_directions(flow_directions_files):
+    """Open the flow directions, which are either a raster file that GDAL can read, which
+       is loaded into memory, or one or more BIL tiles, which are read on demand.
+       Also return the geotransform and projection of the flow directions.
+    """
+    set_gdal_data()
+    if all(flow_raster.is_bil(path) for path in flow_directions_files):
+        mosaic = flow_raster.TileMosaic(flow_directions_files)
+        projection = mosaic.projection
+        if projection is None:
+            # HydroSHEDS uses WGS84 geographic coordinates
+            spatialReference = osr.SpatialReference()
+            spatialReference.ImportFromEPSG(4326)
+            projection = spatialReference.ExportToWkt()
+        return (mosaic, mosaic.geotransform, projection)
+    if len(flow_directions_files) != 1:
+        raise ValueError('multiple flow directions files must all be BIL tiles')
+    raster = gdal.Open(flow_directions_files[0])
+    flow_directions = gdalnumeric.LoadFile(flow_directions_files[0])
+    return (flow_directions, raster.GetGeoTransform(), raster.GetProjectionRef())
 
-def load_inputs(input_csv, csv_epsg, flow_directions_file):
+def load_inputs(input_csv, csv_epsg, flow_directions_files):
     """Load input files and reproject CSV to same projection and flow directions
     """
-    raster = gdal.Open(flow_directions_file)
-    flow_directions = gdalnumeric.LoadFile(flow_directions_file)
-    input_df = pd.read_csv(input_csv)
+    if isinstance(flow_directions_files, str):
+        flow_directions_files = [flow_directions_files]
+    (flow_directions, geoTrans, projection) = load_flow_directions(flow_directions_files)
+    input_df = measurement_store.read_columns(input_csv, ['Easting', 'Northing'])
 
     # Reproject vector geometry to same projection as raster
     sourceSR = osr.SpatialReference()
     sourceSR.ImportFromEPSG(csv_epsg)
     targetSR = osr.SpatialReference()
-    targetSR.ImportFromWkt(raster.GetProjectionRef())
+    targetSR.ImportFromWkt(projection)
     coordTrans = osr.CoordinateTransformation(sourceSR, targetSR)
-    geoTrans = raster.GetGeoTransform()
 
-    return (input_df, flow_directions, coordTrans, geoTrans)
+    return (input_df, flow_directions, coordTrans, geoTrans, projection)
+
+def trace_catchments(flow, cells, single_pass=False):
+    """Return a list of the linear indices of the cells upstream of each of the (unique) cells.
+       If single_pass is True, they are found together, rather than tracing each cell separately.
+    """
+    if single_pass:
+        upstream, starts, stops = find_all_upstream(flow, cells)
+        return [upstream[start:stop] for start, stop in zip(starts, stops)]
+    return [trace_upstream(flow, cell) for cell in cells]
+
+def find_outlets(flow_directions, cells):
+    """Follow the flow downstream from each of the cells to the cell where it stops,
+       or leaves the raster. Cells with the same outlet are in the same basin.
+       flow_directions is an array or anything else that supports take (see find_donors).
+    """
+    ny, nx = flow_shape(flow_directions)
+    outlets = np.array(cells, dtype=np.int64)
+    active = np.arange(len(outlets))
+    num_steps = 0
+    while len(active) > 0:
+        k = direction_index(flow_directions.take(outlets[active]))
+        rows = outlets[active] // nx + np.take(dy, k)
+        cols = outlets[active] % nx + np.take(dx, k)
+        moving = (k > 0) & (0 <= rows) & (rows < ny) & (0 <= cols) & (cols < nx)
+        active = active[moving]
+        outlets[active] = rows[moving] * nx + cols[moving]
+        num_steps += 1
+        if num_steps > ny * nx:
+            raise ValueError('flow directions contain a cycle downstream of the samples')
+    return outlets
+
+def basin_batches(outlets, num_batches):
+    """Split the indices of the cells with the given outlets into about num_batches batches
+       of similar size. Cells in the same basin are kept together where possible, so that
+       catchments that overlap are traced together, but basins that are larger than a
+       batch are split.
+    """
+    order = np.argsort(outlets, kind='stable')
+    batch_size = len(outlets) / max(num_batches, 1)
+    boundaries = np.flatnonzero(np.diff(outlets[order])) + 1
+    splits = []
+    for target in np.arange(1, num_batches) * batch_size:
+        split = int(round(target))
+        if len(boundaries) > 0:
+            nearest = boundaries[np.argmin(np.abs(boundaries - target))]
+            if abs(nearest - target) <= batch_size / 2:
+                split = int(nearest)
+        splits.append(split)
+    return [batch for batch in np.split(order, np.unique(splits)) if len(batch) > 0]
+
+def save_donor_graph(path, donor_graph):
+    """Save a donor graph to the directory path, so that it can be memory-mapped.
+    """
+    np.save(os.path.join(path, 'indptr.npy'), donor_graph.indptr)
+    np.save(os.path.join(path, 'donors.npy'), donor_graph.donors)
+    np.save(os.path.join(path, 'shape.npy'), np.array(donor_graph.shape))
 
-def run(output_file, input_csv, csv_epsg, flow_directions_file):
+def load_donor_graph(path, mmap_mode='r'):
+    """Load a donor graph saved by save_donor_graph. The arrays are memory-mapped unless mmap_mode is None.
+    """
+    return DonorGraph(np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode),
+                      np.load(os.path.join(path, 'donors.npy'), mmap_mode=mmap_mode),
+                      tuple(np.load(os.path.join(path, 'shape.npy')).tolist()))
+
+# The flow that is traced in each worker process, opened by init_worker
+worker_flow = None
+
+def init_worker(flow_source):
+    """Open the flow in a worker process. flow_source is either a list of BIL files
+       or the directory containing a donor graph saved by save_donor_graph.
+    """
+    global worker_flow
+    if isinstance(flow_source, list):
+        worker_flow = flow_raster.TileMosaic(flow_source)
+    else:
+        worker_flow = load_donor_graph(flow_source)
+
+def trace_batch(cells, single_pass=False):
+    """Trace a batch of cells in a worker process.
+    """
+    return trace_catchments(worker_flow, cells, single_pass)
+
+def trace_catchments_parallel(flow_directions, flow, cells, single_pass=False, workers=2, batches_per_worker=4):
+    """Like trace_catchments, but split the cells into batches (by basin, see basin_batches)
+       that are traced by workers processes.
+       The workers do not receive copies of the flow: a donor graph is saved to a temporary
+       directory that each worker memory-maps, so they share the operating system's copy
+       of it, while BIL tiles are memory-mapped by each worker directly.
+    """
+    cells = np.asarray(cells)
+    batches = basin_batches(find_outlets(flow_directions, cells), workers * batches_per_worker)
+    temp_dir = None
+    if isinstance(flow, DonorGraph):
+        temp_dir = tempfile.mkdtemp(prefix='donor_graph')
+        save_donor_graph(temp_dir, flow)
+        flow_source = temp_dir
+    else:
+        flow_source = flow.files
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(flow_source,)) as executor:
+            results = list(executor.map(partial(trace_batch, single_pass=single_pass), [cells[batch] for batch in batches]))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    upstream = [None] * len(cells)
+    for batch, rows in zip(batches, results):
+        for i, row in zip(batch, rows):
+            upstream[i] = row
+    return upstream
+
+def run(output_file, input_csv, csv_epsg, flow_directions_files, single_pass=False, cache_dir=None,
+        cache_max_age=catchment_cache.DEFAULT_MAX_AGE, workers=1, metrics_file=None):
     """Main driver function.
+       If single_pass is True, the upstream cells of all rows are found together,
+       rather than tracing each row separately.
+       Flow directions that are in memory are inverted into a donor graph first,
+       while those read on demand from BIL tiles are used directly, so that only
+       the parts of the tiles covered by the catchments are read.
+       If cache_dir is specified, catchments are stored there, and only the
+       catchments of cells that are not already in it are traced.
+       If workers is more than 1, the catchments are traced by that many processes.
+       If metrics_file is specified, the time and memory used by each stage are written to it.
+       Returns the upstream index that was written to output_file.
     """
+    metrics = Metrics()
 
-    (input_df, flow_directions, coordTrans, geoTrans) = load_inputs(input_csv, csv_epsg, flow_directions_file)
+    if isinstance(flow_directions_files, str):
+        flow_directions_files = [flow_directions_files]
+    with metrics.stage('load'):
+        (input_df, flow_directions, coordTrans, geoTrans, projection) = load_inputs(input_csv, csv_epsg, flow_directions_files)
 
-    upstream = []
-    for _, row in input_df.iterrows():
-        upstream.append(process_row(row, flow_directions, coordTrans, geoTrans))
-    np.save(output_file, upstream)
+    with metrics.stage('transform'):
+        flow = flow_directions
+        if isinstance(flow_directions, np.ndarray):
+            flow = build_donor_graph(flow_directions)
+        shape = flow_shape(flow)
+        cells, inside = locate_cells(input_df, shape, coordTrans, geoTrans)
+    if not np.all(inside):
+        print('{} of {} points are outside the flow directions raster and have no upstream cells'.format(
+            np.sum(~inside), len(inside)), file=sys.stderr)
+
+    trace = partial(trace_catchments, flow, single_pass=single_pass)
+    if workers > 1:
+        trace = partial(trace_catchments_parallel, flow_directions, flow, single_pass=single_pass, workers=workers)
+
+    with metrics.stage('trace'):
+        if cache_dir is not None:
+            key = catchment_cache.raster_key(flow_directions_files)
+            upstream, stats = catchment_cache.find_upstream_cached(cache_dir, key, cells, trace, shape,
+                                                                   geoTrans, projection, cache_max_age)
+            print('catchment cache: {} hits, {} misses, {} evicted'.format(stats.hits, stats.misses, stats.evicted),
+                  file=sys.stderr)
+            metrics.count(cache_hits=stats.hits, cache_misses=stats.misses, cache_evicted=stats.evicted)
+            index = upstream_index.from_rows(upstream, shape, geoTrans, projection)
+        elif workers > 1:
+            unique_cells, unique_idxs = np.unique(cells[inside], return_inverse=True)
+            rows = trace(unique_cells)
+            upstream = [np.zeros(0, dtype=index_dtype(np.prod(shape)))] * len(cells)
+            for i, unique_idx in zip(np.flatnonzero(inside), unique_idxs):
+                upstream[i] = rows[unique_idx]
+            index = upstream_index.from_rows(upstream, shape, geoTrans, projection)
+        elif single_pass:
+            upstream, starts, stops = find_all_upstream(flow, cells[inside])
+            all_starts = np.zeros(len(cells), dtype=np.int64)
+            all_stops = np.zeros(len(cells), dtype=np.int64)
+            all_starts[inside] = starts
+            all_stops[inside] = stops
+            index = upstream_index.from_slices(upstream, all_starts, all_stops, shape, geoTrans, projection)
+        else:
+            upstream = [trace_upstream(flow, cell) if cell >= 0 else np.zeros(0, dtype=index_dtype(np.prod(shape)))
+                        for cell in cells]
+            index = upstream_index.from_rows(upstream, shape, geoTrans, projection)
+
+    with metrics.stage('write'):
+        upstream_index.save(output_file, index)
+
+    metrics.count(samples=len(cells), samples_outside=int(np.sum(~inside)), raster_cells=int(np.prod(shape)),
+                  catchment_cells=len(index.cells))
+    if isinstance(flow, flow_raster.TileMosaic):
+        metrics.count(blocks_read=flow.misses, block_cache_hits=flow.hits)
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+    return index
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--output", type=str, help="path to output upstream npy file", required=True)
-    parser.add_argument("--measurements", type=str, help="path to measurements csv file", required=True)
+    parser.add_argument("--output", type=str, help="path to output upstream index directory", required=True)
+    parser.add_argument("--measurements", type=str, help="path to measurements csv file or measurement store directory", required=True)
     parser.add_argument("--measurements_epsg", type=int, help="EPSG of measurements csv file spatial reference", required=True)
-    parser.add_argument("--flow_directions", type=str, help="path to flow directions file", required=True)
+    parser.add_argument("--flow_directions", type=str, nargs='+', help="path to flow directions file, or paths to BIL flow directions tiles", required=True)
+    parser.add_argument("--single_pass", action="store_true", help="find the upstream cells of all rows in one pass over the flow directions")
+    parser.add_argument("--cache", type=str, help="path to catchment cache directory, to only trace samples in cells that have not been traced before")
+    parser.add_argument("--cache_max_age", type=float, default=catchment_cache.DEFAULT_MAX_AGE / 86400, help="days after which unused catchments are removed from the cache")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to trace catchments with")
+    parser.add_argument("--metrics_json", type=str, help="path to output JSON file of the time and memory used by each stage")
+    parser.add_argument("--profile", type=str, help="path to output cProfile statistics file")
     args = parser.parse_args()
-    run(args.output, args.measurements, args.measurements_epsg, args.flow_directions)
+    profile(args.profile, run, args.output, args.measurements, args.measurements_epsg, args.flow_directions,
+            args.single_pass, args.cache, args.cache_max_age * 86400, args.workers, args.metrics_json)
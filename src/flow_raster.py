@@ -0,0 +1,134 @@
+"""Read flow directions from raw BIL tiles (such as those of HydroSHEDS) on demand.
+
+The tiles are treated as one mosaic, without merging them into a single file
+or loading them into memory. Each tile is memory-mapped, and the values are
+read in square blocks that are kept in a least recently used cache, so only
+the parts of the tiles that are needed (such as the catchments of the
+measurements) are read.
+"""
+
+import os
+from collections import OrderedDict
+import numpy as np
+
+def read_bil_header(bil_file):
+    """Read the ESRI .hdr file that describes a .bil file.
+    """
+    header = {'BYTEORDER': 'I', 'NBANDS': '1', 'NBITS': '8', 'SKIPBYTES': '0', 'PIXELTYPE': 'UNSIGNEDINT'}
+    with open(os.path.splitext(bil_file)[0] + '.hdr') as header_file:
+        for line in header_file:
+            fields = line.split()
+            if len(fields) >= 2:
+                header[fields[0].upper()] = fields[1]
+    if int(header['NBANDS']) != 1:
+        raise ValueError('{}: only single band BIL files are supported'.format(bil_file))
+    return header
+
+def bil_dtype(header):
+    """Return the NumPy data type of the values in a BIL file with the given header.
+    """
+    kind = 'i' if header['PIXELTYPE'].upper().startswith('SIGNED') else 'u'
+    byteorder = '>' if header['BYTEORDER'].upper() in ('M', 'MSBFIRST') else '<'
+    return np.dtype('{}{}{}'.format(byteorder, kind, int(header['NBITS']) // 8))
+
+def read_projection(bil_file):
+    """Return the WKT in the .prj file next to a .bil file, or None if there is not one.
+    """
+    prj_file = os.path.splitext(bil_file)[0] + '.prj'
+    if not os.path.exists(prj_file):
+        return None
+    with open(prj_file) as projection_file:
+        return projection_file.read().strip()
+
+class TileMosaic(object):
+    """A virtual mosaic of BIL tiles on the same grid.
+       Cells that are not covered by any tile have the value 0 (no flow).
+       Like a NumPy array, the values at linear (row-major) cell indices are
+       returned by take, and the dimensions are in shape.
+    """
+
+    def __init__(self, bil_files, block_size=256, cache_blocks=1024):
+        headers = [read_bil_header(bil_file) for bil_file in bil_files]
+        xdim = float(headers[0]['XDIM'])
+        ydim = float(headers[0]['YDIM'])
+        # ULXMAP and ULYMAP are the centre of the top left cell
+        lefts = [float(header['ULXMAP']) - xdim / 2 for header in headers]
+        tops = [float(header['ULYMAP']) + ydim / 2 for header in headers]
+        left = min(lefts)
+        top = max(tops)
+        self.tiles = []
+        ny = 0
+        nx = 0
+        for bil_file, header, tile_left, tile_top in zip(bil_files, headers, lefts, tops):
+            if not np.isclose(float(header['XDIM']), xdim) or not np.isclose(float(header['YDIM']), ydim):
+                raise ValueError('{}: tiles must have the same cell size'.format(bil_file))
+            row0 = int(round((top - tile_top) / ydim))
+            col0 = int(round((tile_left - left) / xdim))
+            shape = (int(header['NROWS']), int(header['NCOLS']))
+            data = np.memmap(bil_file, dtype=bil_dtype(header), mode='r',
+                             offset=int(header['SKIPBYTES']), shape=shape)
+            self.tiles.append((row0, col0, data))
+            ny = max(ny, row0 + shape[0])
+            nx = max(nx, col0 + shape[1])
+        self.files = list(bil_files)
+        self.shape = (ny, nx)
+        self.dtype = np.result_type(*[data.dtype for _, _, data in self.tiles]).newbyteorder('=')
+        self.geotransform = (left, xdim, 0.0, top, 0.0, -ydim)
+        self.projection = read_projection(bil_files[0])
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.blocks_x = (nx + block_size - 1) // block_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read_block(self, block):
+        """Return the values in a block, reading it from the tiles if it is not in the cache.
+        """
+        if block in self.cache:
+            self.cache.move_to_end(block)
+            self.hits += 1
+            return self.cache[block]
+        self.misses += 1
+        row0 = (block // self.blocks_x) * self.block_size
+        col0 = (block % self.blocks_x) * self.block_size
+        values = np.zeros([self.block_size, self.block_size], dtype=self.dtype)
+        for tile_row0, tile_col0, data in self.tiles:
+            rows = slice(max(row0, tile_row0), min(row0 + self.block_size, tile_row0 + data.shape[0]))
+            cols = slice(max(col0, tile_col0), min(col0 + self.block_size, tile_col0 + data.shape[1]))
+            if rows.start < rows.stop and cols.start < cols.stop:
+                values[rows.start - row0:rows.stop - row0, cols.start - col0:cols.stop - col0] = \
+                    data[rows.start - tile_row0:rows.stop - tile_row0, cols.start - tile_col0:cols.stop - tile_col0]
+        self.cache[block] = values
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return values
+
+    def take(self, cells):
+        """Return the values at the given linear cell indices.
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        rows = cells // self.shape[1]
+        cols = cells % self.shape[1]
+        blocks = (rows // self.block_size) * self.blocks_x + cols // self.block_size
+        unique_blocks, block_idxs = np.unique(blocks, return_inverse=True)
+        values = np.zeros(len(cells), dtype=self.dtype)
+        order = np.argsort(block_idxs, kind='stable')
+        bounds = np.searchsorted(block_idxs[order], np.arange(len(unique_blocks) + 1))
+        for i, block in enumerate(unique_blocks):
+            idxs = order[bounds[i]:bounds[i+1]]
+            values[idxs] = self.read_block(int(block))[rows[idxs] % self.block_size, cols[idxs] % self.block_size]
+        return values
+
+    def read(self):
+        """Return the whole mosaic as an array.
+        """
+        values = np.zeros(self.shape, dtype=self.dtype)
+        for row0, col0, data in self.tiles:
+            values[row0:row0 + data.shape[0], col0:col0 + data.shape[1]] = data
+        return values
+
+def is_bil(path):
+    """Return True if path is a BIL file.
+    """
+    return os.path.splitext(path)[1].lower() == '.bil'
@@ -0,0 +1,14 @@
+"""Tell GDAL where its data files (such as the EPSG support files) are.
+"""
+
+import os
+
+def set_gdal_data():
+    """Set GDAL_DATA to the output of gdal-config --datadir, unless it is already set.
+       Necessary for my version of GDAL to avoid errors such as
+       ERROR 4: Unable to open EPSG support file gcs.csv
+       This starts a process, so it is done just before GDAL first needs its data
+       (when a spatial reference is created), rather than when a script starts.
+    """
+    if 'GDAL_DATA' not in os.environ:
+        os.environ['GDAL_DATA'] = os.popen('gdal-config --datadir').read().rstrip()
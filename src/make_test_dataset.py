@@ -1,17 +1,144 @@
-import os
 import argparse
 import gdal
 import osr
 import numpy as np
 import pandas as pd
-
-# Necessary for my version of GDAL to avoid errors such as
-# ERROR 4: Unable to open EPSG support file gcs.csv
-os.environ['GDAL_DATA'] = os.popen('gdal-config --datadir').read().rstrip()
+from gdal_data import set_gdal_data
 
 NX = 3
 NY = 6
 
+# Geotransform of the test rasters, a small part of the HydroSHEDS grid in Ireland
+GEOTRANSFORM = (-10.601476282215518, 0.000833385971806, 0, 55.571185968814824, 0, -0.000833397668502)
+
+# Flow directions of the synthetic dendritic rasters: south west, south, south east
+DENDRITIC_DIRECTIONS = np.array([8, 4, 2], dtype=np.uint8)
+
+# The column offset of the cell that each flow direction value flows into
+COLUMN_OFFSET = np.zeros(256, dtype=np.int64)
+COLUMN_OFFSET[[8, 4, 2]] = [-1, 0, 1]
+
+# Substance columns of the synthetic measurements
+SYNTHETIC_COLUMNS = ['Na2O_%', 'MgO_%', 'Al2O3_%', 'SiO2_%', 'P2O5_%', 'S_mgkg']
+
+def make_dendritic_flow_directions(ny, nx, seed=0, block_cells=1 << 22):
+    """Create a flow directions raster with a realistic branching (dendritic) river network.
+       This is Scheidegger's model: each cell flows to one of the three cells below it,
+       chosen at random, so rivers merge as they flow south, and every cell drains
+       (without cycles) to the edge of the raster. The rows are generated in blocks of
+       about block_cells cells, so rasters with hundreds of millions of cells can be made.
+    """
+    rng = np.random.RandomState(seed)
+    flow_directions = np.empty([ny, nx], dtype=np.uint8)
+    block_rows = max(block_cells // max(nx, 1), 1)
+    for row in range(0, ny, block_rows):
+        rows = min(block_rows, ny - row)
+        flow_directions[row:row+rows] = DENDRITIC_DIRECTIONS[rng.randint(0, 3, size=[rows, nx])]
+    return flow_directions
+
+def dendritic_accumulation(flow_directions):
+    """Yield the number of cells upstream of (and including) each cell of a raster made
+       by make_dendritic_flow_directions, one row at a time, from the top.
+    """
+    ny, nx = flow_directions.shape
+    accumulation = np.ones(nx, dtype=np.int64)
+    for row in range(ny):
+        yield accumulation
+        receivers = np.arange(nx) + COLUMN_OFFSET[flow_directions[row]]
+        inside = (0 <= receivers) & (receivers < nx)
+        accumulation = 1 + np.bincount(receivers[inside], weights=accumulation[inside],
+                                       minlength=nx).astype(np.int64)
+
+def make_dendritic_samples(flow_directions, num_samples, nesting=1, spacing=10, min_catchment=10, seed=0):
+    """Choose the cells of num_samples samples on a raster made by make_dendritic_flow_directions.
+       The samples are placed in chains of nesting samples, spacing cells apart along a
+       river, so each sample's catchment contains the catchments of the samples upstream
+       of it in its chain. The first sample of each chain is in a randomly chosen cell with
+       at least min_catchment upstream cells. The samples of each chain are consecutive.
+       Samples that would be outside the raster are dropped, so fewer than num_samples
+       samples may be returned.
+    """
+    rng = np.random.RandomState(seed)
+    ny, nx = flow_directions.shape
+    num_chains = int(np.ceil(num_samples / nesting))
+    # Choose the first samples from the suitable cells in two passes, to avoid storing the accumulation
+    counts = np.array([np.count_nonzero(accumulation >= min_catchment)
+                       for accumulation in dendritic_accumulation(flow_directions)])
+    if num_chains == 0 or counts.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    ranks = np.unique(rng.randint(0, counts.sum(), size=num_chains))
+    row_starts = np.concatenate([[0], np.cumsum(counts)])
+    starts = []
+    for row, accumulation in enumerate(dendritic_accumulation(flow_directions)):
+        row_ranks = ranks[(row_starts[row] <= ranks) & (ranks < row_starts[row+1])] - row_starts[row]
+        if len(row_ranks) > 0:
+            starts.append(row * nx + np.flatnonzero(accumulation >= min_catchment)[row_ranks])
+    cells = np.concatenate(starts)
+
+    # Walk downstream from the first samples, adding a sample every spacing cells,
+    # and marking those that have left the raster with -1
+    samples = [cells]
+    for _ in range(nesting - 1):
+        for _ in range(spacing):
+            rows = cells // nx + 1
+            cols = cells % nx + COLUMN_OFFSET[flow_directions.take(np.maximum(cells, 0))]
+            inside = (cells >= 0) & (rows < ny) & (0 <= cols) & (cols < nx)
+            cells = np.where(inside, rows * nx + cols, -1)
+        samples.append(cells)
+    # The samples of each chain are consecutive, from upstream to downstream
+    samples = np.column_stack(samples).ravel()
+    return samples[samples >= 0][:num_samples]
+
+def to_irish_grid(easting, northing):
+    """Reproject coordinates from WGS84 to the Irish National Grid.
+    """
+    #'EPSG:29901, OSNI 1952 / Irish National Grid'
+    set_gdal_data()
+    sourceSR = osr.SpatialReference()
+    sourceSR.ImportFromEPSG(4326)
+    targetSR = osr.SpatialReference()
+    targetSR.ImportFromEPSG(29901)
+    coordTrans = osr.CoordinateTransformation(sourceSR, targetSR)
+    points = np.array(coordTrans.TransformPoints(np.column_stack([easting, northing]).tolist()), dtype=float)
+    return points[:, 0], points[:, 1]
+
+def write_flow_directions(output_path, flow_directions):
+    """Write flow directions to a GeoTiff file on the test grid.
+    """
+    ny, nx = flow_directions.shape
+    driver = gdal.GetDriverByName('GTiff')
+
+    dataset = driver.Create(output_path, nx, ny, 1, gdal.GDT_Byte, ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+
+    dataset.SetGeoTransform(GEOTRANSFORM)
+    set_gdal_data()
+    proj = osr.SpatialReference()
+    proj.ImportFromEPSG(4326)
+    dataset.SetProjection(proj.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(flow_directions)
+    dataset = None
+
+def create_dendritic_dataset(measurements_path, flow_directions_path, ny, nx, density=1e-3, nesting=3,
+                             spacing=10, min_catchment=10, seed=0):
+    """Create a synthetic dataset on a dendritic flow directions raster (see
+       make_dendritic_flow_directions), with about density samples per cell
+       (see make_dendritic_samples) and random substance concentrations.
+    """
+    flow_directions = make_dendritic_flow_directions(ny, nx, seed)
+    if flow_directions_path:
+        write_flow_directions(flow_directions_path, flow_directions)
+    if measurements_path:
+        cells = make_dendritic_samples(flow_directions, int(round(density * ny * nx)), nesting, spacing,
+                                       min_catchment, seed)
+        rows, cols = np.unravel_index(cells, flow_directions.shape)
+        easting, northing = to_irish_grid(GEOTRANSFORM[0] + (cols + 0.5) * GEOTRANSFORM[1],
+                                          GEOTRANSFORM[3] + (rows + 0.5) * GEOTRANSFORM[5])
+        rng = np.random.RandomState(seed)
+        dataset = pd.DataFrame({'Easting': easting, 'Northing': northing})
+        for column in SYNTHETIC_COLUMNS:
+            dataset[column] = rng.lognormal(size=len(cells))
+        dataset.to_csv(measurements_path)
+
 def create_test_flow_directions(output_path):
     flow_directions = np.zeros([NY, NX], dtype=np.uint8)
     flow_directions[1:5, 1] = np.uint8(4)
@@ -22,40 +149,14 @@ def create_test_flow_directions(output_path):
     # 0 4 0
     # 0 0 0
     # 0: no flow, 4: flow south
-
-    driver = gdal.GetDriverByName('GTiff')
-
-    dataset = driver.Create(output_path, NX, NY, 1, gdal.GDT_Byte)
-
-    dataset.SetGeoTransform((
-        -10.601476282215518,
-        0.000833385971806,
-        0,
-        55.571185968814824,
-        0,
-        -0.000833397668502))
-    proj = osr.SpatialReference()
-    proj.ImportFromEPSG(4326)
-    dataset.SetProjection(proj.ExportToWkt())
-    dataset.GetRasterBand(1).WriteArray(flow_directions)
-    dataset = None
+    write_flow_directions(output_path, flow_directions)
 
 def create_test_measurements(output_path):
-    easting = (-10.601476282215518 + 1.5*0.000833385971806)*np.ones(2)
+    easting = (GEOTRANSFORM[0] + 1.5*GEOTRANSFORM[1])*np.ones(2)
     northing = np.zeros(2)
-    northing[0] = 55.571185968814824 - (0.5+2)*0.000833397668502
-    northing[1] = 55.571185968814824 - (0.5+4)*0.000833397668502
-    # Reproject vector geometry from WGS84 to Irish National Grid
-    #'EPSG:29901, OSNI 1952 / Irish National Grid'
-    sourceSR = osr.SpatialReference()
-    sourceSR.ImportFromEPSG(4326)
-    targetSR = osr.SpatialReference()
-    targetSR.ImportFromEPSG(29901)
-    coordTrans = osr.CoordinateTransformation(sourceSR, targetSR)
-    for i in range(len(easting)):
-        new_coords = coordTrans.TransformPoint(float(easting[i]), float(northing[i]))
-        easting[i] = new_coords[0]
-        northing[i] = new_coords[1]
+    northing[0] = GEOTRANSFORM[3] + (0.5+2)*GEOTRANSFORM[5]
+    northing[1] = GEOTRANSFORM[3] + (0.5+4)*GEOTRANSFORM[5]
+    easting, northing = to_irish_grid(easting, northing)
     na = [1.0, 1.0]
     mg = [0.0, 0.5]
     al = [1.0, 0.5]
@@ -69,8 +170,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--measurements", type=str, help="path to measurements csv file")
     parser.add_argument("--flow_directions", type=str, help="path to flow directions file")
+    parser.add_argument("--dendritic", type=int, nargs=2, metavar=('NY', 'NX'), help="create a synthetic dendritic dataset of this size instead of the test dataset")
+    parser.add_argument("--density", type=float, default=1e-3, help="number of synthetic samples per cell")
+    parser.add_argument("--nesting", type=int, default=3, help="number of nested synthetic samples along each river")
+    parser.add_argument("--spacing", type=int, default=10, help="number of cells between nested synthetic samples")
+    parser.add_argument("--min_catchment", type=int, default=10, help="minimum catchment size of the most upstream synthetic samples")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic dataset")
     args = parser.parse_args()
-    if args.measurements:
-        create_test_measurements(args.measurements)
-    if args.flow_directions:
-        create_test_flow_directions(args.flow_directions)
+    if args.dendritic:
+        create_dendritic_dataset(args.measurements, args.flow_directions, args.dendritic[0], args.dendritic[1],
+                                 args.density, args.nesting, args.spacing, args.min_catchment, args.seed)
+    else:
+        if args.measurements:
+            create_test_measurements(args.measurements)
+        if args.flow_directions:
+            create_test_flow_directions(args.flow_directions)
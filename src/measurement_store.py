@@ -0,0 +1,148 @@
+"""Store measurements as one array file per column, so that columns can be read separately.
+
+A measurement store is a directory containing:
+    meta.json: the number of rows, and the name, file and data type of each column
+    column<i>.npy: the values of column i
+Coordinate columns are stored as float64, other numeric columns (such as the
+substance concentrations) as float32, and text columns (such as Sample_ID) as
+fixed-width strings. The arrays are plain .npy files that are memory-mapped
+when read, so reading one column takes the same time however many there are.
+Readers also accept CSV files, such as the output of older versions.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+# Columns that need double precision
+COORDINATE_COLUMNS = ('Easting', 'Northing')
+
+# Columns that are always stored as text, as some of their values look like numbers
+TEXT_COLUMNS = ('Sample_ID',)
+
+# Number of rows copied at a time when finishing a column
+COPY_ROWS = 1 << 20
+
+def is_store(path):
+    """Return True if path is a measurement store, rather than a CSV file.
+    """
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+def column_dtype(name, values):
+    """Return the data type that a column is stored with, or None if it is stored as text.
+    """
+    if name in TEXT_COLUMNS:
+        return None
+    if name in COORDINATE_COLUMNS:
+        return np.dtype(np.float64)
+    if pd.api.types.is_numeric_dtype(values):
+        return np.dtype(np.float32)
+    return None
+
+class StoreWriter(object):
+    """Write a measurement store one chunk of rows at a time.
+       The numeric columns of each chunk are appended to raw files, so only the text
+       columns (which are small) are kept in memory until the store is closed.
+    """
+
+    def __init__(self, path, columns):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path = path
+        self.columns = list(columns)
+        self.dtypes = [None] * len(self.columns)
+        self.text = [[] for _ in self.columns]
+        self.num_rows = 0
+
+    def raw_file(self, i):
+        """Return the path of the file that column i is appended to.
+        """
+        return os.path.join(self.path, 'column{}.raw'.format(i))
+
+    def write(self, chunk):
+        """Append a DataFrame containing (a subset of) the columns. Missing columns are NaN.
+        """
+        chunk = chunk.reindex(columns=self.columns)
+        for i, name in enumerate(self.columns):
+            values = chunk[name]
+            if self.dtypes[i] is None and values.notna().any():
+                self.dtypes[i] = column_dtype(name, values)
+                if self.dtypes[i] is None:
+                    self.dtypes[i] = 'text'
+                else:
+                    # Earlier chunks had no values in this column
+                    np.full(self.num_rows, np.nan, dtype=self.dtypes[i]).tofile(self.raw_file(i))
+            if self.dtypes[i] == 'text':
+                self.text[i].extend(values.where(values.notna(), '').astype(str).tolist())
+            elif self.dtypes[i] is not None:
+                with open(self.raw_file(i), 'ab') as raw_file:
+                    pd.to_numeric(values, errors='coerce').values.astype(self.dtypes[i]).tofile(raw_file)
+        self.num_rows += len(chunk)
+
+    def close(self):
+        """Convert the raw files to .npy files and write meta.json.
+           Columns that never had a value are stored as float32 NaN.
+        """
+        meta = {'num_rows': self.num_rows, 'columns': []}
+        for i, name in enumerate(self.columns):
+            column_file = os.path.join(self.path, 'column{}.npy'.format(i))
+            if self.dtypes[i] == 'text':
+                values = np.array(self.text[i], dtype=str).reshape(self.num_rows)
+                np.save(column_file, values)
+            elif self.dtypes[i] is None:
+                values = np.full(self.num_rows, np.nan, dtype=np.float32)
+                np.save(column_file, values)
+            else:
+                values = np.lib.format.open_memmap(column_file, mode='w+', dtype=self.dtypes[i], shape=(self.num_rows,))
+                raw = np.memmap(self.raw_file(i), dtype=self.dtypes[i], mode='r', shape=(self.num_rows,))
+                for row in range(0, self.num_rows, COPY_ROWS):
+                    values[row:row+COPY_ROWS] = raw[row:row+COPY_ROWS]
+                values.flush()
+                del raw
+                os.remove(self.raw_file(i))
+            meta['columns'].append({'name': name, 'file': os.path.basename(column_file), 'dtype': values.dtype.str})
+            del values
+        with open(os.path.join(self.path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=1)
+        # Overwriting files does not update the directory's modification time,
+        # which Make uses to decide whether the store is up to date
+        os.utime(self.path, None)
+
+def write_store(path, df):
+    """Write a DataFrame to a measurement store.
+    """
+    writer = StoreWriter(path, df.columns)
+    writer.write(df)
+    writer.close()
+
+def read_meta(path):
+    """Return the contents of a store's meta.json.
+    """
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        return json.load(meta_file)
+
+def column_names(path):
+    """Return the names of the columns in a measurement store or CSV file.
+    """
+    if is_store(path):
+        return [column['name'] for column in read_meta(path)['columns']]
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+def read_columns(path, columns=None, mmap_mode='r'):
+    """Return a DataFrame of the columns (or all columns if None) of a measurement
+       store or CSV file. Only the requested columns are read.
+    """
+    if not is_store(path):
+        return pd.read_csv(path, usecols=columns)[columns] if columns is not None else pd.read_csv(path)
+    meta = read_meta(path)
+    files = {column['name']: column['file'] for column in meta['columns']}
+    if columns is None:
+        columns = [column['name'] for column in meta['columns']]
+    missing = [name for name in columns if name not in files]
+    if missing:
+        raise KeyError('{} not in {}'.format(', '.join(missing), path))
+    return pd.DataFrame({name: np.load(os.path.join(path, files[name]), mmap_mode=mmap_mode)
+                         for name in columns}, columns=columns)
@@ -5,11 +5,16 @@ into a single CSV file to ease later processing.
 
 import argparse
 import pandas as pd
+import measurement_store
+from metrics import Metrics, profile
+
+# Number of rows of the input files that are read at a time when writing a measurement store
+CHUNK_ROWS = 100000
 
 def merge_dfs(input_dfs):
     """Merge the input dataframes.
     """
-    return input_dfs[0].append(input_dfs[1:], ignore_index=True)
+    return pd.concat(input_dfs, ignore_index=True, sort=False)
 
 def fix_northern_ireland_set1(northern_ireland_set1_data):
     """Modify Northern Ireland columns in 'set1' to match Republic ones.
@@ -80,18 +85,78 @@ def fix_northern_ireland(input_dfs, ni1idx, ni2idx, niauandpgeidx):
         input_dfs.append(ni_df)
     return input_dfs
 
-def run(output_file, input_files, ni1idx, ni2idx, niauandpgeidx):
-    """Main driver function.
+def merge_chunks(input_files, ni1idx, ni2idx, niauandpgeidx, chunk_size=CHUNK_ROWS):
+    """Merge the input files in chunks of at most chunk_size rows.
+       Returns the columns of the merged data and an iterator over the chunks, which
+       contain the same rows as merge_dfs would in the same order.
+       The Northern Ireland files are read and joined in memory, as they must be
+       matched by sample, while the other files are only read a chunk at a time.
     """
-    input_dfs = []
-    for input_file in input_files:
-        input_dfs.append(pd.read_csv(input_file))
-
+    ni_idxs = [idx for idx in (ni1idx, ni2idx, niauandpgeidx) if idx is not None]
+    input_dfs = [pd.read_csv(input_file) if idx in ni_idxs else pd.read_csv(input_file, nrows=0)
+                 for idx, input_file in enumerate(input_files)]
+    # The other files are represented by their (empty) header until they are read
     input_dfs = fix_northern_ireland(input_dfs, ni1idx, ni2idx, niauandpgeidx)
-
-    merged_df = merge_dfs(input_dfs)
-
-    merged_df.to_csv(output_file)
+    columns = merge_dfs([input_df.iloc[:0] for input_df in input_dfs]).columns
+
+    # The path of each file to read in chunks, or None and the data of the Northern Ireland
+    # files, in the order of fix_northern_ireland's output: the files are in their original
+    # order unless several Northern Ireland files are joined, which are then moved to the end
+    if len(ni_idxs) > 1:
+        sources = [(input_file, None) for idx, input_file in enumerate(input_files) if idx not in ni_idxs]
+        sources.append((None, input_dfs[-1]))
+    else:
+        sources = [(None, input_dfs[idx]) if idx in ni_idxs else (input_file, None)
+                   for idx, input_file in enumerate(input_files)]
+
+    def chunks():
+        for input_file, input_df in sources:
+            if input_file is not None:
+                for chunk in pd.read_csv(input_file, chunksize=chunk_size):
+                    yield chunk
+            else:
+                for row in range(0, len(input_df), chunk_size):
+                    yield input_df.iloc[row:row+chunk_size]
+    return columns, chunks()
+
+def run(output_file, input_files, ni1idx, ni2idx, niauandpgeidx, metrics_file=None, columnar=False):
+    """Main driver function.
+       If columnar is True, the output is a measurement store (see measurement_store)
+       written a chunk at a time, rather than a CSV file.
+       If metrics_file is specified, the time and memory used by each stage are written to it.
+    """
+    metrics = Metrics()
+
+    if columnar:
+        with metrics.stage('load'):
+            columns, chunks = merge_chunks(input_files, ni1idx, ni2idx, niauandpgeidx)
+        with metrics.stage('write'):
+            writer = measurement_store.StoreWriter(output_file, columns)
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.close()
+        metrics.count(input_files=len(input_files), samples=writer.num_rows, columns=len(columns))
+        if metrics_file is not None:
+            metrics.write(metrics_file)
+        return
+
+    with metrics.stage('load'):
+        input_dfs = []
+        for input_file in input_files:
+            input_dfs.append(pd.read_csv(input_file))
+    metrics.count(input_files=len(input_files), input_rows=sum(len(input_df) for input_df in input_dfs))
+
+    with metrics.stage('transform'):
+        input_dfs = fix_northern_ireland(input_dfs, ni1idx, ni2idx, niauandpgeidx)
+
+        merged_df = merge_dfs(input_dfs)
+
+    with metrics.stage('write'):
+        merged_df.to_csv(output_file)
+
+    metrics.count(samples=len(merged_df), columns=len(merged_df.columns))
+    if metrics_file is not None:
+        metrics.write(metrics_file)
 
 if __name__ == '__main__':
 
@@ -101,5 +166,9 @@ if __name__ == '__main__':
     parser.add_argument("--ni1idx", type=int, help="index of Northern Ireland Set 1 in input list")
     parser.add_argument("--ni2idx", type=int, help="index of Northern Ireland Set 2 in input list")
     parser.add_argument("--niauandpgeidx", type=int, help="index of Northern Ireland Au and PGE in input list")
+    parser.add_argument("--columnar", action="store_true", help="write a directory with a file for each column instead of a CSV file")
+    parser.add_argument("--metrics_json", type=str, help="path to output JSON file of the time and memory used by each stage")
+    parser.add_argument("--profile", type=str, help="path to output cProfile statistics file")
     args = parser.parse_args()
-    run(args.output, args.inputs, args.ni1idx, args.ni2idx, args.niauandpgeidx)
+    profile(args.profile, run, args.output, args.inputs, args.ni1idx, args.ni2idx, args.niauandpgeidx, args.metrics_json,
+            args.columnar)
@@ -0,0 +1,158 @@
+"""Record the time and memory used by each stage of a script, and counts of what it processed.
+
+The metrics are written to a JSON file containing:
+    stages: for each stage (in the order they ran), its name, any labels (such as
+            the column being processed), wall time and CPU time in seconds, and
+            the peak resident set size (RSS) of the process in bytes during the
+            stage. That needs Linux, where the peak is reset at the start of the
+            stage; elsewhere peak_rss_increase is recorded instead, which is how
+            far the stage raised the process's peak RSS (zero if it stayed below
+            the peak of an earlier stage)
+    stage_times: the total wall time of each stage name
+    counts: the numbers of things processed, such as samples and unknowns
+    peak_rss, children_peak_rss: the peak RSS of the process, and of the largest
+            worker process that has finished
+    time: the wall time from the creation of the Metrics to writing them
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+from contextlib import contextmanager
+
+# Linux keeps the peak RSS since it was last reset in these files
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+STATUS_FILE = '/proc/self/status'
+
+# The peak RSS of this process before it was last reset, and that of each stage
+# that is running (as a one item list), outermost first
+_cleared_peak = 0
+_running_peaks = []
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size (in bytes) of this process, or of its largest
+       finished child process.
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    if who == resource.RUSAGE_SELF:
+        return max(maxrss, _cleared_peak)
+    return maxrss
+
+def recent_peak_rss():
+    """Return the peak RSS (in bytes) of this process since it was last reset (see
+       reset_peak_rss), or None if it is not known.
+    """
+    try:
+        with open(STATUS_FILE) as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS, first adding the peak
+       so far to the peaks of the running stages and of the process.
+       Returns False if it cannot be reset.
+    """
+    global _cleared_peak
+    peak = recent_peak_rss()
+    if peak is None or not os.path.exists(CLEAR_REFS_FILE):
+        return False
+    _update_peaks(peak)
+    _cleared_peak = max(_cleared_peak, peak)
+    try:
+        with open(CLEAR_REFS_FILE, 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+def _update_peaks(peak):
+    for running_peak in _running_peaks:
+        running_peak[0] = max(running_peak[0], peak)
+
+class Metrics(object):
+    """The stages and counts of one run of a script.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """Time the code in a with block as the stage name.
+        """
+        if reset_peak_rss():
+            start_peak = None
+            stage_peak = [0]
+            _running_peaks.append(stage_peak)
+        else:
+            start_peak = peak_rss()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {'stage': name}
+            record.update(labels)
+            record.update({'time': time.perf_counter() - start,
+                           'cpu_time': time.process_time() - start_cpu})
+            if start_peak is None:
+                _update_peaks(recent_peak_rss() or 0)
+                _running_peaks.pop()
+                record['peak_rss'] = stage_peak[0]
+            else:
+                record['peak_rss_increase'] = peak_rss() - start_peak
+            self.stages.append(record)
+
+    def count(self, *groups, **counts):
+        """Record counts, within nested dictionaries named by groups if they are
+           specified (e.g. count('columns', column, unknowns=n)).
+        """
+        target = self.counts
+        for group in groups:
+            target = target.setdefault(group, {})
+        target.update(counts)
+
+    def stage_times(self):
+        """Return the total wall time of each stage name.
+        """
+        times = {}
+        for record in self.stages:
+            times[record['stage']] = times.get(record['stage'], 0.0) + record['time']
+        return times
+
+    def write(self, metrics_file):
+        """Write the metrics to a JSON file.
+        """
+        metrics = {'stages': self.stages,
+                   'stage_times': self.stage_times(),
+                   'counts': self.counts,
+                   'peak_rss': peak_rss(),
+                   'children_peak_rss': peak_rss(resource.RUSAGE_CHILDREN),
+                   'time': time.perf_counter() - self.start}
+        with open(metrics_file, 'w') as output_file:
+            json.dump(metrics, output_file, indent=2, default=int)
+
+def profile(profile_file, function, *args, **kwargs):
+    """Call function with args and kwargs and return its result. If profile_file is
+       specified, the call is profiled with cProfile and the statistics are written to
+       it, to be read with pstats or a viewer such as snakeviz.
+    """
+    if profile_file is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Run all of the processing in one process: merge the measurements, find the
+upstream cells of each sample, estimate the concentration of each substance
+and package the results.
+
+Each stage is skipped if its inputs, its settings and the source files of the
+modules it uses are unchanged since it last ran (and its outputs still exist).
+The signatures of the stages that have run are kept in <name>_pipeline.json in
+the interim directory. The modules of each stage (and with them GDAL, pandas
+and SciPy) are only imported when the stage runs, and the upstream index that
+is found is used to estimate the concentrations without reading it back.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import zipfile
+import argparse
+from metrics import Metrics, profile
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The modules that each stage uses, whose source files are part of its signature
+STAGE_MODULES = {
+    'merge': ['merge_csvs', 'measurement_store'],
+    'trace': ['find_upstream', 'flow_raster', 'catchment_cache', 'upstream_index', 'measurement_store', 'gdal_data'],
+    'solve': ['reverse_sediment', 'solvers', 'upstream_index', 'measurement_store', 'result_cache',
+              'catchment_operator'],
+    'package': [],
+}
+
+def file_signature(path):
+    """Return the path, size and modification time of path, or of each file in it
+       if it is a directory, or None if it does not exist.
+    """
+    if os.path.isdir(path):
+        return [file_signature(os.path.join(path, name)) for name in sorted(os.listdir(path))]
+    if not os.path.exists(path):
+        return None
+    status = os.stat(path)
+    return [os.path.abspath(path), status.st_size, status.st_mtime_ns]
+
+def stage_signature(stage, inputs, settings):
+    """Return a hash of a stage's input files, settings and module source files.
+    """
+    modules = [os.path.join(SRC_DIR, module + '.py') for module in STAGE_MODULES[stage]]
+    signature = {'inputs': [file_signature(path) for path in inputs],
+                 'modules': [file_signature(path) for path in modules],
+                 'settings': settings}
+    return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+def load_state(state_file):
+    """Return the signatures of the stages that have run, recorded in state_file.
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as input_file:
+        return json.load(input_file)
+
+def save_state(state_file, state):
+    """Record the signatures of the stages that have run in state_file.
+    """
+    with open(state_file, 'w') as output_file:
+        json.dump(state, output_file, indent=1, sort_keys=True)
+
+def run_stage(state, state_file, metrics, stage, inputs, outputs, settings, function):
+    """Call function to run a stage, unless its signature (see stage_signature) is
+       recorded in state and all of its outputs exist.
+       Returns the result of function, or None if the stage was skipped.
+    """
+    signature = stage_signature(stage, inputs, settings)
+    if state.get(stage) == signature and all(os.path.exists(path) for path in outputs):
+        print('pipeline: {} is up to date'.format(stage), file=sys.stderr)
+        metrics.count('stages', stage, skipped=True)
+        return None
+    with metrics.stage(stage):
+        result = function()
+    state[stage] = signature
+    save_state(state_file, state)
+    metrics.count('stages', stage, skipped=False)
+    return result
+
+def merge(measurements_file, input_files, ni1idx, ni2idx, niauandpgeidx, metrics_file):
+    """Merge the input CSV files into a measurement store.
+    """
+    import merge_csvs
+    merge_csvs.run(measurements_file, input_files, ni1idx, ni2idx, niauandpgeidx, metrics_file, columnar=True)
+
+def trace(upstream_file, measurements_file, csv_epsg, flow_directions_files, single_pass, cache_dir, workers,
+          metrics_file):
+    """Find the upstream cells of each sample, and return the upstream index.
+    """
+    import find_upstream
+    return find_upstream.run(upstream_file, measurements_file, csv_epsg, flow_directions_files, single_pass,
+                             cache_dir, workers=workers, metrics_file=metrics_file)
+
+def solve(output_pattern, columns, measurements_file, upstream, results_cache_dir, workers, metrics_file):
+    """Estimate the concentration of each substance in columns.
+       upstream is the upstream index, or the path it was saved to.
+    """
+    import reverse_sediment
+    reverse_sediment.run_columns(output_pattern, columns, measurements_file, upstream, workers=workers,
+                                 metrics_file=metrics_file, cache_dir=results_cache_dir)
+
+def package(zip_file, folder, files):
+    """Write files to a zip file, in a folder.
+    """
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as output_zip:
+        for path in files:
+            output_zip.write(path, os.path.join(folder, os.path.basename(path)))
+
+def substance_columns(measurements_file):
+    """Return the substance columns of the measurements.
+    """
+    import measurement_store
+    import reverse_sediment
+    return reverse_sediment.find_substance_columns(measurement_store.column_names(measurements_file))
+
+def run(name, interim_dir, output_dir, flow_directions_files, measurements_file=None, input_files=None,
+        ni1idx=None, ni2idx=None, niauandpgeidx=None, csv_epsg=29901, columns=None, readme_file=None,
+        single_pass=False, cache_dir=None, results_cache_dir=None, workers=1, force=False, metrics_file=None):
+    """Main driver function.
+       The measurements are either measurements_file, or input_files merged (see
+       merge_csvs) into <name>_measurements in interim_dir. The upstream index is
+       written to <name>_upstream in interim_dir, and the result for each column
+       (all substance columns if columns is None) to <name>_<column>.tif in output_dir,
+       which are zipped with readme_file (if specified) into <name>_sediments.zip.
+       The metrics of each stage are written to <name>_<output>_metrics.json in
+       interim_dir. cache_dir and results_cache_dir are the catchment and result caches
+       (see find_upstream and reverse_sediment), if specified. If force is True, all
+       stages are run, even if they are up to date.
+       If metrics_file is specified, the time and memory used by each stage are written to it.
+    """
+    if isinstance(flow_directions_files, str):
+        flow_directions_files = [flow_directions_files]
+    metrics = Metrics()
+    state_file = os.path.join(interim_dir, '{}_pipeline.json'.format(name))
+    state = {} if force else load_state(state_file)
+
+    def stage_metrics_file(output):
+        return os.path.join(interim_dir, '{}_{}_metrics.json'.format(name, output))
+
+    if measurements_file is None:
+        measurements_file = os.path.join(interim_dir, '{}_measurements'.format(name))
+        run_stage(state, state_file, metrics, 'merge', input_files, [measurements_file],
+                  {'ni1idx': ni1idx, 'ni2idx': ni2idx, 'niauandpgeidx': niauandpgeidx},
+                  lambda: merge(measurements_file, input_files, ni1idx, ni2idx, niauandpgeidx,
+                                stage_metrics_file('measurements')))
+
+    upstream_file = os.path.join(interim_dir, '{}_upstream'.format(name))
+    index = run_stage(state, state_file, metrics, 'trace', [measurements_file] + list(flow_directions_files),
+                      [upstream_file], {'csv_epsg': csv_epsg},
+                      lambda: trace(upstream_file, measurements_file, csv_epsg, flow_directions_files, single_pass,
+                                    cache_dir, workers, stage_metrics_file('upstream')))
+
+    if columns is None:
+        columns = substance_columns(measurements_file)
+    output_pattern = os.path.join(output_dir, '{}_{{column}}.tif'.format(name))
+    results = [output_pattern.format(column=column) for column in columns]
+    run_stage(state, state_file, metrics, 'solve', [measurements_file, upstream_file], results,
+              {'columns': list(columns)},
+              lambda: solve(output_pattern, columns, measurements_file, upstream_file if index is None else index,
+                            results_cache_dir, workers, stage_metrics_file('results')))
+
+    zip_file = os.path.join(output_dir, '{}_sediments.zip'.format(name))
+    package_files = results + ([readme_file] if readme_file is not None else [])
+    run_stage(state, state_file, metrics, 'package', package_files, [zip_file], {},
+              lambda: package(zip_file, '{}_sediments'.format(name), package_files))
+
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", type=str, default='tellus', help="name of the dataset, used to name the output files")
+    parser.add_argument("--interim", type=str, help="path to directory for intermediate files", required=True)
+    parser.add_argument("--output", type=str, help="path to directory for output files", required=True)
+    parser.add_argument("--measurements", type=str, help="path to measurements csv file or measurement store directory, instead of merging inputs")
+    parser.add_argument("--inputs", type=str, nargs='+', help="paths to measurements csv files to be merged")
+    parser.add_argument("--ni1idx", type=int, help="index of Northern Ireland Set 1 in input list")
+    parser.add_argument("--ni2idx", type=int, help="index of Northern Ireland Set 2 in input list")
+    parser.add_argument("--niauandpgeidx", type=int, help="index of Northern Ireland Au and PGE in input list")
+    parser.add_argument("--measurements_epsg", type=int, default=29901, help="EPSG of measurements spatial reference")
+    parser.add_argument("--flow_directions", type=str, nargs='+', help="path to flow directions file, or paths to BIL flow directions tiles", required=True)
+    parser.add_argument("--columns", type=str, nargs='+', help="names of the columns to process (default: all substance columns)")
+    parser.add_argument("--readme", type=str, help="path to README file to include in the zipped results")
+    parser.add_argument("--single_pass", action="store_true", help="find the upstream cells of all rows in one pass over the flow directions")
+    parser.add_argument("--cache", type=str, help="path to catchment cache directory, to only trace samples in cells that have not been traced before")
+    parser.add_argument("--results_cache", type=str, help="path to result cache directory, to only solve for columns whose inputs have changed")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to trace catchments and solve for substances with")
+    parser.add_argument("--force", action="store_true", help="run every stage, even if its inputs have not changed")
+    parser.add_argument("--metrics_json", type=str, help="path to output JSON file of the time and memory used by each stage")
+    parser.add_argument("--profile", type=str, help="path to output cProfile statistics file")
+    args = parser.parse_args()
+    if (args.measurements is None) == (args.inputs is None):
+        parser.error('exactly one of --measurements and --inputs must be specified')
+    profile(args.profile, run, args.name, args.interim, args.output, args.flow_directions, args.measurements,
+            args.inputs, args.ni1idx, args.ni2idx, args.niauandpgeidx, args.measurements_epsg, args.columns,
+            args.readme, args.single_pass, args.cache, args.results_cache, args.workers, args.force, args.metrics_json)
@@ -0,0 +1,162 @@
+"""Keep the solution for each column on disk, so that columns whose inputs have
+not changed are not solved for again.
+
+The cache is a directory containing one file for each solution, <key>.npz, named
+by a hash of everything that the solution depends on (see column_key): the
+column's valid measurements and which rows they are in, the upstream index, the
+solver settings and the source code of the solver. Each file contains:
+    x: the solution
+    cells: the linear indices of the cells that x is for
+    result: the solver's status and history (as JSON)
+The latest directory contains a file for each column (named by a hash of the
+column's name) with the key of the column's last solution. When a column has
+changed, its last solution is used as the starting point for solving it again.
+Once the cache is larger than max_size bytes, the solutions that were used least
+recently are evicted.
+"""
+
+import os
+import json
+import time
+import hashlib
+from collections import namedtuple
+import numpy as np
+import solvers
+
+# Solutions are evicted once the cache is larger than this many bytes
+DEFAULT_MAX_SIZE = 1 << 30
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evicted'])
+
+def index_key(index):
+    """Return a hash of an upstream index's shape and cells.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([int(n) for n in index.shape]).encode())
+    digest.update(np.ascontiguousarray(index.indptr, dtype=np.int64))
+    digest.update(np.ascontiguousarray(index.cells, dtype=np.int64))
+    return digest.hexdigest()
+
+def source_key(modules):
+    """Return a hash of the source files of modules, so that solutions are not
+       used once the code that found them has changed.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+def column_key(values, mask, index_key, settings):
+    """Return a hash of a column's valid measurements (values), the rows that they
+       are in (where mask is True), the key of the upstream index (see index_key)
+       and the solver settings (a dictionary that can be written as JSON).
+       The values are hashed as 32 bit floats, as reading a CSV file does not
+       always give the last bit of the values that were written to it.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.packbits(np.asarray(mask, dtype=bool)))
+    digest.update(np.ascontiguousarray(values, dtype=np.float32))
+    digest.update(index_key.encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def entry_path(cache_dir, key):
+    """Return the path of the solution for key.
+    """
+    return os.path.join(cache_dir, key + '.npz')
+
+def latest_path(cache_dir, column):
+    """Return the path of the file containing the key of a column's last solution.
+    """
+    return os.path.join(cache_dir, 'latest', hashlib.sha256(column.encode()).hexdigest())
+
+def remap(x, from_cells, cells):
+    """Return the values x at the linear indices from_cells at the linear indices cells
+       instead, and whether each of cells is in from_cells (those that are not are zero).
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    if len(from_cells) == 0:
+        return np.zeros(len(cells)), np.zeros(len(cells), dtype=bool)
+    order = np.argsort(from_cells)
+    positions = np.minimum(np.searchsorted(from_cells, cells, sorter=order), len(order) - 1)
+    found = from_cells[order[positions]] == cells
+    return np.where(found, x[order[positions]], 0.0), found
+
+def load(cache_dir, key, cells, now=None):
+    """Return the solvers.SolverResult cached for key, with its solution at the linear
+       indices cells (in their order, which may differ from the order the solution
+       was saved in), or None if there is not one or it is not for the same cells.
+       The time that the solution was last used is set to now.
+    """
+    path = entry_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as entry:
+        x, found = remap(entry['x'], entry['cells'], cells)
+        num_cells = len(entry['cells'])
+        result = json.loads(str(entry['result']))
+    if num_cells != len(found) or not np.all(found):
+        return None
+    if now is None:
+        now = time.time()
+    os.utime(path, (now, now))
+    return solvers.SolverResult(x, result['history'], result['status'])
+
+def save(cache_dir, key, column, cells, result, now=None):
+    """Add the solution of a column, for the linear indices cells, to the cache,
+       and record it as the column's last solution.
+    """
+    for directory in (cache_dir, os.path.join(cache_dir, 'latest')):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    new_path = entry_path(cache_dir, key + '.new')
+    np.savez(new_path, x=result.x, cells=np.asarray(cells, dtype=np.int64),
+             result=json.dumps({'status': result.status, 'history': result.history}))
+    os.replace(new_path, entry_path(cache_dir, key))
+    if now is not None:
+        os.utime(entry_path(cache_dir, key), (now, now))
+    new_path = latest_path(cache_dir, column) + '.new'
+    with open(new_path, 'w') as latest_file:
+        latest_file.write(key)
+    os.replace(new_path, latest_path(cache_dir, column))
+
+def previous(cache_dir, column, cells):
+    """Return the last solution of a column at the linear indices cells, to use as
+       a starting point, or None if it is not in the cache. Cells that it is not
+       for are zero.
+    """
+    path = latest_path(cache_dir, column)
+    if not os.path.exists(path):
+        return None
+    with open(path) as latest_file:
+        path = entry_path(cache_dir, latest_file.read())
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as entry:
+        previous_x = entry['x']
+        previous_cells = entry['cells']
+    return remap(previous_x, previous_cells, cells)[0]
+
+def evict(cache_dir, max_size=DEFAULT_MAX_SIZE):
+    """Remove the solutions that were used least recently until the cache is no
+       larger than max_size bytes. Returns the number of solutions removed.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.npz') and not name.endswith('.new.npz'):
+            status = os.stat(path)
+            entries.append((status.st_mtime, status.st_size, path))
+    entries.sort()
+    size = sum(entry[1] for entry in entries)
+    evicted = 0
+    for _, entry_size, path in entries:
+        if size <= max_size:
+            break
+        os.remove(path)
+        size -= entry_size
+        evicted += 1
+    return evicted
@@ -1,43 +1,132 @@
 """Estimate the substance concentration in cells that are upstream from measurements.
 """
+import os
+import sys
+import json
+import time
 import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import gdal
-from scipy.sparse import csr_matrix
-from scipy.optimize import lsq_linear
-import pandas as pd
+from scipy.sparse import csr_matrix, csc_matrix
+from scipy.sparse.csgraph import connected_components
 import numpy as np
+import upstream_index
+import solvers
+import measurement_store
+import result_cache
+import catchment_operator
+from metrics import Metrics, profile
 
-def load_data(column, measurements_file, upstream_file, flow_directions_file):
-    """Load the input datasets, and extract the part that is relevant for the current substance.
+# Suffixes of the names of the columns that contain substance concentrations
+SUBSTANCE_UNITS = ('_%', '_mgkg', '_ugkg')
+
+# GeoTiff creation options for output files
+OUTPUT_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'SPARSE_OK=TRUE', 'BIGTIFF=IF_SAFER']
+
+# Overviews are added until they would be smaller than this in both dimensions
+OVERVIEW_MIN_SIZE = 256
+
+def load_index(upstream_file, flow_directions_file=None):
+    """Load the upstream index, and the geometry of the flow directions raster.
+       upstream_file may also be an upstream_index.UpstreamIndex that is already loaded.
+       The geometry is read from flow_directions_file if it is specified, and otherwise
+       from the index, so the flow directions are only needed for upstream .npy files
+       saved by older versions.
     """
-    measurements = pd.read_csv(measurements_file)[column].values
-    upstream = np.load(upstream_file)
+    loaded = isinstance(upstream_file, upstream_index.UpstreamIndex)
+    if flow_directions_file is None:
+        index = upstream_file if loaded else upstream_index.load(upstream_file)
+        geometry = upstream_index.geometry(index)
+        if geometry.geotransform is None:
+            raise ValueError('{} does not record the flow directions geometry, so the flow directions file must be specified'.format(
+                'the upstream index' if loaded else upstream_file))
+        return index, geometry
     flow_directions = gdal.Open(flow_directions_file)
+    geometry = upstream_index.RasterGeometry((flow_directions.RasterYSize, flow_directions.RasterXSize),
+                                             flow_directions.GetGeoTransform(), flow_directions.GetProjection())
+    index = upstream_file if loaded else upstream_index.load(upstream_file, shape=geometry.shape)
+    return index, geometry
 
-    valid_measurement_idxs = np.isfinite(measurements)
+def load_data(column, measurements_file, upstream_file, flow_directions_file=None, matrix_free=False):
+    """Load the input datasets, and extract the part that is relevant for the current substance.
+       The upstream index, and which of its rows have a valid measurement, are also returned.
+       If matrix_free is True, the coordinates of the upstream cells are not needed
+       (see build_operator), and None is returned instead of them.
+    """
+    measurements = measurement_store.read_columns(measurements_file, [column])[column].values.astype(float)
+    index, geometry = load_index(upstream_file, flow_directions_file)
+
+    valid_measurement_idxs = np.isfinite(measurements) & (upstream_index.row_lengths(index) > 0)
 
     measurements = measurements[valid_measurement_idxs]
-    upstream = upstream[valid_measurement_idxs]
-    return measurements, upstream, flow_directions
+    upstream = None
+    if not matrix_free:
+        upstream = [np.column_stack(np.unravel_index(cells, index.shape))
+                    for cells in upstream_index.select_rows(index, valid_measurement_idxs)]
+    return measurements, upstream, geometry, index, valid_measurement_idxs
+
+def find_substance_columns(columns):
+    """Return the columns that contain substance concentrations, identified by their units.
+    """
+    return [column for column in columns if column.endswith(SUBSTANCE_UNITS)]
+
+def load_all_data(columns, measurements_file, upstream_file, flow_directions_file=None, matrix_free=False):
+    """Load the input datasets for several substances at once.
+       If columns is None, all substance columns in the measurements file are used.
+       Unlike load_data, measurements and upstream are returned for every row,
+       as the valid rows differ between substances. The upstream index is also returned.
+       If matrix_free is True, None is returned instead of upstream, as in load_data.
+    """
+    if columns is None:
+        columns = find_substance_columns(measurement_store.column_names(measurements_file))
+    measurements = measurement_store.read_columns(measurements_file, columns).values.astype(float)
+    index, geometry = load_index(upstream_file, flow_directions_file)
+    # measurements without upstream cells are outside the flow directions raster
+    measurements[upstream_index.row_lengths(index) == 0] = np.nan
+    if matrix_free:
+        return columns, measurements, None, geometry, index
+
+    upstream = [np.column_stack(np.unravel_index(upstream_index.row_cells(index, i), index.shape))
+                for i in range(upstream_index.num_rows(index))]
+    return columns, measurements, upstream, geometry, index
+
+def select_measurements(A, full_coords, measurements):
+    """Extract the part of the system built from all rows that is relevant for one substance.
+       Rows without a valid measurement are removed, as are the cells
+       that are then no longer upstream of any measurement. The indices of the
+       remaining cells in the full system are also returned.
+    """
+    valid_measurement_idxs = np.isfinite(measurements)
+    if isinstance(A, catchment_operator.CatchmentOperator):
+        A, used_cells = A.select_rows(valid_measurement_idxs)
+    else:
+        A = A[valid_measurement_idxs]
+        used_cells = np.flatnonzero(np.bincount(A.indices, minlength=A.shape[1]))
+        A = A[:, used_cells]
+    full_coords = full_coords[used_cells]
+    return A, measurements[valid_measurement_idxs], full_coords, used_cells
+
+def flatten_upstream(upstream):
+    """Concatenate the coordinate pairs upstream of all measurements into one array.
+       Also return the number of coordinate pairs upstream of each measurement.
+    """
+    coords = [np.asarray(upstream_coords, dtype=np.int64).reshape(-1, 2) for upstream_coords in upstream]
+    lengths = np.array([len(upstream_coords) for upstream_coords in coords], dtype=np.int64)
+    if len(coords) > 0:
+        coords = np.concatenate(coords)
+    else:
+        coords = np.zeros([0, 2], dtype=np.int64)
+    return coords, lengths
 
-# two lists
 def find_min_max_nonzero_coords(upstream):
     """Find the min and max of the x and y coordinates in upstream.
     """
-    minx = np.inf
-    maxx = -np.inf
-    miny = np.inf
-    maxy = -np.inf
-    for _, upstream_coords in enumerate(upstream):
-        for coord in upstream_coords:
-            if coord[1] < minx:
-                minx = coord[1]
-            if coord[1] > maxx:
-                maxx = coord[1]
-            if coord[0] < miny:
-                miny = coord[0]
-            if coord[0] > maxy:
-                maxy = coord[0]
+    coords, _ = flatten_upstream(upstream)
+    if len(coords) == 0:
+        return np.inf, -np.inf, np.inf, -np.inf
+    miny, minx = coords.min(axis=0)
+    maxy, maxx = coords.max(axis=0)
     return minx, maxx, miny, maxy
 
 def find_nonzero_cells(upstream):
@@ -45,30 +134,33 @@ def find_nonzero_cells(upstream):
        Construct arrays to allow conversion between full and these reduced coordinates.
        Also return the number of nonzero entries that there will be in the
        A matrix so that this memory can be allocated in build_A.
+       Cells are numbered in the reduced system in the order in which they first
+       appear in upstream.
     """
-    minx, maxx, miny, maxy = find_min_max_nonzero_coords(upstream)
+    coords, _ = flatten_upstream(upstream)
+    minx, maxx, miny, maxy = find_min_max_nonzero_coords([coords])
     nx = maxx - minx + 1
     ny = maxy - miny + 1
     if not np.isfinite(nx):
         nx = 0
     if not np.isfinite(ny):
         ny = 0
+    nx = int(nx)
+    ny = int(ny)
+    # position of each cell in a 2D landscape that covers the cells to be solved for
+    local_idxs = np.zeros(len(coords), dtype=np.int64)
+    if len(coords) > 0:
+        local_idxs = (coords[:, 0] - miny) * nx + (coords[:, 1] - minx)
+    unique_idxs, first_idxs = np.unique(local_idxs, return_index=True)
+    order = np.argsort(first_idxs)
     # coordinate pairs of points in full 2D landscape that will be solved for
-    full_coords = []
+    full_coords = coords[first_idxs[order]]
     # a 2D landscape with cells that will be solved for containing their
     # index in the reduced-size system that will be solved
     # initialize to -1 to indicate that value has not been set
-    reduced_idxs = -1*np.ones([ny, nx], dtype=np.int)
-    reduced_idx = 0
-    num_nonzero = 0
-    for coords_upstream_of_measurement in upstream:
-        for coord in coords_upstream_of_measurement:
-            if reduced_idxs[coord[0] - miny, coord[1] - minx] < 0:
-                # point has not been added to the reduced system yet, so add it
-                full_coords.append(coord)
-                reduced_idxs[coord[0] - miny, coord[1] - minx] = reduced_idx
-                reduced_idx += 1
-            num_nonzero += 1
+    reduced_idxs = -1*np.ones([ny, nx], dtype=np.int64)
+    reduced_idxs.flat[unique_idxs[order]] = np.arange(len(order))
+    num_nonzero = len(coords)
     return full_coords, reduced_idxs, num_nonzero, minx, miny
 
 def build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny):
@@ -78,80 +170,647 @@ def build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny):
        column vector of the measurements.
        A is a sparse matrix to save memory.
     """
-    num_rows = len(upstream)
-    indices = np.zeros(num_nonzero, dtype=np.int)
-    indptr = np.zeros(num_rows+1, dtype=np.int)
-    Adata = np.ones(num_nonzero, dtype=np.float32)
-
-    nz_idx = 0
-    for row_idx in range(num_rows):
-        indptr[row_idx] = nz_idx
-        for coord in upstream[row_idx]:
-            reduced_idx = reduced_idxs[coord[0] - miny, coord[1] - minx]
-            indices[nz_idx] = reduced_idx
-            Adata[nz_idx] = 1.0/len(upstream[row_idx])
-            nz_idx += 1
-    assert(nz_idx == num_nonzero)
-    indptr[-1] = nz_idx
+    coords, lengths = flatten_upstream(upstream)
+    num_rows = len(lengths)
+    assert(len(coords) == num_nonzero)
+    indices = np.zeros(num_nonzero, dtype=np.int64)
+    if num_nonzero > 0:
+        indices = reduced_idxs[coords[:, 0] - miny, coords[:, 1] - minx]
+    indptr = np.zeros(num_rows+1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    Adata = np.repeat((1.0/np.maximum(lengths, 1)).astype(np.float32), lengths)
     A = csr_matrix((Adata, indices, indptr), shape=(num_rows, len(full_coords)))
 
     return A
 
-def solve(A, b, full_coords, flow_directions, max_iter=4):
+def build_operator(index, mask):
+    """Form a CatchmentOperator that multiplies by the A matrix of the rows of index
+       where mask is True (the matrix that find_nonzero_cells and build_A form from
+       their upstream coordinates) without storing it. Also returns the coordinates of
+       the cells, which are ordered so that each row's cells are contiguous (see
+       catchment_operator.order_cells).
+    """
+    cells, starts, stops = catchment_operator.order_cells(index, mask)
+    full_coords = np.column_stack(np.unravel_index(cells, index.shape))
+    return catchment_operator.CatchmentOperator(starts, stops, len(cells)), full_coords
+
+def check_matrix_free(solver_options, decompose):
+    """Raise a ValueError if the solver options need the A matrix itself, rather than
+       only multiplication by it, so cannot be used with build_operator.
+    """
+    solver_options = solver_options or {}
+    if decompose or solver_options.get('collapse') or solver_options.get('levels', 1) > 1:
+        raise ValueError('decompose, collapse and levels need the A matrix, so cannot be used without forming it')
+
+def collapse_columns(A):
+    """Merge the cells that are upstream of exactly the same measurements.
+       The columns of A for these cells are identical, so the measurements cannot
+       distinguish between the cells' concentrations and they may be solved for as one.
+       Returns a matrix with one column for each group of such cells, equal to the sum
+       of the group's columns, and the index of the group that each cell belongs to.
+       Cells are grouped using two random hashes of the rows in their columns, so
+       the probability of incorrectly grouping cells is negligible.
+    """
+    A = csc_matrix(A)
+    num_cells = A.shape[1]
+    counts = np.diff(A.indptr)
+    rng = np.random.RandomState(0)
+    signatures = [counts.astype(np.uint64)]
+    for _ in range(2):
+        row_hashes = rng.randint(0, np.iinfo(np.int64).max, size=A.shape[0], dtype=np.int64).astype(np.uint64)
+        column_hashes = np.zeros(num_cells, dtype=np.uint64)
+        nonempty = counts > 0
+        if A.nnz > 0:
+            column_hashes[nonempty] = np.add.reduceat(row_hashes[A.indices], A.indptr[:-1][nonempty])
+        signatures.append(column_hashes)
+    _, groups = np.unique(np.column_stack(signatures), axis=0, return_inverse=True)
+    groups = groups.ravel()
+    return merge_columns(A, groups), groups
+
+def merge_columns(A, groups):
+    """Return a matrix with one column for each group of A's columns, equal to the sum
+       of the group's columns, so that (merged A) @ x == A @ x[groups].
+    """
+    num_cells = A.shape[1]
+    num_groups = groups.max() + 1 if num_cells > 0 else 0
+    P = csr_matrix((np.ones(num_cells, dtype=A.dtype), (np.arange(num_cells), groups)),
+                   shape=(num_cells, num_groups))
+    return csr_matrix(A @ P)
+
+def group_means(x, groups, num_groups):
+    """Return the mean of x in each group (the starting point of a system with merged columns).
+    """
+    group_sizes = np.bincount(groups, minlength=num_groups)
+    return np.bincount(groups, weights=np.nan_to_num(x), minlength=num_groups) / np.maximum(group_sizes, 1)
+
+def solve_values(A, b, x0=None, coords=None, method='lsq_linear', max_iter=None, tol=None, collapse=False, levels=1):
+    """Solve Ax=b for the substance concentration in each cell of the reduced system.
+       A solver that keeps the output non-negative is used (negative substance
+       concentration is not allowed), chosen by method from solvers.SOLVERS.
+       x0, if specified, is used as the starting point.
+       If collapse is True, cells that are upstream of the same measurements are
+       solved for together (see collapse_columns).
+       If levels is more than 1, the system is first solved on coarser grids (see
+       solve_multigrid), which needs the coordinates of the cells, coords, and a
+       method other than lsq_linear.
+       Returns a solvers.SolverResult.
+    """
+    if len(b) == 0:
+        return solvers.SolverResult(solvers.starting_point(A, x0), [], 'converged')
+    if levels > 1:
+        if method == 'lsq_linear':
+            raise ValueError('lsq_linear does not start from the solution of the coarser level, so solving on more than '
+                             'one level only adds time; use another method, such as projected_gradient')
+        if coords is None:
+            raise ValueError('the coordinates of the cells are needed to solve on more than one level')
+        return solve_multigrid(A, b, coords, x0, levels, method=method, max_iter=max_iter, tol=tol, collapse=collapse)
+    if collapse:
+        A, groups = collapse_columns(A)
+        if x0 is not None:
+            x0 = group_means(x0, groups, A.shape[1])
+    result = solvers.solve(A, b, method, x0, tol, max_iter)
+    if collapse:
+        return result._replace(x=result.x[groups])
+    return result
+
+def coarsen(coords, factor):
+    """Group the cells at coords into the cells of a grid that is factor times coarser.
+       Returns the coarse cell of each cell, and the number of coarse cells.
+    """
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2) // factor
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    keys = coords[:, 0] * (coords[:, 1].max() + 1) + coords[:, 1]
+    coarse_keys, groups = np.unique(keys, return_inverse=True)
+    return groups.ravel(), len(coarse_keys)
+
+def solve_multigrid(A, b, coords, x0=None, levels=3, max_iter=None, **solver_options):
+    """Solve Ax=b on a sequence of grids, from coarse to fine.
+       On level l the cells at coords are merged into the cells of a grid that is
+       2**l times coarser, so level 0 is the flow directions grid. The system is solved
+       on the coarsest level first (starting from x0, if specified), and the solution of
+       each level is used as the starting point on the next finer level. The coarse
+       systems are small, so they are given 2**l times max_iter iterations (if it is
+       specified), and the iterations on the fine grid start close to the solution.
+       This needs a solver that starts from the starting point, such as projected_gradient;
+       lsq_linear only uses it to shift its bounds, so it is not accepted (see solve_values).
+       For the same number of nonzeros multiplied by, this reaches a lower residual than
+       solving on one level, but on small systems, where each iteration's time is mostly
+       overhead, it takes longer (see benchmark.compare_levels).
+       The history contains the records of every level, in the order they were solved,
+       with the level and its number of unknowns and nonzeros added, and times from the start of
+       the first level. solver_options are passed to solve_values.
+    """
+    start_time = time.perf_counter()
+    history = []
+    x = x0
+    for level in range(levels - 1, -1, -1):
+        A_level = A
+        x0_level = x
+        if level > 0:
+            groups, num_groups = coarsen(coords, 2**level)
+            A_level = merge_columns(A, groups)
+            x0_level = None if x is None else group_means(x, groups, num_groups)
+        solver_start = time.perf_counter() - start_time
+        result = solve_values(A_level, b, x0_level, max_iter=None if max_iter is None else max_iter * 2**level,
+                              **solver_options)
+        x = result.x[groups] if level > 0 else result.x
+        history.extend(dict(record, level=level, unknowns=len(result.x), nnz=A_level.nnz,
+                            time=solver_start + record['time'])
+                       for record in result.history)
+    return result._replace(x=x, history=history)
+
+def level_summary(history):
+    """Return the number of unknowns, nonzeros, iterations and final residual of each level of
+       a history returned by solve_multigrid, and the time from the end of the previous
+       level to the end of the level (including merging the columns of A).
+    """
+    levels = []
+    start = 0.0
+    for i, record in enumerate(history):
+        if i + 1 == len(history) or history[i + 1]['level'] != record['level']:
+            levels.append({'level': record['level'], 'unknowns': record['unknowns'], 'nnz': record['nnz'],
+                           'iterations': record['iteration'],
+                           'residual': record['residual'], 'time': record['time'] - start})
+            start = record['time']
+    return levels
+
+def find_components(A):
+    """Find the groups of measurements and cells that are linked by A (in separate
+       drainage basins, for example), as the connected components of the graph with
+       an edge between each measurement and each cell upstream of it.
+       Returns the number of components and the component of each row and column of A.
+    """
+    A = csr_matrix(A)
+    num_rows, num_cells = A.shape
+    rows = np.repeat(np.arange(num_rows), np.diff(A.indptr))
+    graph = csr_matrix((np.ones(A.nnz, dtype=np.int8), (rows, num_rows + A.indices)),
+                       shape=(num_rows + num_cells, num_rows + num_cells))
+    num_components, labels = connected_components(graph, directed=False)
+    return num_components, labels[:num_rows], labels[num_rows:]
+
+def split_components(A, b, x0=None, coords=None):
+    """Split Ax=b into independent systems, one for each component (see find_components).
+       Returns a list of (A, b, x0, coords, cells) for the components, where cells are
+       the columns of A that the component's system solves for, and x0 and coords
+       are those of the cells (or None if they were not specified).
+    """
+    num_components, row_labels, column_labels = find_components(A)
+    row_order = np.argsort(row_labels, kind='stable')
+    column_order = np.argsort(column_labels, kind='stable')
+    row_ptr = np.searchsorted(row_labels[row_order], np.arange(num_components + 1))
+    column_ptr = np.searchsorted(column_labels[column_order], np.arange(num_components + 1))
+    # Once the rows and columns are ordered by component, each component's rows
+    # only contain the component's columns, so its block can be sliced out of A
+    A = csr_matrix(A)[row_order][:, column_order]
+    components = []
+    for component in range(num_components):
+        rows = A[row_ptr[component]:row_ptr[component+1]]
+        cells = column_order[column_ptr[component]:column_ptr[component+1]]
+        A_component = csr_matrix((rows.data, rows.indices - column_ptr[component], rows.indptr),
+                                 shape=(rows.shape[0], len(cells)))
+        components.append((A_component, b[row_order[row_ptr[component]:row_ptr[component+1]]],
+                           None if x0 is None else np.asarray(x0)[cells],
+                           None if coords is None else np.asarray(coords)[cells], cells))
+    return components
+
+def component_record(A, b, x, iteration, solver_time, num_components):
+    """Return the history record (see solvers) of a system solved in num_components components.
+    """
+    residual_norm = float(np.linalg.norm(A @ x - b))
+    return {'iteration': iteration, 'residual': residual_norm, 'cost': 0.5 * residual_norm**2,
+            'time': solver_time, 'components': num_components}
+
+def combine_results(A, b, x0, components, results):
+    """Combine the SolverResults of the components of Ax=b into one SolverResult.
+       Its history contains the residual of the whole system before and after
+       solving, the largest number of iterations of any component, the total time
+       taken by the components' solvers and the number of components. Its status
+       is the worst of the components' statuses.
+    """
+    x = np.zeros(A.shape[1])
+    for (_, _, _, _, cells), result in zip(components, results):
+        x[cells] = result.x
+    histories = [result.history for result in results if result.history]
+    iterations = max([history[-1]['iteration'] for history in histories], default=0)
+    solver_time = sum(history[-1]['time'] for history in histories)
+    history = [component_record(A, b, solvers.starting_point(A, x0), 0, 0.0, len(components)),
+               component_record(A, b, x, iterations, solver_time, len(components))]
+    statuses = set(result.status for result in results)
+    status = 'failed' if 'failed' in statuses else 'max_iter' if 'max_iter' in statuses else 'converged'
+    return solvers.SolverResult(x, history, status)
+
+def solve_components(systems, workers=1, **solver_options):
+    """Solve each of a list of systems (A, b, x0, coords) by splitting it into its components
+       (see split_components), which are solved for separately with solve_values.
+       The components of all of the systems are solved for by workers processes, the
+       largest first, so that the processes finish at about the same time.
+       Returns a SolverResult for each system (see combine_results).
+       solver_options are passed to solve_values.
+    """
+    split_systems = [split_components(A, b, x0, coords) for A, b, x0, coords in systems]
+    components = [component for split_system in split_systems for component in split_system]
+    solve_component = partial(solve_values, **solver_options)
+    if workers > 1:
+        order = np.argsort([-component[0].nnz for component in components], kind='stable')
+        results = [None] * len(components)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for i, result in zip(order, executor.map(solve_component, [components[i][0] for i in order],
+                                                     [components[i][1] for i in order],
+                                                     [components[i][2] for i in order],
+                                                     [components[i][3] for i in order])):
+                results[i] = result
+    else:
+        results = [solve_component(A, b, x0, coords) for A, b, x0, coords, _ in components]
+    combined = []
+    start = 0
+    for (A, b, x0, _), split_system in zip(systems, split_systems):
+        combined.append(combine_results(A, b, x0, split_system, results[start:start+len(split_system)]))
+        start += len(split_system)
+    return combined
+
+def solve_decomposed(A, b, x0=None, coords=None, workers=1, **solver_options):
+    """Solve one system by splitting it into its components (see solve_components).
+    """
+    return solve_components([(A, b, x0, coords)], workers, **solver_options)[0]
+
+def solve(A, b, full_coords, x0=None, decompose=False, workers=1, **solver_options):
     """Solve for the substance concentration.
-       The lsq_linear solver is used so that a lower bound of 0 can be set on the
-       output (negative substance concentration is not allowed).
-       The flow_directions file, which was used to generate the coordinates in upstream,
-       is used to find the size of the 2D output, allowing the results to be
-       converted from reduced coordinates to the full 2D array.
-    """
-    if len(b) > 0:
-        res = lsq_linear(A, b, bounds=(0.0, np.inf), verbose=2, lsmr_tol='auto', max_iter=max_iter)
-        res = res.x
+       The solution is returned in a 2D array covering the window of the landscape
+       that contains the cells that were solved for (see grid_values), together
+       with the window's offset and the solver's SolverResult.
+       If decompose is True, the system is split into independent components
+       (see solve_components), which are solved for by workers processes.
+       solver_options are passed to solve_values.
+    """
+    if decompose:
+        result = solve_decomposed(A, b, x0, full_coords, workers, **solver_options)
     else:
-        res = []
-    nx = flow_directions.RasterXSize
-    ny = flow_directions.RasterYSize
-    x = np.nan * np.ones([ny, nx], dtype=np.float32)
-    for reduced_idx, value in enumerate(res):
-        full_coord = full_coords[reduced_idx]
-        x[full_coord[0], full_coord[1]] = value
-    return x
-
-def write_output(x, output_file, flow_directions):
-    """Write the output substance concentration map to the specified file in GeoTiff format.
-       The flow_directions file is used as a prototype for the output file, with the
-       differences being a different datatype and NoData value.
+        result = solve_values(A, b, x0, full_coords, **solver_options)
+    x, offset = grid_values(result.x, full_coords)
+    return x, offset, result
+
+def read_warm_start(warm_start_file, full_coords):
+    """Read the values at full_coords from a previous output file, to use as a starting point.
+       Only the window of the file containing full_coords is read.
+    """
+    full_coords = np.asarray(full_coords, dtype=np.int64).reshape(-1, 2)
+    if len(full_coords) == 0:
+        return np.zeros(0)
+    miny, minx = full_coords.min(axis=0)
+    maxy, maxx = full_coords.max(axis=0)
+    dataset = gdal.Open(warm_start_file)
+    window = dataset.GetRasterBand(1).ReadAsArray(int(minx), int(miny), int(maxx - minx + 1), int(maxy - miny + 1))
+    return np.nan_to_num(window[full_coords[:, 0] - miny, full_coords[:, 1] - minx].astype(float))
+
+def cell_indices(full_coords, shape):
+    """Return the linear indices of the cells at full_coords in a raster of the given shape.
+    """
+    full_coords = np.asarray(full_coords, dtype=np.int64).reshape(-1, 2)
+    return np.ravel_multi_index((full_coords[:, 0], full_coords[:, 1]), shape)
+
+def cache_settings(solver_options, decompose, matrix_free):
+    """Return the settings and source code that a solution depends on, which are
+       part of its key in the result cache (see result_cache.column_key).
+    """
+    return dict(solver_options or {}, decompose=decompose, matrix_free=matrix_free,
+                source=result_cache.source_key([sys.modules[__name__], solvers, catchment_operator]))
+
+def report_cache(metrics, stats):
+    """Print and record the hits, misses and evictions of the result cache.
+    """
+    print('result cache: {} hits, {} misses, {} evicted'.format(stats.hits, stats.misses, stats.evicted),
+          file=sys.stderr)
+    metrics.count(cache_hits=stats.hits, cache_misses=stats.misses, cache_evicted=stats.evicted)
+
+def write_solver_log(solver_log, results):
+    """Write the status and history of the solver for each column to a JSON file.
+    """
+    with open(solver_log, 'w') as log_file:
+        json.dump({column: {'status': result.status, 'history': result.history}
+                   for column, result in results.items()}, log_file, indent=1)
+
+def grid_values(res, full_coords):
+    """Convert the solution from reduced coordinates to a 2D array.
+       Only the window of the landscape that contains full_coords is stored, so
+       the memory required depends on the area solved for rather than on the size
+       of the flow directions raster. The (x, y) offset of the window in the
+       flow directions raster is also returned.
+    """
+    full_coords = np.asarray(full_coords, dtype=np.int64).reshape(-1, 2)
+    if len(full_coords) == 0:
+        return np.zeros([0, 0], dtype=np.float32), (0, 0)
+    miny, minx = full_coords.min(axis=0)
+    maxy, maxx = full_coords.max(axis=0)
+    x = np.nan * np.ones([maxy - miny + 1, maxx - minx + 1], dtype=np.float32)
+    x[full_coords[:, 0] - miny, full_coords[:, 1] - minx] = res
+    return x, (int(minx), int(miny))
+
+def create_output(output_file, geometry, num_bands=1):
+    """Create a GeoTiff file for output substance concentration maps.
+       The output file is on the same grid as the flow directions (described by
+       geometry, an upstream_index.RasterGeometry), with float values and NaN as NoData.
+       The file is tiled and compressed, and blocks that are never written (those that
+       do not contain any cells that were solved for) are not stored.
     """
     driver = gdal.GetDriverByName('GTiff')
-    nx = flow_directions.RasterXSize
-    ny = flow_directions.RasterYSize
-    dataset = driver.Create(output_file, nx, ny, 1, gdal.GDT_Float32)
-    dataset.SetGeoTransform(flow_directions.GetGeoTransform())
-    dataset.SetProjection(flow_directions.GetProjection())
-    band = dataset.GetRasterBand(1)
-    band.SetNoDataValue(np.nan)
-    band.WriteArray(x)
+    ny, nx = geometry.shape
+    dataset = driver.Create(output_file, nx, ny, num_bands, gdal.GDT_Float32, OUTPUT_OPTIONS)
+    dataset.SetGeoTransform(geometry.geotransform)
+    dataset.SetProjection(geometry.projection)
+    for band_idx in range(num_bands):
+        dataset.GetRasterBand(band_idx + 1).SetNoDataValue(np.nan)
+    return dataset
+
+def write_window(band, x, offset):
+    """Write x into band, with its top left corner at offset, one row of blocks at a time.
+    """
+    block_rows = band.GetBlockSize()[1]
+    for row in range(0, x.shape[0], block_rows):
+        band.WriteArray(x[row:row+block_rows], offset[0], offset[1] + row)
+
+def build_overviews(dataset):
+    """Add reduced resolution versions of the output, to speed up viewing it.
+    """
+    levels = []
+    level = 2
+    while max(dataset.RasterXSize, dataset.RasterYSize) // level >= OVERVIEW_MIN_SIZE:
+        levels.append(level)
+        level *= 2
+    if levels:
+        dataset.BuildOverviews('AVERAGE', levels)
+
+def write_output(x, output_file, geometry, offset=(0, 0)):
+    """Write the output substance concentration map to the specified file in GeoTiff format.
+       x may be a window of the landscape, with its top left corner at offset
+       (as returned by solve).
+    """
+    dataset = create_output(output_file, geometry)
+    write_window(dataset.GetRasterBand(1), x, offset)
+    build_overviews(dataset)
     dataset = None
 
-def run(output_file, column, measurements_file, upstream_file, flow_directions_file):
-    """Main driver.
+def count_column(metrics, column, num_unknowns, nnz, b, result):
+    """Record the size of a column's system (its number of unknowns, and of nonzero
+       values in A) and how the solver did in metrics.
     """
-    measurements, upstream, flow_directions = load_data(column, measurements_file, upstream_file, flow_directions_file)
-    full_coords, reduced_idxs, num_nonzero, minx, miny = find_nonzero_cells(upstream)
+    metrics.count('columns', column, samples=len(b), unknowns=num_unknowns, nnz=nnz,
+                  iterations=result.history[-1]['iteration'] if result.history else 0,
+                  solver_time=result.history[-1]['time'] if result.history else 0.0,
+                  components=result.history[-1].get('components', 1) if result.history else 0,
+                  status=result.status)
+    if result.history and 'level' in result.history[-1]:
+        metrics.count('columns', column, levels=level_summary(result.history))
 
-    A = build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+def run(output_file, column, measurements_file, upstream_file, flow_directions_file=None, solver_options=None,
+        warm_start_file=None, solver_log=None, metrics_file=None, decompose=False, workers=1, cache_dir=None,
+        cache_max_size=result_cache.DEFAULT_MAX_SIZE, matrix_free=False):
+    """Main driver.
+       solver_options are passed to solve_values. If decompose is True, the system is
+       split into independent components that are solved for by workers processes
+       (see solve_components). If warm_start_file is specified,
+       the solution in it (such as the output of a previous run) is used as the
+       starting point. If solver_log is specified, the solver's history is written to it.
+       If cache_dir is specified, the solution is kept in a result cache there (see
+       result_cache), and is not solved for again while the column's measurements,
+       the upstream index and the solver settings are unchanged. Otherwise the column's
+       previous solution in the cache (if any) is the starting point, unless
+       warm_start_file is specified. Solutions are evicted once the cache is larger
+       than cache_max_size bytes.
+       If matrix_free is True, A is not formed, and the solver only multiplies by it
+       (see build_operator), which needs much less memory.
+       If metrics_file is specified, the time and memory used by each stage are written to it.
+    """
+    if matrix_free:
+        check_matrix_free(solver_options, decompose)
+    metrics = Metrics()
+    with metrics.stage('load'):
+        measurements, upstream, geometry, index, valid_measurement_idxs = load_data(column, measurements_file, upstream_file,
+                                                                                   flow_directions_file, matrix_free)
+    if matrix_free:
+        with metrics.stage('build_A'):
+            A, full_coords = build_operator(index, valid_measurement_idxs)
+        num_nonzero = A.nnz
+    else:
+        with metrics.stage('reduce'):
+            full_coords, reduced_idxs, num_nonzero, minx, miny = find_nonzero_cells(upstream)
     b = measurements
 
-    x = solve(A, b, full_coords, flow_directions)
-    write_output(x, output_file, flow_directions)
+    # A is only built if the solution is not in the cache
+    result = None
+    if cache_dir is not None:
+        with metrics.stage('cache'):
+            key = result_cache.column_key(measurements, valid_measurement_idxs, result_cache.index_key(index),
+                                          cache_settings(solver_options, decompose, matrix_free))
+            result = result_cache.load(cache_dir, key, cell_indices(full_coords, index.shape))
+    cached = result is not None
+    if cached:
+        x, offset = grid_values(result.x, full_coords)
+    else:
+        x0 = None
+        if warm_start_file is not None:
+            with metrics.stage('load', file=warm_start_file):
+                x0 = read_warm_start(warm_start_file, full_coords)
+        elif cache_dir is not None:
+            x0 = result_cache.previous(cache_dir, column, cell_indices(full_coords, index.shape))
+
+        if not matrix_free:
+            with metrics.stage('build_A'):
+                A = build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+
+        with metrics.stage('solve', column=column):
+            x, offset, result = solve(A, b, full_coords, x0, decompose, workers, **(solver_options or {}))
+    if cache_dir is not None:
+        with metrics.stage('cache'):
+            evicted = 0
+            if not cached:
+                result_cache.save(cache_dir, key, column, cell_indices(full_coords, index.shape), result)
+                evicted = result_cache.evict(cache_dir, cache_max_size)
+        report_cache(metrics, result_cache.CacheStats(int(cached), int(not cached), evicted))
+    with metrics.stage('write', column=column):
+        write_output(x, output_file, geometry, offset)
+    if solver_log is not None:
+        write_solver_log(solver_log, {column: result})
+    count_column(metrics, column, len(full_coords), num_nonzero, b, result)
+    metrics.count('columns', column, cached=cached)
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+
+def run_columns(output_pattern, columns, measurements_file, upstream_file, flow_directions_file=None, workers=1, multiband_file=None,
+                solver_options=None, warm_start_pattern=None, warm_start_column=None, solver_log=None, metrics_file=None,
+                decompose=False, cache_dir=None, cache_max_size=result_cache.DEFAULT_MAX_SIZE, matrix_free=False):
+    """Driver for processing several substances at once.
+       The inputs are loaded and the A matrix is built once, using all rows, and then the
+       rows and cells that are relevant for each substance are extracted from it.
+       The substances are solved for concurrently using workers processes. If decompose
+       is True, the system of each substance is split into independent components,
+       and the components of all of the substances are shared between the processes
+       (see solve_components).
+       The output for each column is written to output_pattern.format(column=column),
+       unless output_pattern is None, and/or to a band of multiband_file.
+       Each column may be warm started from warm_start_pattern.format(column=column), if
+       that file exists, or else from the solution for warm_start_column (which is solved
+       for first), scaled by the ratio of the columns' mean measurements.
+       If cache_dir is specified, the solution for each column is kept in a result
+       cache there (see run), so only the columns whose measurements have changed
+       are solved for again, starting from their previous solutions unless they are
+       warm started.
+       If matrix_free is True, A is not formed (see run).
+       If metrics_file is specified, the time and memory used by each stage (and the
+       time each column's solver took) are written to it.
+    """
+    if matrix_free:
+        check_matrix_free(solver_options, decompose)
+    metrics = Metrics()
+    with metrics.stage('load'):
+        columns, measurements, upstream, geometry, index = load_all_data(columns, measurements_file, upstream_file,
+                                                                         flow_directions_file, matrix_free)
+    if output_pattern is not None and len(columns) > 1 and '{column}' not in output_pattern:
+        raise ValueError('output must contain {column} when processing more than one column')
+    if matrix_free:
+        with metrics.stage('build_A'):
+            A, full_coords = build_operator(index, np.ones(upstream_index.num_rows(index), dtype=bool))
+    else:
+        with metrics.stage('reduce'):
+            full_coords, reduced_idxs, num_nonzero, minx, miny = find_nonzero_cells(upstream)
+
+        with metrics.stage('build_A'):
+            A = build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+
+    with metrics.stage('select'):
+        problems = [select_measurements(A, full_coords, measurements[:, i]) for i in range(len(columns))]
+    x0s = [None] * len(columns)
+    results = [None] * len(columns)
+    solve_column = partial(solve_values, **(solver_options or {}))
+    if decompose:
+        solve_column = partial(solve_decomposed, workers=workers, **(solver_options or {}))
+
+    if cache_dir is not None:
+        with metrics.stage('cache'):
+            index_key = result_cache.index_key(index)
+            settings = cache_settings(solver_options, decompose, matrix_free)
+            keys = [result_cache.column_key(measurements[np.isfinite(measurements[:, i]), i],
+                                            np.isfinite(measurements[:, i]), index_key, settings)
+                    for i in range(len(columns))]
+            results = [result_cache.load(cache_dir, key, cell_indices(problems[i][2], index.shape))
+                       for i, key in enumerate(keys)]
+            for i, column in enumerate(columns):
+                if results[i] is None:
+                    x0s[i] = result_cache.previous(cache_dir, column, cell_indices(problems[i][2], index.shape))
+    cached = [result is not None for result in results]
+
+    if warm_start_column is not None:
+        sibling = columns.index(warm_start_column)
+        A_sibling, b_sibling, sibling_coords, sibling_cells = problems[sibling]
+        if results[sibling] is None:
+            with metrics.stage('solve', column=warm_start_column):
+                results[sibling] = solve_column(A_sibling, b_sibling, x0s[sibling], sibling_coords)
+        x_sibling = np.zeros(A.shape[1])
+        x_sibling[sibling_cells] = results[sibling].x
+        for i, (_, b, _, column_cells) in enumerate(problems):
+            if results[i] is None and len(b) > 0 and np.mean(b_sibling) > 0:
+                x0s[i] = x_sibling[column_cells] * np.mean(b) / np.mean(b_sibling)
+
+    if warm_start_pattern is not None:
+        for i, column in enumerate(columns):
+            warm_start_file = warm_start_pattern.format(column=column)
+            if os.path.exists(warm_start_file):
+                x0s[i] = read_warm_start(warm_start_file, problems[i][2])
+
+    remaining = [i for i in range(len(columns)) if results[i] is None]
+    if decompose:
+        with metrics.stage('solve', workers=workers):
+            remaining_results = solve_components([(problems[i][0], problems[i][1], x0s[i], problems[i][2]) for i in remaining],
+                                                 workers, **(solver_options or {}))
+        for i, result in zip(remaining, remaining_results):
+            results[i] = result
+    elif workers > 1:
+        with metrics.stage('solve', workers=workers):
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                remaining_results = list(executor.map(solve_column, [problems[i][0] for i in remaining],
+                                                      [problems[i][1] for i in remaining],
+                                                      [x0s[i] for i in remaining],
+                                                      [problems[i][2] for i in remaining]))
+        for i, result in zip(remaining, remaining_results):
+            results[i] = result
+    else:
+        for i in remaining:
+            with metrics.stage('solve', column=columns[i]):
+                results[i] = solve_column(problems[i][0], problems[i][1], x0s[i], problems[i][2])
+
+    if cache_dir is not None:
+        with metrics.stage('cache'):
+            for i, column in enumerate(columns):
+                if not cached[i]:
+                    result_cache.save(cache_dir, keys[i], column, cell_indices(problems[i][2], index.shape), results[i])
+            evicted = result_cache.evict(cache_dir, cache_max_size)
+        report_cache(metrics, result_cache.CacheStats(sum(cached), len(columns) - sum(cached), evicted))
+
+    if multiband_file is not None:
+        multiband = create_output(multiband_file, geometry, len(columns))
+
+    for band_idx, (column, (A_column, b, column_coords, _), result) in enumerate(zip(columns, problems, results)):
+        with metrics.stage('write', column=column):
+            x, offset = grid_values(result.x, column_coords)
+            if output_pattern is not None:
+                write_output(x, output_pattern.format(column=column), geometry, offset)
+            if multiband_file is not None:
+                band = multiband.GetRasterBand(band_idx + 1)
+                band.SetDescription(column)
+                write_window(band, x, offset)
+        count_column(metrics, column, A_column.shape[1], A_column.nnz, b, result)
+        metrics.count('columns', column, cached=cached[band_idx])
+
+    if multiband_file is not None:
+        with metrics.stage('write', file=multiband_file):
+            build_overviews(multiband)
+        multiband = None
+
+    if solver_log is not None:
+        write_solver_log(solver_log, dict(zip(columns, results)))
+    metrics.count(samples=len(measurements), unknowns=A.shape[1], nnz=A.nnz)
+    if metrics_file is not None:
+        metrics.write(metrics_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--output", type=str, help="path to output file", required=True)
-    parser.add_argument("--column", type=str, help="name of column in CSV file to process", required=True)
-    parser.add_argument("--measurements", type=str, help="path to measurements csv file", required=True)
-    parser.add_argument("--upstream", type=str, help="path to upstream npy file", required=True)
-    parser.add_argument("--flow_directions", type=str, help="path to flow directions file", required=True)
+    parser.add_argument("--output", type=str, help="path to output file (containing {column} if processing more than one column)")
+    parser.add_argument("--multiband_output", type=str, help="path to output file with one band for each column")
+    column_group = parser.add_mutually_exclusive_group(required=True)
+    column_group.add_argument("--column", type=str, help="name of column in CSV file to process")
+    column_group.add_argument("--columns", type=str, nargs='+', help="names of columns in CSV file to process")
+    column_group.add_argument("--all_columns", action="store_true", help="process all substance columns in CSV file")
+    parser.add_argument("--measurements", type=str, help="path to measurements csv file or measurement store directory", required=True)
+    parser.add_argument("--upstream", type=str, help="path to upstream index directory (or npy file)", required=True)
+    parser.add_argument("--flow_directions", type=str, help="path to flow directions file (only needed for upstream npy files)")
+    parser.add_argument("--workers", type=int, default=1, help="number of columns (or components, with --decompose) to solve for concurrently")
+    parser.add_argument("--decompose", action="store_true", help="split the system into independent drainage basins that are solved for separately")
+    parser.add_argument("--matrix_free", action="store_true", help="multiply by the A matrix without forming it, to use less memory (not with --decompose, --collapse or --levels)")
+    parser.add_argument("--collapse", action="store_true", help="solve for cells that are upstream of the same measurements together")
+    parser.add_argument("--solver", type=str, default='lsq_linear', choices=sorted(solvers.SOLVERS), help="bounded least squares solver to use")
+    parser.add_argument("--max_iter", type=int, help="maximum number of solver iterations (on each level)")
+    parser.add_argument("--levels", type=int, default=1, help="number of grid levels to solve on, from coarse to fine, each twice as fine as the last (not with --solver=lsq_linear)")
+    parser.add_argument("--tol", type=float, help="solver tolerance")
+    parser.add_argument("--warm_start", type=str, help="path to a previous output file (containing {column} if processing more than one column) to start from")
+    parser.add_argument("--warm_start_column", type=str, help="name of column to solve for first and start the other columns from")
+    parser.add_argument("--solver_log", type=str, help="path to output JSON file of solver history")
+    parser.add_argument("--cache", type=str, help="path to result cache directory, to only solve for columns whose inputs have changed")
+    parser.add_argument("--cache_max_size", type=float, default=result_cache.DEFAULT_MAX_SIZE / 2**20, help="size in MiB above which the least recently used solutions are removed from the cache")
+    parser.add_argument("--metrics_json", type=str, help="path to output JSON file of the time and memory used by each stage")
+    parser.add_argument("--profile", type=str, help="path to output cProfile statistics file")
     args = parser.parse_args()
-    run(args.output, args.column, args.measurements, args.upstream, args.flow_directions)
+    if args.output is None and (args.column or args.multiband_output is None):
+        parser.error('--output is required unless --multiband_output is used with --columns or --all_columns')
+    if args.levels > 1 and args.solver == 'lsq_linear':
+        parser.error('--levels needs a solver that starts from the coarser level\'s solution, such as --solver=projected_gradient')
+    solver_options = {'method': args.solver, 'max_iter': args.max_iter, 'tol': args.tol, 'collapse': args.collapse,
+                      'levels': args.levels}
+    if args.column:
+        profile(args.profile, run, args.output, args.column, args.measurements, args.upstream, args.flow_directions,
+                solver_options, args.warm_start, args.solver_log, args.metrics_json, args.decompose, args.workers,
+                args.cache, args.cache_max_size * 2**20, args.matrix_free)
+    else:
+        profile(args.profile, run_columns, args.output, args.columns, args.measurements, args.upstream, args.flow_directions,
+                args.workers, args.multiband_output, solver_options, args.warm_start, args.warm_start_column,
+                args.solver_log, args.metrics_json, args.decompose, args.cache, args.cache_max_size * 2**20,
+                args.matrix_free)
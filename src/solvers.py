@@ -0,0 +1,144 @@
+"""Solvers for the bounded least squares problem: minimize |Ax - b| subject to x >= 0.
+
+Every solver takes A (a sparse matrix, or anything else that supports A @ x
+and A.T @ y), b, an optional starting point x0, a tolerance and an iteration
+limit, and returns a SolverResult. Its history contains one dictionary for
+each iteration, with the iteration number, residual norm, cost (half of the
+squared residual norm) and wall time since the solver started.
+"""
+
+import time
+from collections import namedtuple
+import numpy as np
+from scipy.optimize import lsq_linear
+
+SolverResult = namedtuple('SolverResult', ['x', 'history', 'status'])
+
+def record(history, iteration, residual, start_time):
+    """Append the telemetry of one iteration to history.
+    """
+    residual_norm = float(np.linalg.norm(residual))
+    history.append({'iteration': iteration,
+                    'residual': residual_norm,
+                    'cost': 0.5 * residual_norm**2,
+                    'time': time.perf_counter() - start_time})
+
+def starting_point(A, x0):
+    """Return a feasible copy of x0, or zeros if it is None.
+    """
+    if x0 is None:
+        return np.zeros(A.shape[1])
+    return np.maximum(np.nan_to_num(np.asarray(x0, dtype=float)), 0.0)
+
+def bounded_lsq(A, b, x0=None, tol=1e-10, max_iter=4):
+    """Solve using SciPy's lsq_linear bounded least squares solver.
+       lsq_linear does not accept a starting point, so to warm start it is
+       used to find the correction to x0, bounded so that x0 plus the correction
+       is not negative.
+       lsq_linear does not report its progress, so the history only contains
+       the starting point and the result.
+    """
+    start_time = time.perf_counter()
+    history = []
+    x0 = starting_point(A, x0)
+    residual = A @ x0 - b
+    record(history, 0, residual, start_time)
+    res = lsq_linear(A, -residual, bounds=(-x0, np.inf), method='trf', tol=tol,
+                     lsmr_tol='auto', max_iter=max_iter)
+    x = np.maximum(x0 + res.x, 0.0)
+    record(history, res.nit, A @ x - b, start_time)
+    status = {-1: 'failed', 0: 'max_iter'}.get(res.status, 'converged')
+    return SolverResult(x, history, status)
+
+def estimate_norm_squared(A, num_iter=20):
+    """Estimate the square of the largest singular value of A using power iteration.
+    """
+    rng = np.random.RandomState(0)
+    v = rng.rand(A.shape[1])
+    norm_squared = 0.0
+    for _ in range(num_iter):
+        v_norm = np.linalg.norm(v)
+        if v_norm == 0:
+            break
+        w = A.T @ (A @ (v / v_norm))
+        norm_squared = np.linalg.norm(w)
+        v = w
+    return norm_squared
+
+def projected_gradient(A, b, x0=None, tol=1e-6, max_iter=100):
+    """Solve using accelerated projected gradient descent (FISTA) on the non-negative
+       least squares problem.
+       Iterations stop when the relative change in x is less than tol.
+    """
+    start_time = time.perf_counter()
+    history = []
+    x = starting_point(A, x0)
+    record(history, 0, A @ x - b, start_time)
+    step = 1.0 / max(1.01 * estimate_norm_squared(A), np.finfo(float).tiny)
+    y = x.copy()
+    t = 1.0
+    status = 'max_iter'
+    for iteration in range(1, max_iter + 1):
+        x_new = np.maximum(y - step * (A.T @ (A @ y - b)), 0.0)
+        t_new = 0.5 * (1 + np.sqrt(1 + 4 * t**2))
+        y = x_new + ((t - 1) / t_new) * (x_new - x)
+        change = np.linalg.norm(x_new - x)
+        x = x_new
+        t = t_new
+        record(history, iteration, A @ x - b, start_time)
+        if change <= tol * max(np.linalg.norm(x), np.finfo(float).tiny):
+            status = 'converged'
+            break
+    return SolverResult(x, history, status)
+
+def normal_equations(A, b, x0=None, tol=1e-6, max_iter=100):
+    """Solve the normal equations A.T A x = A.T b using the conjugate gradient
+       method (CGLS, which does not form A.T A), and then set negative values to zero.
+       This is fast, but the bound is only applied at the end, so the result is
+       not the bounded least squares solution if any values were negative.
+       Iterations stop when the norm of A.T (b - Ax) has been reduced by tol.
+    """
+    start_time = time.perf_counter()
+    history = []
+    x = starting_point(A, x0)
+    r = b - A @ x
+    record(history, 0, -r, start_time)
+    s = A.T @ r
+    p = s.copy()
+    gamma = s @ s
+    stop_gamma = tol**2 * gamma
+    status = 'converged'
+    iteration = 0
+    while gamma > stop_gamma:
+        if iteration == max_iter:
+            status = 'max_iter'
+            break
+        iteration += 1
+        q = A @ p
+        alpha = gamma / (q @ q)
+        x = x + alpha * p
+        r = r - alpha * q
+        s = A.T @ r
+        gamma_new = s @ s
+        p = s + (gamma_new / gamma) * p
+        gamma = gamma_new
+        record(history, iteration, -r, start_time)
+    x = np.maximum(x, 0.0)
+    record(history, iteration, A @ x - b, start_time)
+    return SolverResult(x, history, status)
+
+SOLVERS = {'lsq_linear': bounded_lsq,
+           'projected_gradient': projected_gradient,
+           'normal_equations': normal_equations}
+
+def solve(A, b, method='lsq_linear', x0=None, tol=None, max_iter=None):
+    """Solve with the named method, using its default tol and max_iter unless specified.
+    """
+    if method not in SOLVERS:
+        raise ValueError('unknown solver {}, should be one of {}'.format(method, ', '.join(SOLVERS)))
+    kwargs = {}
+    if tol is not None:
+        kwargs['tol'] = tol
+    if max_iter is not None:
+        kwargs['max_iter'] = max_iter
+    return SOLVERS[method](A, b, x0, **kwargs)
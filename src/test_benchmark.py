@@ -0,0 +1,34 @@
+import numpy as np
+import find_upstream
+import make_test_dataset
+import benchmark
+
+def test_dendritic_dataset():
+    flow_directions = make_test_dataset.make_dendritic_flow_directions(50, 40, block_cells=100)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    accumulation = np.array(list(make_test_dataset.dendritic_accumulation(flow_directions)))
+    assert(accumulation[17, 23] == len(find_upstream.trace_upstream(donor_graph, 17 * 40 + 23)))
+    cells = make_test_dataset.make_dendritic_samples(flow_directions, 12, nesting=3, spacing=5, min_catchment=20)
+    assert(len(cells) <= 12)
+    assert(np.all(accumulation.take(cells) >= 20))
+    # Each sample's catchment contains the catchment of the previous sample if it is in the same chain
+    upstream = [set(find_upstream.trace_upstream(donor_graph, cell).tolist()) for cell in cells]
+    nested = [cells[i] in upstream[i+1] for i in range(len(cells) - 1)]
+    assert(sum(nested) >= 4)
+    assert(all(upstream[i] < upstream[i+1] for i in np.flatnonzero(nested)))
+
+def test_find_regressions():
+    baseline = {'cases': {'10x10': {'stages': {'solve': {'time': 1.0, 'peak_memory': 1e8}}}}}
+    results = {'cases': {'10x10': {'stages': {'solve': {'time': 1.1, 'peak_memory': 2e8}}},
+                         '20x20': {'stages': {'solve': {'time': 5.0, 'peak_memory': 1e8}}}}}
+    regressions = benchmark.find_regressions(results, baseline, tolerance=0.25)
+    assert(len(regressions) == 1 and regressions[0].startswith('10x10 solve: peak_memory'))
+
+def test_compare_levels():
+    comparison = benchmark.compare_levels((60, 40), levels=3, max_iter=20, density=5e-3)
+    solves = comparison['solves']
+    assert(set(solves) == {'multigrid', 'single_level', 'lsq_linear'})
+    # The single level costs the same as the multigrid solve, unless it converged sooner
+    assert(solves['single_level']['cost'] <= comparison['single_level_iterations'] * comparison['nnz'])
+    assert(solves['multigrid']['cost'] > (comparison['single_level_iterations'] - 1) * comparison['nnz'])
+    assert(all(np.isfinite(stats['residual']) for stats in solves.values()))
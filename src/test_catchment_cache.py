@@ -0,0 +1,30 @@
+import numpy as np
+import find_upstream
+import catchment_cache
+
+def test_find_upstream_cached(tmpdir):
+    flow_directions = np.zeros([6, 3], dtype=np.uint8)
+    flow_directions[1:5, 1] = np.uint8(4)
+    flow_directions[2, 0] = np.uint8(1)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    traced = []
+    def trace(cells):
+        traced.extend(cells.tolist())
+        return find_upstream.trace_catchments(donor_graph, cells)
+    cache_dir = str(tmpdir.join('cache'))
+
+    upstream, stats = catchment_cache.find_upstream_cached(cache_dir, 'a', [7, 13, -1, 7], trace, (6, 3), now=0)
+    assert(stats == (0, 2, 0))
+    assert([sorted(row.tolist()) for row in upstream] == [[4, 6, 7], [4, 6, 7, 10, 13], [], [4, 6, 7]])
+
+    # Only the new cell is traced, and the cell that is no longer used is evicted once it is too old
+    upstream, stats = catchment_cache.find_upstream_cached(cache_dir, 'a', [10, 7], trace, (6, 3), max_age=10, now=100)
+    assert(stats == (1, 1, 1))
+    assert(traced == [7, 13, 10])
+    assert([sorted(row.tolist()) for row in upstream] == [[4, 6, 7, 10], [4, 6, 7]])
+
+    # A different raster does not use the entry, and the old entry is evicted once it is too old
+    upstream, stats = catchment_cache.find_upstream_cached(cache_dir, 'b', [7], trace, (6, 3), max_age=1e12)
+    assert(stats == (0, 1, 0))
+    catchment_cache.find_upstream_cached(cache_dir, 'b', [7], trace, (6, 3), max_age=10)
+    assert(tmpdir.join('cache').listdir() == [tmpdir.join('cache', 'b')])
@@ -0,0 +1,63 @@
+import json
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import numpy as np
+import pandas as pd
+import make_test_dataset
+import find_upstream
+import reverse_sediment
+import catchment_query
+
+def cell_center(row, col):
+    geotransform = make_test_dataset.GEOTRANSFORM
+    return geotransform[0] + (col + 0.5) * geotransform[1], geotransform[3] + (row + 0.5) * geotransform[5]
+
+def make_query(tmpdir):
+    measurements_file = str(tmpdir.join('measurements.csv'))
+    flow_directions_file = str(tmpdir.join('flow_directions.tif'))
+    make_test_dataset.create_test_measurements(measurements_file)
+    make_test_dataset.create_test_flow_directions(flow_directions_file)
+    measurements = pd.read_csv(measurements_file, index_col=0)
+    measurements['Sample_ID'] = ['a', 'b']
+    measurements.to_csv(measurements_file)
+    find_upstream.run(str(tmpdir.join('upstream')), measurements_file, 29901, flow_directions_file, single_pass=True)
+    reverse_sediment.run_columns(str(tmpdir.join('test_{column}.tif')), ['MgO_%'], measurements_file, str(tmpdir.join('upstream')))
+    return catchment_query.CatchmentQuery(str(tmpdir.join('upstream')), measurements_file, str(tmpdir.join('test_{column}.tif')),
+                                          [flow_directions_file])
+
+def test_catchment_query(tmpdir):
+    query = make_query(tmpdir)
+    assert(query.locate(*cell_center(2, 1)) == (2, 1))
+    answer = query.point(*cell_center(2, 1), column='MgO_%')
+    assert([sample['sample_id'] for sample in answer['samples']] == ['a', 'b'])
+    assert(answer['cells'] == [[2, 1]] and np.allclose(answer['values'], [0.0], atol=0.05))
+    assert([sample['sample'] for sample in query.point(*cell_center(4, 1))['samples']] == [1])
+    assert(query.point(*cell_center(0, 0))['samples'] == [])
+    assert(not query.point(*cell_center(-1, 0))['inside'])
+    assert(sorted(query.sample(0)['cells']) == [[1, 1], [2, 1]])
+    assert(np.allclose(query.sample(1, 'MgO_%')['values'], [1.0, 1.0, 0.0, 0.0], atol=0.05))
+    assert(sorted(query.upstream(*cell_center(3, 1))['cells']) == [[1, 1], [2, 1], [3, 1]])
+    answer = query.bbox(*(cell_center(3, 0) + cell_center(5, 2)))
+    assert([sample['sample'] for sample in answer['samples']] == [1] and answer['num_cells'] == 2)
+
+def test_serve(tmpdir):
+    query = make_query(tmpdir)
+    server = catchment_query.HTTPServer(('127.0.0.1', 0), catchment_query.make_handler(query))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        x, y = cell_center(4, 1)
+        with urlopen('{}/point?x={}&y={}'.format(url, x, y)) as response:
+            assert([sample['sample_id'] for sample in json.load(response)['samples']] == ['b'])
+        for path, status in [('/sample?sample=5', 400), ('/sample', 400), ('/nothing', 404)]:
+            try:
+                urlopen(url + path)
+                assert(False)
+            except HTTPError as error:
+                assert(error.code == status)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
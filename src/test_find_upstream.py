@@ -1,9 +1,91 @@
 import pytest
 import numpy as np
+import pandas as pd
+import make_test_dataset
+import find_upstream
+import upstream_index
 
 def test_find_upstream(test_upstream):
     if test_upstream == None:
         raise TypeError('must specify --upstream')
-    output = np.load(test_upstream)
-    assert(output[0] == [(2,1), (1,1)])
-    assert(output[1] == [(4,1), (3,1), (2,1), (1,1)])
+    output = upstream_index.load(test_upstream)
+    assert(upstream_index.row_coords(output, 0) == [(2,1), (1,1)])
+    assert(upstream_index.row_coords(output, 1) == [(4,1), (3,1), (2,1), (1,1)])
+
+def test_find_upstream_branches():
+    # 0 2 4
+    # 1 0 4
+    # 0 1 4
+    # 0 0 0
+    flow_directions = np.array([[0, 2, 4], [1, 0, 4], [0, 1, 4], [0, 0, 0]], dtype=np.uint8)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    assert(donor_graph.indptr.dtype == donor_graph.donors.dtype == np.int32)
+    output = find_upstream.find_upstream(donor_graph, 3, 2)
+    assert(output[0] == (3,2))
+    assert(sorted(output) == [(0,1), (0,2), (1,2), (2,1), (2,2), (3,2)])
+    assert(find_upstream.find_upstream(flow_directions, 1, 1) == [(1,1), (1,0)])
+
+def test_find_all_upstream_nested():
+    flow_directions = np.zeros([6, 3], dtype=np.uint8)
+    flow_directions[1:5, 1] = np.uint8(4)
+    flow_directions[2, 0] = np.uint8(1)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    cells = np.array([2*3+1, 4*3+1, 2*3+1])
+    upstream, starts, stops = find_upstream.find_all_upstream(donor_graph, cells)
+    for cell, start, stop in zip(cells, starts, stops):
+        expected = find_upstream.trace_upstream(donor_graph, cell)
+        assert(upstream[start] == cell)
+        assert(sorted(upstream[start:stop]) == sorted(expected))
+
+def test_no_samples_inside(tmpdir):
+    donor_graph = find_upstream.build_donor_graph(np.zeros([6, 3], dtype=np.uint8))
+    for single_pass in [False, True]:
+        assert(find_upstream.trace_catchments(donor_graph, np.zeros(0, dtype=np.int64), single_pass) == [])
+    # A point outside the raster has no upstream cells, however it is traced
+    measurements_file = str(tmpdir.join('measurements.csv'))
+    pd.DataFrame({'Sample_ID': ['a'], 'Easting': [0.0], 'Northing': [0.0]}).to_csv(measurements_file)
+    flow_directions_file = str(tmpdir.join('flow_directions.tif'))
+    make_test_dataset.create_test_flow_directions(flow_directions_file)
+    for single_pass in [False, True]:
+        index = find_upstream.run(str(tmpdir.join('upstream')), measurements_file, 29901, flow_directions_file,
+                                  single_pass=single_pass)
+        assert(upstream_index.num_rows(index) == 1)
+        assert(len(index.cells) == 0)
+
+def test_upstream_index_round_trip(tmpdir):
+    upstream = [[(2,1), (1,1)], [(4,1), (3,1), (2,1), (1,1)]]
+    legacy_file = str(tmpdir.join('upstream.npy'))
+    np.save(legacy_file, np.array(upstream, dtype=object))
+    index = upstream_index.load(legacy_file, shape=(6, 3))
+    path = str(tmpdir.join('upstream'))
+    upstream_index.save(path, index)
+    output = upstream_index.load(path)
+    assert(output.shape == (6, 3))
+    assert(upstream_index.row_coords(output, 0) == upstream[0])
+    assert(upstream_index.row_coords(output, 1) == upstream[1])
+
+def test_world_to_pixel():
+    geotransform = (100.0, 10.0, 0.0, 500.0, 0.0, -20.0)
+    x = np.array([105.0, 125.0, 95.0, 105.0, 129.0])
+    y = np.array([495.0, 461.0, 495.0, 505.0, 441.0])
+    pixel, line = find_upstream.world_to_pixel(geotransform, x, y)
+    assert(np.array_equal(pixel, [0, 2, -1, 0, 2]))
+    assert(np.array_equal(line, [0, 1, 0, -1, 2]))
+    assert(find_upstream.world2Pixel(geotransform, 125.0, 461.0) == (2, 1))
+
+def test_trace_catchments_parallel():
+    # flowing east, south east or south, so that there are no cycles
+    rng = np.random.RandomState(0)
+    flow_directions = rng.choice([0, 1, 2, 4], size=[20, 30], p=[0.05, 0.35, 0.3, 0.3]).astype(np.uint8)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    cells = rng.choice(flow_directions.size, 40, replace=False)
+    outlets = find_upstream.find_outlets(flow_directions, cells)
+    # the flow stops at each outlet, or leaves the raster across the south or east edge
+    rows, cols = np.unravel_index(outlets, flow_directions.shape)
+    assert(np.all((flow_directions.take(outlets) == 0) | (rows == 19) | (cols == 29)))
+    batches = find_upstream.basin_batches(outlets, 4)
+    assert(np.array_equal(np.sort(np.concatenate(batches)), np.arange(len(cells))))
+    expected = find_upstream.trace_catchments(donor_graph, cells)
+    for single_pass in [False, True]:
+        upstream = find_upstream.trace_catchments_parallel(flow_directions, donor_graph, cells, single_pass, workers=2)
+        assert(all(np.array_equal(np.sort(row), np.sort(expected_row)) for row, expected_row in zip(upstream, expected)))
@@ -0,0 +1,36 @@
+import numpy as np
+import flow_raster
+import find_upstream
+
+def write_bil(path, values, ulxmap, ulymap):
+    values.astype('>u1').tofile(str(path))
+    with open(str(path)[:-4] + '.hdr', 'w') as header_file:
+        header_file.write('BYTEORDER M\nLAYOUT BIL\nNROWS {}\nNCOLS {}\nNBANDS 1\nNBITS 8\n'
+                          'ULXMAP {}\nULYMAP {}\nXDIM 1\nYDIM 1\n'.format(values.shape[0], values.shape[1], ulxmap, ulymap))
+
+def make_mosaic(tmpdir):
+    rng = np.random.RandomState(0)
+    flow_directions = (1 << rng.randint(0, 8, size=[6, 10])).astype(np.uint8)
+    flow_directions[rng.rand(6, 10) < 0.2] = 0
+    # two tiles side by side, read in blocks smaller than the tiles
+    write_bil(tmpdir.join('west_dir.bil'), flow_directions[:, :5], 0.5, 5.5)
+    write_bil(tmpdir.join('east_dir.bil'), flow_directions[:, 5:], 5.5, 5.5)
+    mosaic = flow_raster.TileMosaic([str(tmpdir.join('west_dir.bil')), str(tmpdir.join('east_dir.bil'))],
+                                    block_size=4, cache_blocks=2)
+    return flow_directions, mosaic
+
+def test_tile_mosaic(tmpdir):
+    flow_directions, mosaic = make_mosaic(tmpdir)
+    assert(mosaic.shape == flow_directions.shape)
+    assert(mosaic.geotransform == (0.0, 1.0, 0.0, 6.0, 0.0, -1.0))
+    assert(np.array_equal(mosaic.read(), flow_directions))
+    cells = np.array([59, 0, 4, 5, 37, 37, 12])
+    assert(np.array_equal(mosaic.take(cells), flow_directions.take(cells)))
+    assert(mosaic.misses > 0 and len(mosaic.cache) <= 2)
+
+def test_trace_mosaic(tmpdir):
+    flow_directions, mosaic = make_mosaic(tmpdir)
+    donor_graph = find_upstream.build_donor_graph(flow_directions)
+    for cell in [0, 17, 33, 59]:
+        expected = find_upstream.trace_upstream(donor_graph, cell)
+        assert(np.array_equal(np.sort(find_upstream.trace_upstream(mosaic, cell)), np.sort(expected)))
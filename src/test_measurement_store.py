@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import measurement_store
+import merge_csvs
+
+def test_measurement_store(tmpdir):
+    store = str(tmpdir.join('store'))
+    writer = measurement_store.StoreWriter(store, ['Sample_ID', 'Easting', 'Northing', 'Na2O_%', 'Au_ugkg'])
+    writer.write(pd.DataFrame({'Sample_ID': ['1A', '2B'], 'Easting': [215662, 228250],
+                               'Northing': [425641, 1.5], 'Na2O_%': [1.4, np.nan]}))
+    writer.write(pd.DataFrame({'Sample_ID': [3], 'Easting': [1], 'Northing': [2], 'Au_ugkg': [5]}))
+    writer.close()
+    assert(measurement_store.is_store(store))
+    assert(measurement_store.column_names(store) == ['Sample_ID', 'Easting', 'Northing', 'Na2O_%', 'Au_ugkg'])
+    df = measurement_store.read_columns(store, ['Au_ugkg', 'Sample_ID', 'Easting'])
+    assert(df.columns.tolist() == ['Au_ugkg', 'Sample_ID', 'Easting'])
+    assert(df['Sample_ID'].tolist() == ['1A', '2B', '3'])
+    assert(df['Easting'].dtype == np.float64 and df['Au_ugkg'].dtype == np.float32)
+    assert(np.array_equal(df['Au_ugkg'].values, [np.nan, np.nan, 5], equal_nan=True))
+
+def test_merge_columnar(tmpdir):
+    input_files = []
+    for i, df in enumerate([pd.DataFrame({'Sample_ID': ['a', 'b', 'c'], 'Easting': [1, 2, 3], 'Northing': [4, 5, 6], 'Na2O_%': [0.1, 0.2, 0.3]}),
+                            pd.DataFrame({'Sample_ID': ['d'], 'Easting': [7], 'Northing': [8], 'MgO_%': [0.4]})]):
+        input_files.append(str(tmpdir.join('input{}.csv'.format(i))))
+        df.to_csv(input_files[-1], index=False)
+    merge_csvs.run(str(tmpdir.join('merged.csv')), input_files, None, None, None)
+    columns, chunks = merge_csvs.merge_chunks(input_files, None, None, None, chunk_size=2)
+    assert([len(chunk) for chunk in chunks] == [2, 1, 1])
+    merge_csvs.run(str(tmpdir.join('merged')), input_files, None, None, None, columnar=True)
+    expected = pd.read_csv(str(tmpdir.join('merged.csv')), index_col=0)
+    merged = measurement_store.read_columns(str(tmpdir.join('merged')))
+    assert(merged.columns.tolist() == expected.columns.tolist())
+    assert(np.allclose(merged[['Easting', 'Na2O_%', 'MgO_%']].values, expected[['Easting', 'Na2O_%', 'MgO_%']].values, equal_nan=True))
+
+def test_merge_columnar_northern_ireland(tmpdir):
+    # Northern Ireland set 1 and Au and PGE are joined by sample and moved after the Republic file
+    set1 = pd.DataFrame(np.arange(2 * 22.0).reshape(2, 22), columns=['c{}'.format(i) for i in range(22)])
+    set1.insert(0, 'SAMPLE', ['n1', 'n2'])
+    set1.insert(3, 'YEAR', 2010)
+    set1.insert(4, 'LABNO', 1)
+    auandpge = pd.DataFrame({'SAMPLE': ['n2'], 'X': [22.0], 'Y': [23.0], 'AU': [1.0], 'PT': [2.0], 'PD': [3.0]})
+    republic = pd.DataFrame({'Sample_ID': ['r1', 'r2', 'r3'], 'Easting': [1, 2, 3], 'Northing': [4, 5, 6], 'Au_ugkg': [0.1, 0.2, 0.3]})
+    input_files = []
+    for i, df in enumerate([set1, republic, auandpge]):
+        input_files.append(str(tmpdir.join('input{}.csv'.format(i))))
+        df.to_csv(input_files[-1], index=False)
+    # A single Northern Ireland file keeps its place
+    for files, ni1idx, niauandpgeidx, expected_ids in [(input_files, 0, 2, ['r1', 'r2', 'r3', 'n1', 'n2']),
+                                                       (input_files[:0:-1], None, 0, ['n2', 'r1', 'r2', 'r3'])]:
+        merge_csvs.run(str(tmpdir.join('merged.csv')), files, ni1idx, None, niauandpgeidx)
+        expected = pd.read_csv(str(tmpdir.join('merged.csv')), index_col=0)
+        columns, chunks = merge_csvs.merge_chunks(files, ni1idx, None, niauandpgeidx, chunk_size=2)
+        merged = pd.concat(list(chunks), ignore_index=True, sort=False)
+        assert(columns.tolist() == expected.columns.tolist())
+        assert(merged['Sample_ID'].tolist() == expected['Sample_ID'].tolist() == expected_ids)
+        assert(np.allclose(merged[['Easting', 'Au_ugkg']].values, expected[['Easting', 'Au_ugkg']].values, equal_nan=True))
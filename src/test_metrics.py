@@ -0,0 +1,49 @@
+import json
+import pstats
+import numpy as np
+import metrics
+
+def test_metrics(tmpdir):
+    run_metrics = metrics.Metrics()
+    for column in ['a', 'b']:
+        with run_metrics.stage('solve', column=column):
+            sum(range(1000))
+        run_metrics.count('columns', column, unknowns=3)
+    run_metrics.count(samples=2)
+    metrics_file = str(tmpdir.join('metrics.json'))
+    run_metrics.write(metrics_file)
+    with open(metrics_file) as input_file:
+        output = json.load(input_file)
+    assert([(stage['stage'], stage['column']) for stage in output['stages']] == [('solve', 'a'), ('solve', 'b')])
+    assert(output['stage_times']['solve'] == output['stages'][0]['time'] + output['stages'][1]['time'])
+    assert(output['counts'] == {'samples': 2, 'columns': {'a': {'unknowns': 3}, 'b': {'unknowns': 3}}})
+    assert(output['peak_rss'] > 0)
+
+def test_stage_peak_rss():
+    run_metrics = metrics.Metrics()
+    with run_metrics.stage('large'):
+        with run_metrics.stage('inner'):
+            large = np.ones(1 << 25)
+            large_rss = metrics.peak_rss()
+            del large
+        with run_metrics.stage('after'):
+            pass
+    with run_metrics.stage('small'):
+        pass
+    peaks = {stage['stage']: stage.get('peak_rss', stage.get('peak_rss_increase')) for stage in run_metrics.stages}
+    if 'peak_rss' in run_metrics.stages[0]:
+        # Each stage's peak is its own, except that it includes the stages within it
+        assert(peaks['large'] == peaks['inner'] >= large_rss)
+        assert(peaks['small'] < peaks['large'] - (1 << 27))
+        assert(peaks['after'] < peaks['large'] - (1 << 27))
+    else:
+        assert(peaks['inner'] >= 1 << 27)
+        assert(peaks['small'] == 0)
+    # The peak of the process is not reset by the stages
+    assert(metrics.peak_rss() >= large_rss)
+
+def test_profile(tmpdir):
+    profile_file = str(tmpdir.join('profile'))
+    assert(metrics.profile(profile_file, sorted, [2, 1]) == [1, 2])
+    assert(pstats.Stats(profile_file).total_calls > 0)
+    assert(metrics.profile(None, sorted, [2, 1]) == [1, 2])
@@ -0,0 +1,50 @@
+import os
+import json
+import zipfile
+import numpy as np
+import pandas as pd
+import gdal
+import make_test_dataset
+import pipeline
+
+def run_pipeline(tmpdir):
+    metrics_file = str(tmpdir.join('metrics.json'))
+    pipeline.run('test', str(tmpdir), str(tmpdir), str(tmpdir.join('flow_directions.tif')),
+                 measurements_file=str(tmpdir.join('measurements.csv')), readme_file=str(tmpdir.join('flow_directions.tif')),
+                 single_pass=True, metrics_file=metrics_file)
+    with open(metrics_file) as input_file:
+        return {stage: counts['skipped'] for stage, counts in json.load(input_file)['counts']['stages'].items()}
+
+def test_pipeline(tmpdir):
+    make_test_dataset.create_test_measurements(str(tmpdir.join('measurements.csv')))
+    make_test_dataset.create_test_flow_directions(str(tmpdir.join('flow_directions.tif')))
+    assert(run_pipeline(tmpdir) == {'trace': False, 'solve': False, 'package': False})
+    output = gdal.Open(str(tmpdir.join('test_MgO_%.tif'))).ReadAsArray()
+    assert(np.allclose(output[1:5, 1], [0.0, 0.0, 1.0, 1.0], atol=0.05))
+    with zipfile.ZipFile(str(tmpdir.join('test_sediments.zip'))) as output_zip:
+        assert(len(output_zip.namelist()) == 7)
+        assert('test_sediments/test_S_mgkg.tif' in output_zip.namelist())
+
+    # Nothing has changed, so every stage is skipped
+    assert(run_pipeline(tmpdir) == {'trace': True, 'solve': True, 'package': True})
+
+    # A missing output is made again, and so is everything that depends on it
+    os.remove(str(tmpdir.join('test_Na2O_%.tif')))
+    assert(run_pipeline(tmpdir) == {'trace': True, 'solve': False, 'package': False})
+
+    # Changing the measurements changes everything
+    measurements = pd.read_csv(str(tmpdir.join('measurements.csv')), index_col=0)
+    measurements.loc[1, 'MgO_%'] = 1.0
+    measurements.to_csv(str(tmpdir.join('measurements.csv')))
+    assert(run_pipeline(tmpdir) == {'trace': False, 'solve': False, 'package': False})
+    output = gdal.Open(str(tmpdir.join('test_MgO_%.tif'))).ReadAsArray()
+    assert(np.allclose(output[1:5, 1], [0.0, 0.0, 2.0, 2.0], atol=0.05))
+
+def test_stage_signature(tmpdir):
+    input_file = tmpdir.join('input')
+    input_file.write('a')
+    signature = pipeline.stage_signature('package', [str(input_file)], {})
+    assert(pipeline.stage_signature('package', [str(input_file)], {}) == signature)
+    assert(pipeline.stage_signature('package', [str(input_file)], {'columns': ['a']}) != signature)
+    input_file.write('ab')
+    assert(pipeline.stage_signature('package', [str(input_file)], {}) != signature)
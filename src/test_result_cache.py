@@ -0,0 +1,92 @@
+import json
+import pytest
+import numpy as np
+import pandas as pd
+import gdal
+import make_test_dataset
+import find_upstream
+import reverse_sediment
+import upstream_index
+import result_cache
+import solvers
+
+def run_columns(tmpdir, cache_max_size=result_cache.DEFAULT_MAX_SIZE):
+    metrics_file = str(tmpdir.join('metrics.json'))
+    reverse_sediment.run_columns(str(tmpdir.join('test_{column}.tif')), ['MgO_%', 'Al2O3_%'], str(tmpdir.join('measurements.csv')),
+                                 str(tmpdir.join('upstream')), cache_dir=str(tmpdir.join('cache')),
+                                 cache_max_size=cache_max_size, metrics_file=metrics_file)
+    with open(metrics_file) as input_file:
+        counts = json.load(input_file)['counts']
+    return ({column: column_counts['cached'] for column, column_counts in counts['columns'].items()},
+            (counts['cache_hits'], counts['cache_misses'], counts['cache_evicted']))
+
+def test_run_columns_cached(tmpdir):
+    measurements_file = str(tmpdir.join('measurements.csv'))
+    make_test_dataset.create_test_measurements(measurements_file)
+    make_test_dataset.create_test_flow_directions(str(tmpdir.join('flow_directions.tif')))
+    find_upstream.run(str(tmpdir.join('upstream')), measurements_file, 29901, str(tmpdir.join('flow_directions.tif')),
+                      single_pass=True)
+    assert(run_columns(tmpdir) == ({'MgO_%': False, 'Al2O3_%': False}, (0, 2, 0)))
+    expected = gdal.Open(str(tmpdir.join('test_MgO_%.tif'))).ReadAsArray()
+
+    # Nothing has changed, so both columns are read from the cache
+    assert(run_columns(tmpdir) == ({'MgO_%': True, 'Al2O3_%': True}, (2, 0, 0)))
+    assert(np.array_equal(gdal.Open(str(tmpdir.join('test_MgO_%.tif'))).ReadAsArray(), expected, equal_nan=True))
+
+    # A single column uses the same key as several columns
+    metrics_file = str(tmpdir.join('metrics.json'))
+    reverse_sediment.run(str(tmpdir.join('test_MgO_%.tif')), 'MgO_%', measurements_file, str(tmpdir.join('upstream')),
+                         cache_dir=str(tmpdir.join('cache')), metrics_file=metrics_file)
+    with open(metrics_file) as input_file:
+        output = json.load(input_file)
+    assert(output['counts']['columns']['MgO_%']['cached'])
+    # A is not built for a solution that is in the cache
+    assert('build_A' not in [stage['stage'] for stage in output['stages']])
+    assert(output['counts']['columns']['MgO_%']['nnz'] > 0)
+
+    # Only the column that changed is solved for again, and a cache that is too large is emptied
+    measurements = pd.read_csv(measurements_file, index_col=0)
+    measurements.loc[1, 'Al2O3_%'] = 2.0
+    measurements.to_csv(measurements_file)
+    assert(run_columns(tmpdir, cache_max_size=0) == ({'MgO_%': True, 'Al2O3_%': False}, (1, 1, 3)))
+    output = gdal.Open(str(tmpdir.join('test_Al2O3_%.tif'))).ReadAsArray()
+    assert(np.allclose(output[1:5, 1], [1.0, 1.0, 3.0, 3.0], atol=0.05))
+    assert(len(tmpdir.join('cache').listdir('*.npz')) == 0)
+
+def test_cell_order(tmpdir):
+    # run numbers the cells in the order they appear in the valid rows (C, D, A, B, E),
+    # and run_columns in the order they appear in all rows (A, B, C, D, E)
+    make_test_dataset.create_test_flow_directions(str(tmpdir.join('flow_directions.tif')))
+    projection = gdal.Open(str(tmpdir.join('flow_directions.tif'))).GetProjection()
+    a, b, c, d, e = 0, 3, 6, 7, 2
+    rows = [np.array(row, dtype=np.int64) for row in [[a, b], [c], [c, d, a, b], [e]]]
+    upstream_index.save(str(tmpdir.join('upstream')),
+                        upstream_index.from_rows(rows, (3, 3), make_test_dataset.GEOTRANSFORM, projection))
+    measurements_file = str(tmpdir.join('measurements.csv'))
+    pd.DataFrame({'Na2O_%': [np.nan, 5.0, 2.0, 1.0]}).to_csv(measurements_file)
+
+    reverse_sediment.run(str(tmpdir.join('expected.tif')), 'Na2O_%', measurements_file, str(tmpdir.join('upstream')))
+    expected = gdal.Open(str(tmpdir.join('expected.tif'))).ReadAsArray()
+    assert(expected[2, 0] == pytest.approx(5.0, abs=0.05))
+    reverse_sediment.run_columns(str(tmpdir.join('test_{column}.tif')), ['Na2O_%'], measurements_file,
+                                 str(tmpdir.join('upstream')), cache_dir=str(tmpdir.join('cache')))
+    metrics_file = str(tmpdir.join('metrics.json'))
+    reverse_sediment.run(str(tmpdir.join('cached.tif')), 'Na2O_%', measurements_file, str(tmpdir.join('upstream')),
+                         cache_dir=str(tmpdir.join('cache')), metrics_file=metrics_file)
+    with open(metrics_file) as input_file:
+        assert(json.load(input_file)['counts']['cache_hits'] == 1)
+    cached = gdal.Open(str(tmpdir.join('cached.tif'))).ReadAsArray()
+    assert(np.allclose(cached, expected, atol=1e-6, equal_nan=True))
+
+def test_previous(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    assert(result_cache.previous(cache_dir, 'a', [1, 2]) is None)
+    result_cache.save(cache_dir, 'key', 'a', [5, 1, 3], solvers.SolverResult(np.array([0.5, 0.1, 0.3]), [], 'converged'))
+    assert(np.allclose(result_cache.previous(cache_dir, 'a', [3, 4, 5, 0]), [0.3, 0.0, 0.5, 0.0]))
+    result = result_cache.load(cache_dir, 'key', [1, 3, 5])
+    assert(result.status == 'converged')
+    assert(np.allclose(result.x, [0.1, 0.3, 0.5]))
+    # A solution for other cells is a miss
+    assert(result_cache.load(cache_dir, 'key', [1, 3]) is None)
+    assert(result_cache.load(cache_dir, 'key', [1, 3, 4]) is None)
+    assert(result_cache.load(cache_dir, 'other', [1, 3, 5]) is None)
@@ -1,6 +1,12 @@
 import pytest
 import numpy as np
+import gdal
 import gdalnumeric
+import make_test_dataset
+import benchmark
+import find_upstream
+import reverse_sediment
+import upstream_index
 
 def compare(output, expected, atol=0.05):
     assert(np.all(output[0,:]))
@@ -44,3 +50,132 @@ def test_all_nan(test_s):
         raise TypeError('must specify --s_')
     output = gdalnumeric.LoadFile(test_s)
     compare(output, [np.nan,np.nan,np.nan,np.nan])
+
+def test_vectorized_build_A():
+    upstream = [[(2,1), (1,1)], [(4,1), (3,1), (2,1), (1,1)], [(4,2), (4,1), (3,1), (2,1), (1,1)]]
+    expected = benchmark.find_nonzero_cells_loop(upstream)
+    full_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells(upstream)
+    assert(np.array_equal(full_coords, np.array(expected[0])))
+    assert(np.array_equal(reduced_idxs, expected[1]))
+    assert((num_nonzero, minx, miny) == expected[2:])
+    A = reverse_sediment.build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+    expected_A = benchmark.build_A_loop(upstream, *expected)
+    assert(np.array_equal(A.toarray(), expected_A.toarray()))
+    full_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells([])
+    A = reverse_sediment.build_A([], full_coords, reduced_idxs, num_nonzero, minx, miny)
+    assert(A.shape == (0, 0))
+
+def test_collapse_columns():
+    upstream = [[(2,1), (1,1)], [(4,1), (3,1), (2,1), (1,1)], [(4,2), (4,1), (3,1), (2,1), (1,1)]]
+    full_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells(upstream)
+    A = reverse_sediment.build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+    collapsed_A, groups = reverse_sediment.collapse_columns(A)
+    assert(collapsed_A.shape == (3, 3))
+    assert(groups[0] == groups[1])
+    assert(groups[2] == groups[3])
+    assert(len(set(groups)) == 3)
+    x = np.arange(collapsed_A.shape[1], dtype=float)
+    assert(np.allclose(collapsed_A @ x, A @ x[groups]))
+
+def test_solve_components():
+    # Two basins, the second of which has two nested measurements
+    upstream = [[(0,0), (1,0)], [(0,3), (1,3)], [(0,3), (1,3), (2,3), (2,4)]]
+    full_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells(upstream)
+    A = reverse_sediment.build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+    b = np.array([1.0, 2.0, 1.0])
+    num_components, row_labels, column_labels = reverse_sediment.find_components(A)
+    assert(num_components == 2)
+    assert(row_labels[1] == row_labels[2] != row_labels[0])
+    assert(len(set(column_labels[:2])) == 1 and len(set(column_labels[2:])) == 1)
+    components = reverse_sediment.split_components(A, b)
+    assert([(component[0].shape, component[4].tolist()) for component in components] == [((1, 2), [0, 1]), ((2, 4), [2, 3, 4, 5])])
+    expected = reverse_sediment.solve_values(A, b, method='projected_gradient', max_iter=1000)
+    for workers in [1, 2]:
+        results = reverse_sediment.solve_components([(A, b, None, None), (A[:1, :2], b[:1], None, None)], workers,
+                                                    method='projected_gradient', max_iter=1000)
+        assert(np.allclose(results[0].x, expected.x, atol=1e-3))
+        assert(np.allclose(results[1].x, expected.x[:2], atol=1e-3))
+        assert(results[0].history[-1]['components'] == 2)
+        assert(results[0].history[-1]['residual'] < results[0].history[0]['residual'])
+
+def test_solve_multigrid():
+    upstream = [[(0,0), (1,0), (0,1)], [(2,2), (3,3)], [(0,0), (1,0), (0,1), (2,2), (3,3), (4,3), (5,4)]]
+    full_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells(upstream)
+    A = reverse_sediment.build_A(upstream, full_coords, reduced_idxs, num_nonzero, minx, miny)
+    b = np.array([1.0, 2.0, 1.5])
+    groups, num_groups = reverse_sediment.coarsen(full_coords, 2)
+    assert(num_groups == 4)
+    assert(groups[0] == groups[1] == groups[2] != groups[3])
+    assert(np.allclose(reverse_sediment.merge_columns(A, groups) @ np.arange(4.0), A @ np.arange(4.0)[groups]))
+    expected = reverse_sediment.solve_values(A, b, method='projected_gradient', max_iter=1000)
+    result = reverse_sediment.solve_values(A, b, None, full_coords, method='projected_gradient', max_iter=1000, levels=3)
+    assert(np.allclose(A @ result.x, A @ expected.x, atol=1e-3))
+    levels = reverse_sediment.level_summary(result.history)
+    assert([level['level'] for level in levels] == [2, 1, 0])
+    assert([level['unknowns'] for level in levels] == [3, 4, 7])
+    assert(levels[-1]['residual'] < 1e-3)
+    assert(levels[-1]['nnz'] == A.nnz)
+    # lsq_linear does not start from the coarser level's solution
+    with pytest.raises(ValueError):
+        reverse_sediment.solve_values(A, b, None, full_coords, levels=3)
+
+def test_build_operator():
+    # Two basins, the second of which has two nested measurements, one of them twice, and a measurement outside the raster
+    upstream = [[(0,3), (1,3), (2,3), (2,4)], [(0,0), (1,0)], [(0,3), (1,3)], [], [(1,3), (0,3)]]
+    index = upstream_index.from_coords(upstream, (3, 5))
+    A, full_coords = reverse_sediment.build_operator(index, np.ones(len(upstream), dtype=bool))
+    rows = [row for row in upstream if row]
+    expected_coords, reduced_idxs, num_nonzero, minx, miny = reverse_sediment.find_nonzero_cells(rows)
+    expected_A = reverse_sediment.build_A(rows, expected_coords, reduced_idxs, num_nonzero, minx, miny).toarray()
+    order = [expected_coords.tolist().index(coords) for coords in full_coords.tolist()]
+    dense_A = A @ np.eye(A.shape[1])
+    assert(np.allclose(np.delete(dense_A, 3, axis=0), expected_A[:, order]))
+    assert(np.allclose(A.T @ np.eye(A.shape[0]), dense_A.T))
+    assert(A.nnz == num_nonzero)
+
+    measurements = np.array([1.0, 2.0, np.nan, np.nan, 0.5])
+    A_selected, b, column_coords, _ = reverse_sediment.select_measurements(A, full_coords, measurements)
+    assert(A_selected.shape == (3, 6))
+    expected = reverse_sediment.solve_values(A_selected @ np.eye(6), b, method='projected_gradient', max_iter=1000)
+    result = reverse_sediment.solve_values(A_selected, b, method='projected_gradient', max_iter=1000)
+    assert(np.allclose(result.x, expected.x))
+
+    # Catchments that overlap without being nested are not from the same flow directions
+    index = upstream_index.from_coords([[(0,0), (1,0)], [(1,0), (2,0)]], (3, 5))
+    with pytest.raises(ValueError):
+        reverse_sediment.build_operator(index, np.ones(2, dtype=bool))
+
+def test_write_window(tmpdir):
+    # A window in the second row and column of blocks of a larger raster
+    geometry = upstream_index.RasterGeometry((600, 500), make_test_dataset.GEOTRANSFORM, 'projection')
+    x = np.arange(12, dtype=np.float32).reshape(3, 4)
+    x[1, 2] = np.nan
+    output_file = str(tmpdir.join('window.tif'))
+    reverse_sediment.write_output(x, output_file, geometry, offset=(300, 270))
+    dataset = gdal.Open(output_file)
+    assert((dataset.RasterYSize, dataset.RasterXSize) == geometry.shape)
+    assert(dataset.GetGeoTransform() == pytest.approx(make_test_dataset.GEOTRANSFORM))
+    band = dataset.GetRasterBand(1)
+    output = band.ReadAsArray()
+    assert(np.array_equal(output[270:273, 300:304], x, equal_nan=True))
+    output[270:273, 300:304] = np.nan
+    assert(np.all(np.isnan(output)))
+    # Only the block containing the window is stored
+    assert(band.GetMetadataItem('BLOCK_OFFSET_1_1', 'TIFF') is not None)
+    assert(band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF') is None)
+
+def test_multiband_output(tmpdir):
+    measurements_file = str(tmpdir.join('measurements.csv'))
+    make_test_dataset.create_test_measurements(measurements_file)
+    make_test_dataset.create_test_flow_directions(str(tmpdir.join('flow_directions.tif')))
+    find_upstream.run(str(tmpdir.join('upstream')), measurements_file, 29901, str(tmpdir.join('flow_directions.tif')),
+                      single_pass=True)
+    columns = ['Na2O_%', 'MgO_%', 'Al2O3_%']
+    multiband_file = str(tmpdir.join('multiband.tif'))
+    reverse_sediment.run_columns(None, columns, measurements_file, str(tmpdir.join('upstream')),
+                                 multiband_file=multiband_file)
+    dataset = gdal.Open(multiband_file)
+    assert(dataset.RasterCount == len(columns))
+    assert([dataset.GetRasterBand(i + 1).GetDescription() for i in range(len(columns))] == columns)
+    for i, expected in enumerate([[1.0, 1.0, 1.0, 1.0], [0.0, 0.0, 1.0, 1.0], [1.0, 1.0, 0.0, 0.0]]):
+        compare(dataset.GetRasterBand(i + 1).ReadAsArray(), expected)
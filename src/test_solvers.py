@@ -0,0 +1,28 @@
+import pytest
+import numpy as np
+from scipy.sparse import csr_matrix
+import solvers
+
+def make_problem():
+    A = csr_matrix(np.array([[0.5, 0.5, 0.0, 0.0],
+                             [0.25, 0.25, 0.25, 0.25],
+                             [0.0, 0.0, 0.5, 0.5]]))
+    b = np.array([1.0, 0.5, 0.0])
+    return A, b
+
+@pytest.mark.parametrize('method', sorted(solvers.SOLVERS))
+def test_solvers_fit_measurements(method):
+    A, b = make_problem()
+    result = solvers.solve(A, b, method, max_iter=1000)
+    assert(np.all(result.x >= 0))
+    assert(np.allclose(A @ result.x, b, atol=1e-3))
+    assert(result.history[0]['iteration'] == 0)
+    assert(result.history[-1]['cost'] <= result.history[0]['cost'])
+
+@pytest.mark.parametrize('method', sorted(solvers.SOLVERS))
+def test_warm_start_from_solution(method):
+    A, b = make_problem()
+    x0 = np.array([1.0, 1.0, 0.0, 0.0])
+    result = solvers.solve(A, b, method, x0=x0, max_iter=1000)
+    assert(np.allclose(result.x, x0, atol=1e-3))
+    assert(result.history[0]['residual'] == 0)
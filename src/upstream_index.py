@@ -0,0 +1,126 @@
+"""Store the upstream cells of each measurement in a compact format.
+
+An upstream index is a directory containing:
+    indptr.npy: the upstream cells of row i are cells[indptr[i]:indptr[i+1]]
+    cells.npy: the linear (row-major) indices of the upstream cells in the
+               flow directions raster
+    meta.json: the shape, geotransform and projection of the flow directions raster
+The arrays are plain .npy files, so they can be memory-mapped and the rows that
+are needed read without unpickling (or even reading) the others.
+"""
+
+import os
+import json
+from collections import namedtuple
+import numpy as np
+
+UpstreamIndex = namedtuple('UpstreamIndex', ['indptr', 'cells', 'shape', 'geotransform', 'projection'])
+
+# The grid of the flow directions raster, which output rasters are created on
+RasterGeometry = namedtuple('RasterGeometry', ['shape', 'geotransform', 'projection'])
+
+def from_rows(rows, shape, geotransform=None, projection=None):
+    """Create an index from a list containing an array of the linear cell indices
+       upstream of each row.
+    """
+    lengths = np.array([len(row) for row in rows], dtype=np.int64)
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    if len(rows) > 0:
+        cells = np.concatenate(rows)
+    else:
+        cells = np.zeros(0, dtype=np.int32)
+    return UpstreamIndex(indptr, cells, tuple(shape), geotransform, projection)
+
+def from_slices(upstream, starts, stops, shape, geotransform=None, projection=None):
+    """Create an index where the upstream cells of row i are upstream[starts[i]:stops[i]],
+       as returned by find_upstream.find_all_upstream.
+    """
+    lengths = np.asarray(stops) - np.asarray(starts)
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    ranges = np.repeat(np.arange(len(lengths)), lengths)
+    idxs = np.asarray(starts)[ranges] + np.arange(indptr[-1]) - indptr[:-1][ranges]
+    return UpstreamIndex(indptr, upstream[idxs], tuple(shape), geotransform, projection)
+
+def from_coords(upstream, shape=None, geotransform=None, projection=None):
+    """Create an index from a list of lists of (row, col) coordinate pairs,
+       the format of upstream files that were saved by older versions.
+       If the shape is not specified, the smallest raster that contains all
+       of the coordinates is used.
+    """
+    coords = [np.asarray(row, dtype=np.int64).reshape(-1, 2) for row in upstream]
+    if shape is None:
+        max_coords = [row.max(axis=0) for row in coords if len(row) > 0]
+        if max_coords:
+            shape = tuple(np.max(max_coords, axis=0) + 1)
+        else:
+            shape = (0, 0)
+    return from_rows([np.ravel_multi_index((row[:, 0], row[:, 1]), shape) for row in coords],
+                     shape, geotransform, projection)
+
+def save(path, index):
+    """Save an index to the directory path.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'indptr.npy'), np.asarray(index.indptr, dtype=np.int64))
+    np.save(os.path.join(path, 'cells.npy'), index.cells)
+    meta = {'shape': [int(n) for n in index.shape],
+            'geotransform': None if index.geotransform is None else list(index.geotransform),
+            'projection': index.projection}
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    # Overwriting files does not update the directory's modification time,
+    # which Make uses to decide whether the index is up to date
+    os.utime(path, None)
+
+def load(path, mmap_mode='r', shape=None):
+    """Load an index. The arrays are memory-mapped unless mmap_mode is None.
+       Upstream .npy files saved by older versions are also accepted; these
+       are converted to an index using shape (the shape of the flow directions
+       raster) if it is specified.
+    """
+    if not os.path.isdir(path):
+        return from_coords(np.load(path, allow_pickle=True), shape)
+    indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode=mmap_mode)
+    cells = np.load(os.path.join(path, 'cells.npy'), mmap_mode=mmap_mode)
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    geotransform = meta['geotransform']
+    if geotransform is not None:
+        geotransform = tuple(geotransform)
+    return UpstreamIndex(indptr, cells, tuple(meta['shape']), geotransform, meta['projection'])
+
+def geometry(index):
+    """Return the geometry of the flow directions raster that the index was built from.
+    """
+    return RasterGeometry(index.shape, index.geotransform, index.projection)
+
+def num_rows(index):
+    """Return the number of rows (measurements) in the index.
+    """
+    return len(index.indptr) - 1
+
+def row_lengths(index):
+    """Return the number of cells upstream of each row.
+       Rows whose measurement is not in the flow directions raster have none.
+    """
+    return np.diff(index.indptr)
+
+def row_cells(index, i):
+    """Return the linear indices of the cells upstream of row i.
+       If the index is memory-mapped, this is a view and is not copied into memory.
+    """
+    return index.cells[index.indptr[i]:index.indptr[i+1]]
+
+def select_rows(index, mask):
+    """Return the linear indices of the cells upstream of each row where mask is True.
+    """
+    return [row_cells(index, i) for i in np.flatnonzero(mask)]
+
+def row_coords(index, i):
+    """Return the (row, col) coordinate pairs of the cells upstream of row i.
+    """
+    rows, cols = np.unravel_index(row_cells(index, i), index.shape)
+    return list(zip(rows.tolist(), cols.tolist()))